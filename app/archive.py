@@ -0,0 +1,69 @@
+"""Export, convert and import activity archives from the command line.
+
+Usage:
+    python archive.py export START_DATE OUTPUT [--end-date END_DATE] [--account NAME]
+    python archive.py convert SOURCE TARGET [--profile NAME] [--workers N]
+    python archive.py import ARCHIVE [--limit N] [--account NAME]
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+
+from services.archive import ARCHIVE_WORKERS, convert_archive, export_archive, import_archive
+from services.fit_file_service import FitFileService
+from services.service_context import ServiceContext, load_accounts
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="download the raw .fit files of a date range")
+    export.add_argument("start_date", help="export activities started after this day (YYYY-MM-DD)")
+    export.add_argument("output", help=".tar.gz archive to write")
+    export.add_argument("--end-date", help="only activities started before this day (YYYY-MM-DD)")
+    export.add_argument("--account", help="account to export, required with several accounts")
+
+    convert = commands.add_parser("convert", help="convert an exported archive, offline")
+    convert.add_argument("source", help="archive written by export")
+    convert.add_argument("target", help=".tar.gz archive to write")
+    convert.add_argument("--profile", help="device profile, defaults to DEVICE_PROFILE")
+    convert.add_argument("--workers", type=int, default=ARCHIVE_WORKERS, help="conversion processes")
+
+    upload = commands.add_parser("import", help="upload a converted archive to Garmin Connect")
+    upload.add_argument("archive", help="archive written by convert")
+    upload.add_argument("--limit", type=int, help="upload at most this many activities")
+    upload.add_argument("--account", help="account to import to, required with several accounts")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    fit_file_service = FitFileService()
+    if args.command == "convert":
+        result = convert_archive(fit_file_service, args.source, args.target, args.profile, args.workers)
+    else:
+        try:
+            context = ServiceContext(load_accounts(), fit_file_service, async_io=False)
+            name = context.resolve_account(args.account)
+        except ValueError as e:
+            parser.error(str(e))
+        try:
+            account = context.account(name)
+            if args.command == "export":
+                result = export_archive(account.zwift_service, args.output, args.start_date, args.end_date)
+            else:
+                result = import_archive(account.processor.upload_scheduler, account.sync_state,
+                                        args.archive, args.limit)
+        finally:
+            context.close()
+    json.dump(result, sys.stdout, indent=2)
+    print()
+    return 0 if not result["failed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,4 +7,4 @@ garmin_password = os.getenv("GARMIN_PASSWORD")
 garth.login(garmin_username, garmin_password)
 
 # Save the session tokens for future use (up to one year)
-garth.save("/app/data/.garth")
+garth.save(os.getenv("GARMIN_TOKEN_FILE", "/app/data/.garth"))
@@ -1,61 +1,268 @@
 """Main entry point for Zwift to Garmin activity transfer."""
 
-import sys
 import os
+import asyncio
 import logging
-import uvicorn
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime
 
-from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
-from services.zwift_service import ZwiftService
-from services.fit_file_service import FitFileService
-from services.garmin_service import GarminService
-from services.activity_processor import ActivityProcessor
+from typing import Literal, Optional
 
-app = FastAPI()
+from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, RedirectResponse, StreamingResponse
+from pydantic import BaseModel
+from services.service_context import (
+    ARCHIVE_JOBS,
+    ASYNC_IO,
+    JOB_ARCHIVE_CONVERT,
+    JOB_ARCHIVE_EXPORT,
+    JOB_LAST_X,
+    JOB_LATEST,
+    JOB_SINCE_DATE,
+    get_context,
+    aclose_context,
+)
+from services.job_queue import AsyncJobManager, JobManager
+from services.job_store import JobStore
+from services.archive import archive_path
+from services.poller import POLL_ENABLED, ActivityPoller
+from services.metrics import REGISTRY
+
+# Seconds /sync_latest/ waits for its job before answering with the job id
+SYNC_TIMEOUT = float(os.getenv("SYNC_TIMEOUT", "300"))
+# "background" loads the sync dependencies and logs in once the server is ready,
+# "startup" does so before it accepts requests, "off" leaves it to the first sync
+WARM_UP = os.getenv("WARM_UP", "background")
+# Restart on code changes, for development only
+RELOAD = os.getenv("RELOAD", "false").lower() in ("1", "true", "yes")
+
+job_manager: Optional[JobManager] = None
+
+
+class JobRequest(BaseModel):
+    """Body of POST /jobs."""
+
+    kind: Literal["latest", "last_x", "since_date", "new",
+                  "archive_export", "archive_convert", "archive_import"] = JOB_LATEST
+    count: Optional[int] = None
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    archive: Optional[str] = None
+    output: Optional[str] = None
+    profile: Optional[str] = None
+    account: Optional[str] = None
+
+
+def run_job(job):
+    return get_context().run_job(job)
+
+
+async def run_job_async(job):
+    return await get_context().run_job_async(job)
+
+
+def job_target(account: Optional[str], profile: Optional[str]):
+    """Resolve the account and device profile of a request, rejecting unknown names."""
+    try:
+        context = get_context()
+    except ValueError as e:
+        # no account can be resolved without the configuration, answer instead of failing with a 500
+        raise HTTPException(status_code=400, detail=f"Accounts are not configured: {e}")
+    try:
+        account = context.resolve_account(account)
+        if profile is not None:
+            context.fit_file_service.get_profile(profile)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return account, ({"profile": profile} if profile is not None else {})
+
+
+def check_date(name: str, value: str) -> str:
+    """Reject dates that are not YYYY-MM-DD."""
+    try:
+        datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"{name} must be a date like 2025-01-31")
+    return value
+
+
+def archive_params(request: JobRequest) -> dict:
+    """Parameters of an archive job; archives are named files in ARCHIVE_DIR."""
+    if not request.archive:
+        raise HTTPException(status_code=422, detail="archive is required")
+    params = {"archive": request.archive}
+    if request.kind == JOB_ARCHIVE_EXPORT:
+        if not request.start_date:
+            raise HTTPException(status_code=422, detail="start_date is required")
+        params["start_date"] = check_date("start_date", request.start_date)
+        if request.end_date:
+            params["end_date"] = check_date("end_date", request.end_date)
+    elif request.kind == JOB_ARCHIVE_CONVERT:
+        if not request.output:
+            raise HTTPException(status_code=422, detail="output is required")
+        params["output"] = request.output
+    elif request.count is not None:
+        if request.count < 1:
+            raise HTTPException(status_code=422, detail="count must be a positive number")
+        # imports upload at most count activities per job
+        params["count"] = request.count
+    try:
+        for name in (params["archive"], params.get("output")):
+            if name is not None:
+                archive_path(name)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return params
+
+
+async def warm_up(context) -> None:
+    """Run the warm-up of the services next to the first requests; failures are left to the first sync."""
+    try:
+        await asyncio.to_thread(context.warm_up)
+    except Exception:
+        logging.getLogger(__name__).exception("Warm-up failed")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the shared services once at startup, loading and logging in as WARM_UP says."""
+    global job_manager
+    logger = logging.getLogger(__name__)
+    context = None
+    try:
+        context = get_context()
+    except ValueError:
+        # keep serving; the endpoints report the missing configuration
+        logger.exception("Failed to create services at startup")
+    else:
+        if WARM_UP == "startup":
+            await run_in_threadpool(context.warm_up)
+    # jobs left queued or running by the last process are resumed right away
+    job_store = JobStore()
+    if ASYNC_IO:
+        job_manager = AsyncJobManager(run_job_async, store=job_store)
+    else:
+        job_manager = JobManager(run_job, store=job_store)
+    poller_task = None
+    if POLL_ENABLED and context is not None:
+        poller_task = asyncio.create_task(ActivityPoller(context, job_manager.submit).run())
+    warm_up_task = None
+    if WARM_UP == "background" and context is not None:
+        # runs while the first requests are served; syncs wait for the logins it has started
+        warm_up_task = asyncio.create_task(warm_up(context))
+    yield
+    if poller_task is not None:
+        poller_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await poller_task
+    if warm_up_task is not None:
+        await warm_up_task
+    await job_manager.aclose()
+    job_store.close()
+    await aclose_context()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure logging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=LOG_LEVEL,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
+# Keep HTTP client internals quiet unless explicitly requested
+for noisy_logger in ("urllib3", "requests_oauthlib", "oauthlib", "httpx", "httpcore", "multipart"):
+    logging.getLogger(noisy_logger).setLevel(os.getenv("THIRD_PARTY_LOG_LEVEL", "WARNING").upper())
 
 @app.get("/sync_latest/")
-def sync_latest():
+async def sync_latest(profile: Optional[str] = None, account: Optional[str] = None):
     """Main function to orchestrate the activity transfer process."""
-    # Load environment variables from .env file
-    logger = logging.getLogger(__name__)
-    logger.info("test")
-    garmin_username = os.getenv("GARMIN_USERNAME")
-    garmin_password = os.getenv("GARMIN_PASSWORD")
-    zwift_username = os.getenv("ZWIFT_USERNAME")
-    zwift_password = os.getenv("ZWIFT_PASSWORD")
+    account, params = job_target(account, profile)
+    # Overlapping calls are coalesced into the same job
+    job = job_manager.submit(JOB_LATEST, params, account)
+    if not await job.wait_async(SYNC_TIMEOUT):
+        return {"pending": "Transfer still running", "job_id": job.id}
 
-    # Validate required environment variables
-    if not all([zwift_username, zwift_password, garmin_username, garmin_password]):
-        raise ValueError("Missing required environment variables.")
+    if job.result and job.result["success"]:
+        return {"success": "Activity successfully transferred from Zwift to Garmin"}
+    else:
+        return {"failed": "Failed to transfer activity. Check the logs for details."}  
 
-    # Initialize services with dependency injection
-    zwift_service = ZwiftService(zwift_username, zwift_password)
-    fit_file_service = FitFileService()
-    garmin_service = GarminService(garmin_username, garmin_password)
 
-    # Create the main processor
-    processor = ActivityProcessor(zwift_service, garmin_service, fit_file_service)
+@app.post("/jobs", status_code=202)
+async def create_job(request: JobRequest):
+    """Queue a sync in the background and return its job id immediately."""
+    account, params = job_target(request.account, request.profile)
+    if request.kind == JOB_LAST_X:
+        if not request.count or request.count < 1:
+            raise HTTPException(status_code=422, detail="count must be a positive number")
+        params["count"] = request.count
+    elif request.kind == JOB_SINCE_DATE:
+        if not request.start_date:
+            raise HTTPException(status_code=422, detail="start_date is required")
+        params["start_date"] = check_date("start_date", request.start_date)
+    elif request.kind in ARCHIVE_JOBS:
+        params.update(archive_params(request))
+    job = job_manager.submit(request.kind, params, account)
+    return {"job_id": job.id, "status": job.status}
 
-    # Process the latest activity
-    success = processor.process_latest_activity()
 
-    if success:
-        return {"success": "Activity successfully transferred from Zwift to Garmin"}
-    else:
-        return {"failed": "Failed to transfer activity. Check the logs for details."}  
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Return status and result of a job, and for batches the state of each of their activities."""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    data = job.to_dict()
+    progress = await run_in_threadpool(get_context().job_progress, job)
+    if progress is not None:
+        data["progress"] = progress
+    return data
+
+
+@app.post("/jobs/{job_id}/retry", status_code=202)
+async def retry_job(job_id: str):
+    """Run a finished job again; a batch continues with the activities that have not reached Garmin yet."""
+    job = job_manager.retry(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return {"job_id": job.id, "status": job.status}
+
+
+@app.get("/archive")
+async def export_archive(start_date: str, end_date: Optional[str] = None, account: Optional[str] = None):
+    """Stream the raw Zwift activities started between start_date and end_date (YYYY-MM-DD) as .tar.gz."""
+    account, _ = job_target(account, None)
+    check_date("start_date", start_date)
+    if end_date is not None:
+        check_date("end_date", end_date)
+    context = get_context()
+    try:
+        # log in before the response starts, a failure can't be reported in the middle of the stream
+        await run_in_threadpool(context.account(account).zwift_service.authenticate)
+    except Exception as e:
+        logging.getLogger(__name__).exception("Zwift login for the export failed")
+        raise HTTPException(status_code=502, detail=f"Zwift login failed: {e}")
+    file_name = f"zwift_{account}_{start_date}{'_' + end_date if end_date else ''}.tar.gz"
+    return StreamingResponse(context.export_stream(account, start_date, end_date), media_type="application/gzip",
+                             headers={"Content-Disposition": f'attachment; filename="{file_name}"'})
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Expose stage timings and counters in the Prometheus text format."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/", include_in_schema=False)
-def index():
+async def index():
     return RedirectResponse(url="/docs")    
 
 # This block tells Python what to do when the script is run directly
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    import uvicorn
+
+    # the reloader needs the import string, without it the app imported above is served as is
+    uvicorn.run("main:app" if RELOAD else app, host="0.0.0.0", port=8000, reload=RELOAD,
+                log_level=LOG_LEVEL.lower())
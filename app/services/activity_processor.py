@@ -1,120 +1,266 @@
 """Activity processor for orchestrating the Zwift to Garmin workflow."""
 
 import logging
-from typing import Optional
+from typing import Any, Dict, List, Optional
 from services.zwift_service import ZwiftService
 from services.fit_file_service import FitFileService
-from services.garmin_service import GarminService
+from services.garmin_service import GarminService, UploadError
+from services.batch_sync import ActivityResult, BatchSyncEngine, STAGE_DOWNLOAD, STATUS_SKIPPED
+from services.upload_scheduler import UploadScheduler
+from services.fit_records import ActivityValidator
+from services.fit_cache import ConvertedFitCache
+from services.buffers import read_buffer
+from services.metrics import ACTIVITIES_SYNCED
+from services.job_store import BatchCheckpoint
+from services.sync_state import (
+    SyncStateStore,
+    STATE_CONVERTED,
+    STATE_DOWNLOADED,
+    STATE_DUPLICATE,
+    STATE_FAILED,
+    STATE_UPLOADED,
+    fit_hash,
+)
 
 class ActivityProcessor:
     """Main orchestrator for processing activities from Zwift to Garmin."""
 
     def __init__(self,
-                 zwift_service: ZwiftService, garmin_service: GarminService, fit_file_service:FitFileService):
+                 zwift_service: ZwiftService, garmin_service: GarminService, fit_file_service:FitFileService,
+                 sync_state: Optional[SyncStateStore] = None,
+                 fit_cache: Optional[ConvertedFitCache] = None,
+                 validator: Optional[ActivityValidator] = None):
         """Initialize ActivityProcessor with injected services.
 
         Args:
             zwift_service: Service for Zwift operations
             fit_file_service: Service for FIT file operations
             garmin_service: Service for Garmin operations
+            sync_state: Index of transferred activities; without it nothing is skipped
+            fit_cache: Cache of converted files, may be shared between accounts
+            validator: Sanity check of downloaded activities, may be shared between accounts
         """
         self.zwift_service = zwift_service
         self.fit_file_service = fit_file_service
         self.garmin_service = garmin_service
+        self.sync_state = sync_state
+        self.upload_scheduler = UploadScheduler(garmin_service, sync_state)
+        self.validator = validator or ActivityValidator()
+        self.fit_cache = fit_cache or ConvertedFitCache()
 #        self.runalyze_service = runalyze_service
         self.logger = logging.getLogger(__name__)
 
 
-    def process_latest_activity(self) -> bool:
+    def process_latest_activity(self, profile: Optional[str] = None) -> bool:
         """Process the latest activity from Zwift to Garmin.
 
+        Args:
+            profile: Device profile the activity is converted to, defaults to the configured one
+
         Returns:
             True if successful, False otherwise
         """
-        original_file_path: Optional[str] = None
-        modified_file_path: Optional[str] = None        
+        activity: Optional[Dict[str, Any]] = None
 
         try:
             # Step 1: Authenticate with Zwift and download activity
             self.logger.info("Starting activity processing...")
+            self._retry_pending_uploads()
             self.zwift_service.authenticate()
 
-            original_file_path = self.zwift_service.download_last_activity()
-            if not original_file_path:
+            activity = self.zwift_service.get_latest_activity()
+            if activity is None:
                 self.logger.info("No activities found to process")
                 return False
-            
-            modified_file_path = self.fit_file_service.modify_device_info(original_file_path)
-            self.garmin_service.authenticate()
-            response = self.garmin_service.upload_activity(modified_file_path)
+            if self._is_synced(activity):
+                self.logger.info(f"Latest activity {activity['id']} was already transferred")
+                return True
+
+            # a retry of an activity that was already converted skips straight to the upload
+            modified_file = self._cached_conversion(activity, profile)
+            if modified_file is None:
+                original_file = self.zwift_service.fetch_activity(activity)
+
+                # buffers are anonymous, closing them frees memory and any spooled file
+                with original_file:
+                    data = read_buffer(original_file)
+                    content_hash = fit_hash(data)
+                    if self.sync_state is not None and self.sync_state.find_synced_hash(content_hash):
+                        self.logger.info(f"Activity {activity['id']} has the content of an already synced activity")
+                        self._mark(activity, STATE_DUPLICATE, content_hash=content_hash)
+                        return True
+                    self._mark(activity, STATE_DOWNLOADED, content_hash=content_hash)
+                    self.validator.validate(activity["id"], data)
+                    modified_file = self.fit_file_service.modify_device_info_stream(original_file, profile)
+                self.fit_cache.put(activity["id"], content_hash, self.fit_file_service.profile_key(profile),
+                                   modified_file)
+                self._mark(activity, STATE_CONVERTED)
+            with modified_file:
+                response = self.upload_scheduler.upload(
+                    activity["id"], modified_file, f"zwift_activity_{activity['id']}.fit")
+            self._mark(activity, STATE_UPLOADED if response is not None else STATE_DUPLICATE,
+                       garmin_upload_id=self.garmin_service.extract_upload_id(response))
 
             self.logger.info("Activity processing completed successfully")
             self.logger.debug(f"Upload response: {response}")
             return True
 
-        except Exception:
+        except Exception as e:
             self.logger.exception("Activity processing failed")
+            # uploads parked by the scheduler keep their retry_pending state
+            parked = isinstance(e, UploadError) and e.transient and self.sync_state is not None
+            if activity is not None and not parked:
+                self._mark(activity, STATE_FAILED, error=str(e))
             return False
 
-        finally:
-           if original_file_path:
-               self.fit_file_service.cleanup_file(original_file_path)
-           if modified_file_path:
-               self.fit_file_service.cleanup_file(modified_file_path)
+    def process_new_activities(self, profile: Optional[str] = None) -> List[ActivityResult]:
+        """Process all activities that are newer than the last synced one.
 
-    def process_last_x_activities(self, x:int) -> bool:
-        """Process the latest activity from Zwift to Garmin.
+        The listing stops at the stored high-water mark, so a routine sync only
+        fetches a single page. Without a mark only the latest activity is taken.
+
+        Args:
+            profile: Device profile the activities are converted to, defaults to the configured one
 
         Returns:
-            True if successful, False otherwise
+            One result per activity; empty if nothing was new
+
+        Raises:
+            Exception: If the batch could not be started, e.g. the login or the listing failed
         """
-        file_path_list = []
+        if self.sync_state is None:
+            raise RuntimeError("Processing new activities requires a sync state store")
+        self.logger.info("Starting activity processing...")
+        self._retry_pending_uploads()
+        self.zwift_service.authenticate()
+        high_water_mark = self.sync_state.get_high_water_mark()
+        if high_water_mark is None:
+            activities = self.zwift_service.get_last_x_activities(1)
+        else:
+            activities = self.zwift_service.get_activities_after(
+                high_water_mark, self.sync_state.get_high_water_mark_start())
+        results = self._process_batch(activities, profile)
 
+        self._advance_high_water_mark(activities, results)
+        return results
+
+    def _advance_high_water_mark(self, activities: List[Dict[str, Any]], results: List[ActivityResult]) -> None:
+        # only move the mark over an unbroken run of successes, oldest first
+        for activity, result in zip(reversed(activities), reversed(results)):
+            if not result.success:
+                break
+            self.sync_state.set_high_water_mark(result.activity_id, ZwiftService.activity_start_date(activity))
+
+    def _retry_pending_uploads(self) -> None:
+        """Give uploads that failed transiently in an earlier sync another try."""
         try:
-            # Step 1: Authenticate with Zwift and download activity
-            self.logger.info("Starting activity processing...")
-            self.zwift_service.authenticate()
+            retried = self.upload_scheduler.retry_pending()
+        except Exception:
+            self.logger.exception("Retrying queued uploads failed")
+            return
+        if retried:
+            self.logger.info(f"Uploaded {retried} previously queued activities")
 
-            file_path_list = self.zwift_service.download_last_x_activities(x)
+    def _cached_conversion(self, activity: Dict[str, Any], profile: Optional[str]):
+        """Return the cached modified FIT file of an earlier attempt, if there is one."""
+        state = self.sync_state.get(activity["id"]) if self.sync_state is not None else None
+        if state is None:
+            return None
+        return self.fit_cache.get(activity["id"], state["fit_hash"], self.fit_file_service.profile_key(profile))
 
-            for file_path in file_path_list:
-                modified_file_path = self.fit_file_service.modify_device_info(file_path)
-                self.garmin_service.authenticate()
-                response = self.garmin_service.upload_activity(modified_file_path)                
-                self.logger.info("Activity processing completed successfully")
-                self.logger.debug(f"Upload response: {response}")
-            return True
+    def _is_synced(self, activity: Dict[str, Any]) -> bool:
+        return self.sync_state is not None and self.sync_state.is_synced(activity["id"])
 
-        except Exception:
-            self.logger.exception("Activity processing failed")
-            return False
+    def _mark(self, activity: Dict[str, Any], state: str, **kwargs) -> None:
+        if state in (STATE_UPLOADED, STATE_DUPLICATE, STATE_FAILED):
+            ACTIVITIES_SYNCED.inc(status=state)
+        if self.sync_state is not None:
+            self.sync_state.mark(activity["id"], state, **kwargs)
 
-        finally:
-           for file_path in file_path_list:
-               self.fit_file_service.cleanup_file(file_path)
+    def process_last_x_activities(self, x:int, profile: Optional[str] = None,
+                                  checkpoint: Optional[BatchCheckpoint] = None) -> List[ActivityResult]:
+        """Process the last ``x`` activities from Zwift to Garmin.
 
-    def process_activities_since_date(self, start_date:str) -> bool:
-        file_path_list = []
+        Args:
+            profile: Device profile the activities are converted to, defaults to the configured one
+            checkpoint: Records the listed activities; an interrupted run resumes with the same ones
 
-        try:
-            # Step 1: Authenticate with Zwift and download activity
-            self.logger.info("Starting activity processing...")
-            self.zwift_service.authenticate()
+        Returns:
+            One result per activity
 
-            file_path_list = self.zwift_service.download_activities_since_date(start_date)
+        Raises:
+            Exception: If the batch could not be started, e.g. the login or the listing failed
+        """
+        self.logger.info("Starting activity processing...")
+        self._retry_pending_uploads()
+        self.zwift_service.authenticate()
+        activities = self._resumed(checkpoint)
+        if activities is None:
+            activities = self._checkpoint(checkpoint, self.zwift_service.get_last_x_activities(x))
+        return self._process_batch(activities, profile)
 
-            for file_path in file_path_list:
-                modified_file_path = self.fit_file_service.modify_device_info(file_path)
-                self.garmin_service.authenticate()
-                response = self.garmin_service.upload_activity(modified_file_path)                
-                self.logger.info("Activity processing completed successfully")
-                self.logger.debug(f"Upload response: {response}")            
-            return True
+    def process_activities_since_date(self, start_date:str, profile: Optional[str] = None,
+                                      checkpoint: Optional[BatchCheckpoint] = None) -> List[ActivityResult]:
+        """Process all activities started after ``start_date`` (YYYY-MM-DD).
 
-        except Exception:
-            self.logger.exception("Activity processing failed")
-            return False
+        Args:
+            profile: Device profile the activities are converted to, defaults to the configured one
+            checkpoint: Records the listed activities; an interrupted run resumes with the same ones
+
+        Returns:
+            One result per activity
+
+        Raises:
+            Exception: If the batch could not be started, e.g. the login or the listing failed
+        """
+        self.logger.info("Starting activity processing...")
+        self._retry_pending_uploads()
+        self.zwift_service.authenticate()
+        activities = self._resumed(checkpoint)
+        if activities is None:
+            activities = self._checkpoint(checkpoint, self.zwift_service.get_activities_since_date(start_date))
+        return self._process_batch(activities, profile)
+
+    def _resumed(self, checkpoint: Optional[BatchCheckpoint]) -> Optional[List[Dict[str, Any]]]:
+        """The activities an earlier run of the same job listed, if it got that far."""
+        activities = checkpoint.load() if checkpoint is not None else None
+        if activities is not None:
+            self.logger.info(f"Resuming batch of {len(activities)} activities")
+        return activities
+
+    @staticmethod
+    def _checkpoint(checkpoint: Optional[BatchCheckpoint], activities: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        if checkpoint is not None:
+            checkpoint.save(activities)
+        return activities
+
+    def _process_batch(self, activities: List[Dict[str, Any]], profile: Optional[str]) -> List[ActivityResult]:
+        pending = self._pending(activities)
+        transferred: Dict[Any, ActivityResult] = {}
+        if pending:
+            self.garmin_service.authenticate()
+            engine = BatchSyncEngine(self.zwift_service, self.garmin_service, self.fit_file_service,
+                                     sync_state=self.sync_state, upload_scheduler=self.upload_scheduler,
+                                     validator=self.validator, fit_cache=self.fit_cache, profile=profile)
+            transferred = {result.activity_id: result for result in engine.run(pending)}
+        return self._batch_results(activities, transferred)
+
+    def _pending(self, activities: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """The activities of a batch that still have to be transferred."""
+        if not activities:
+            self.logger.info("No activities found to process")
+            return []
+        skipped = {activity["id"] for activity in activities if self._is_synced(activity)}
+        if skipped:
+            self.logger.info(f"Skipping {len(skipped)} already transferred activities")
+        return [activity for activity in activities if activity["id"] not in skipped]
 
-        finally:
-           for file_path in file_path_list:
-               self.fit_file_service.cleanup_file(file_path)
+    def _batch_results(self, activities: List[Dict[str, Any]],
+                       transferred: Dict[Any, ActivityResult]) -> List[ActivityResult]:
+        """One result per activity of a batch, skipped for those that were not transferred."""
+        results = [transferred.get(activity["id"]) or ActivityResult(activity["id"], STATUS_SKIPPED, STAGE_DOWNLOAD)
+                   for activity in activities]
+        if results:
+            failed = sum(1 for result in results if not result.success)
+            self.logger.info(f"Batch finished: {len(results) - failed} succeeded, {failed} failed")
+        return results
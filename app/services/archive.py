@@ -0,0 +1,365 @@
+"""Bulk export, conversion and import of activities as compressed tar archives.
+
+Backfills of a long history are split into three phases that can run at
+different times: the raw .fit files of a date range are exported from
+Zwift, the archive is converted offline on all cores, and the converted
+archive is imported to Garmin in batches. Archives are read and written as
+gzip streams, one activity at a time, so their size is not bound by memory.
+"""
+
+import os
+import re
+import io
+import logging
+import tarfile
+import tempfile
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, BinaryIO, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from services.batch_sync import DOWNLOAD_WORKERS
+from services.buffers import buffer_from_bytes, read_buffer
+from services.device_profiles import DeviceProfile
+from services.fit_file_service import ENGINE_NATIVE, FitFileService
+from services.fit_records import ActivityValidator
+from services.garmin_service import GarminService, UploadError
+from services.sync_state import (
+    DATA_DIR,
+    STATE_DUPLICATE,
+    STATE_FAILED,
+    STATE_RETRY_PENDING,
+    STATE_UPLOADED,
+    SyncStateStore,
+    fit_hash,
+)
+from services.upload_scheduler import UploadScheduler
+from services.zwift_service import ZwiftService
+
+# Where the archive jobs read and write archives, named without directories
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(DATA_DIR, "archives"))
+# Processes converting an archive with the native engine, one per core by default;
+# the jvm and csv engines convert in this process on its shared codec instead of a JVM per process
+ARCHIVE_WORKERS = int(os.getenv("ARCHIVE_WORKERS", str(os.cpu_count() or 1)))
+
+# PAX headers of converted members: key of the device profile and hash of the original download
+PAX_PROFILE = "ZWIFT_TO_GARMIN.profile"
+PAX_FIT_HASH = "ZWIFT_TO_GARMIN.fit_hash"
+
+_MEMBER_NAME = re.compile(r"^zwift_activity_(\d+)\.fit$")
+_ARCHIVE_NAME = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]*$")
+
+logger = logging.getLogger(__name__)
+
+
+def archive_path(name: str) -> str:
+    """Location of an archive in ARCHIVE_DIR.
+
+    Raises:
+        ValueError: If the name is not a plain file name
+    """
+    if not _ARCHIVE_NAME.match(name):
+        raise ValueError(f"Invalid archive name: {name}")
+    return os.path.join(ARCHIVE_DIR, name)
+
+
+def member_name(activity_id: Any) -> str:
+    """Name of an activity inside an archive, also used as the file name reported to Garmin."""
+    return f"zwift_activity_{activity_id}.fit"
+
+
+def _activity_id(member: tarfile.TarInfo) -> Optional[str]:
+    match = _MEMBER_NAME.match(member.name) if member.isfile() else None
+    return match.group(1) if match else None
+
+
+def _add_member(tar: tarfile.TarFile, name: str, data: BinaryIO, mtime: float,
+                pax_headers: Optional[Dict[str, str]] = None) -> None:
+    info = tarfile.TarInfo(name)
+    data.seek(0, io.SEEK_END)
+    info.size = data.tell()
+    data.seek(0)
+    info.mtime = int(mtime)
+    info.pax_headers = pax_headers or {}
+    tar.addfile(info, data)
+
+
+@contextmanager
+def _write_atomically(path: str) -> Iterator[BinaryIO]:
+    """Write to a temporary file next to ``path`` that only replaces it once it is complete."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    # unique, so jobs writing the same archive don't write into each other's partial file
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".part", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f_out:
+            yield f_out
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class _Chunks(io.RawIOBase):
+    """Collects what tarfile writes until it is handed on as one chunk."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def _in_order(executor: Executor, items: Iterator[Tuple[Any, tuple]], function, window: int
+              ) -> Iterator[Tuple[Any, Future]]:
+    """Run ``function`` on the executor for every (key, args) item, yielding the futures in order.
+
+    At most ``window`` items are in flight, so a long archive or listing is
+    never held in memory at once.
+    """
+    pending: Deque[Tuple[Any, Future]] = deque()
+    try:
+        for key, args in items:
+            pending.append((key, executor.submit(function, *args)))
+            if len(pending) >= window:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        # the consumer stopped early; don't start the rest and free what already finished
+        for _, future in pending:
+            if not future.cancel() and future.exception() is None:
+                result = future.result()
+                if hasattr(result, "close"):
+                    result.close()
+
+
+def activities_between(zwift_service: ZwiftService, start_date: str,
+                       end_date: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Activities started after ``start_date`` and before ``end_date`` (YYYY-MM-DD), oldest first."""
+    activities = zwift_service.get_activities_since_date(start_date)
+    if end_date is not None:
+        end = datetime.strptime(end_date, "%Y-%m-%d")
+        activities = [activity for activity in activities if ZwiftService.activity_start_date(activity) < end]
+    return activities[::-1]
+
+
+def _export(zwift_service: ZwiftService, fileobj: BinaryIO, start_date: str, end_date: Optional[str],
+            failed: List[Dict[str, Any]]) -> Iterator[Any]:
+    """Write the raw activities of a date range to ``fileobj``, yielding each id once it is written."""
+    zwift_service.authenticate()
+    activities = activities_between(zwift_service, start_date, end_date)
+    logger.info(f"Exporting {len(activities)} activities")
+    with ThreadPoolExecutor(DOWNLOAD_WORKERS, thread_name_prefix="archive-download") as executor, \
+            tarfile.open(fileobj=fileobj, mode="w|gz", format=tarfile.PAX_FORMAT) as tar:
+        downloads = ((activity, (activity,)) for activity in activities)
+        for activity, future in _in_order(executor, downloads, zwift_service.fetch_activity, 2 * DOWNLOAD_WORKERS):
+            try:
+                fit_file = future.result()
+            except Exception as e:
+                logger.exception(f"Export of activity {activity['id']} failed")
+                failed.append({"activity_id": activity["id"], "error": str(e)})
+                continue
+            start = ZwiftService.activity_start_date(activity).replace(tzinfo=timezone.utc)
+            with fit_file:
+                _add_member(tar, member_name(activity["id"]), fit_file, start.timestamp())
+            yield activity["id"]
+
+
+def iter_export(zwift_service: ZwiftService, start_date: str, end_date: Optional[str] = None) -> Iterator[bytes]:
+    """Stream the raw activities of a date range as chunks of a .tar.gz archive.
+
+    A chunk is produced per activity; downloads run DOWNLOAD_WORKERS at a time
+    ahead of the one being written. Activities that fail to download are
+    logged and left out.
+    """
+    chunks = _Chunks()
+    for _ in _export(zwift_service, chunks, start_date, end_date, []):
+        yield chunks.drain()
+    yield chunks.drain()
+
+
+def export_archive(zwift_service: ZwiftService, path: str, start_date: str,
+                   end_date: Optional[str] = None) -> Dict[str, Any]:
+    """Write the raw activities of a date range to a .tar.gz archive at ``path``.
+
+    Returns:
+        Number of exported activities and the ones that failed to download
+    """
+    failed: List[Dict[str, Any]] = []
+    with _write_atomically(path) as f_out:
+        exported = sum(1 for _ in _export(zwift_service, f_out, start_date, end_date, failed))
+    logger.info(f"Exported {exported} activities to {path}")
+    return {"exported": exported, "failed": failed}
+
+
+_worker_service: Optional[FitFileService] = None
+_worker_validator: Optional[ActivityValidator] = None
+
+
+def _init_worker(engine: str, profiles: Dict[str, DeviceProfile], default_profile: str) -> None:
+    global _worker_service, _worker_validator
+    _worker_service = FitFileService(engine, profiles, default_profile)
+    _worker_validator = ActivityValidator()
+
+
+def _convert_member(fit_file_service: FitFileService, validator: ActivityValidator,
+                    activity_id: str, data: bytes, profile: Optional[str]) -> bytes:
+    """Validate and convert one activity."""
+    validator.validate(activity_id, data)
+    with buffer_from_bytes(data) as original, \
+            fit_file_service.modify_device_info_stream(original, profile) as modified:
+        return read_buffer(modified)
+
+
+def _convert(activity_id: str, data: bytes, profile: Optional[str]) -> bytes:
+    """Validate and convert one activity; runs in a worker process set up by _init_worker()."""
+    return _convert_member(_worker_service, _worker_validator, activity_id, data, profile)
+
+
+def _workers(fit_file_service: FitFileService, workers: int) -> int:
+    """Conversion processes for an engine: every process of the jvm and csv engines would start its own JVM."""
+    return max(1, workers) if fit_file_service.engine == ENGINE_NATIVE else 1
+
+
+def _executor(fit_file_service: FitFileService, workers: int) -> Tuple[Executor, Callable[..., bytes]]:
+    """The executor converting an archive and the conversion function to submit to it."""
+    if workers <= 1:
+        # in this process, with the caller's service; archive jobs of other accounts may run next to it
+        return (ThreadPoolExecutor(1, thread_name_prefix="archive-convert"),
+                partial(_convert_member, fit_file_service, ActivityValidator()))
+    initargs = (fit_file_service.engine, fit_file_service.profiles, fit_file_service.default_profile)
+    # spawned rather than forked, a running JVM or held locks don't survive a fork
+    return (ProcessPoolExecutor(workers, multiprocessing.get_context("spawn"), _init_worker, initargs),
+            _convert)
+
+
+def convert_archive(fit_file_service: FitFileService, source: str, target: str,
+                    profile: Optional[str] = None, workers: int = ARCHIVE_WORKERS) -> Dict[str, Any]:
+    """Validate and convert every activity of an exported archive into a new archive.
+
+    The conversions of the native engine run on ``workers`` processes, so
+    they use all cores; the jvm and csv engines convert in this process on
+    the JVM ``fit_file_service`` already runs, rather than starting one per
+    process. Converted members carry the device profile and the hash of
+    the original file, which import_archive() uses to skip activities that
+    were already synced.
+
+    Returns:
+        Number of converted activities and the ones that failed
+    """
+    profile_key = fit_file_service.profile_key(profile)
+    workers = _workers(fit_file_service, workers)
+    executor, convert = _executor(fit_file_service, workers)
+    failed: List[Dict[str, Any]] = []
+    converted = 0
+
+    def members(tar: tarfile.TarFile) -> Iterator[Tuple[Tuple[tarfile.TarInfo, str], tuple]]:
+        for member in tar:
+            activity_id = _activity_id(member)
+            if activity_id is None:
+                logger.warning(f"Skipping {member.name}, not an exported activity")
+                continue
+            data = tar.extractfile(member).read()
+            # converting a converted archive again keeps the hash of the original download
+            original_hash = member.pax_headers.get(PAX_FIT_HASH) or fit_hash(data)
+            yield (member, original_hash), (activity_id, data, profile)
+
+    with executor, tarfile.open(source, mode="r|gz") as tar_in, _write_atomically(target) as f_out, \
+            tarfile.open(fileobj=f_out, mode="w|gz", format=tarfile.PAX_FORMAT) as tar_out:
+        for (member, original_hash), future in _in_order(executor, members(tar_in), convert, 2 * workers):
+            activity_id = _activity_id(member)
+            try:
+                data = future.result()
+            except Exception as e:
+                logger.error(f"Conversion of activity {activity_id} failed: {e}")
+                failed.append({"activity_id": activity_id, "error": str(e)})
+                continue
+            with buffer_from_bytes(data) as modified:
+                _add_member(tar_out, member.name, modified, member.mtime,
+                            {PAX_PROFILE: profile_key, PAX_FIT_HASH: original_hash})
+            converted += 1
+    logger.info(f"Converted {converted} activities into {target}")
+    return {"converted": converted, "failed": failed}
+
+
+def import_archive(upload_scheduler: UploadScheduler, sync_state: SyncStateStore, path: str,
+                   limit: Optional[int] = None) -> Dict[str, Any]:
+    """Upload the activities of a converted archive to Garmin Connect.
+
+    Progress is kept in the sync state: activities that were already
+    transferred, by a sync or an earlier import, are skipped, so an
+    interrupted or ``limit``ed import continues where it stopped when run
+    again. The import stops at the first upload that keeps failing for a
+    transient reason (like ongoing rate limiting); that upload is queued for
+    the next sync like any other, the rest waits for the next run.
+
+    Args:
+        upload_scheduler: Rate limited uploads of the account
+        sync_state: Sync state of the account
+        path: Archive written by convert_archive()
+        limit: Upload at most this many activities
+
+    Returns:
+        Counts of uploaded, duplicate, already synced, queued and remaining activities,
+        the failed ones and the error that stopped the import, if any
+    """
+    result: Dict[str, Any] = {"uploaded": 0, "duplicates": 0, "skipped": 0, "queued": 0, "remaining": 0,
+                              "failed": [], "stopped": None}
+    with tarfile.open(path, mode="r|gz") as tar:
+        for member in tar:
+            activity_id = _activity_id(member)
+            if activity_id is None:
+                continue
+            if PAX_PROFILE not in member.pax_headers:
+                result["failed"].append({"activity_id": activity_id, "error": "not converted, run convert first"})
+                continue
+            content_hash = member.pax_headers.get(PAX_FIT_HASH)
+            state = sync_state.get(activity_id)
+            if sync_state.is_synced(activity_id):
+                result["skipped"] += 1
+                continue
+            if state and state["state"] == STATE_RETRY_PENDING:
+                # already in the retry queue of the account
+                result["queued"] += 1
+                continue
+            if content_hash and sync_state.find_synced_hash(content_hash):
+                logger.info(f"Activity {activity_id} has the content of an already synced activity")
+                sync_state.mark(activity_id, STATE_DUPLICATE, content_hash=content_hash)
+                result["skipped"] += 1
+                continue
+            if result["stopped"] or (limit is not None and result["uploaded"] + result["duplicates"] >= limit):
+                result["remaining"] += 1
+                continue
+
+            with buffer_from_bytes(tar.extractfile(member).read()) as fit_file:
+                try:
+                    response = upload_scheduler.upload(activity_id, fit_file, member.name)
+                except UploadError as e:
+                    if e.transient:
+                        # parked by the scheduler, the next sync retries it
+                        result["queued"] += 1
+                        result["stopped"] = str(e)
+                        continue
+                    sync_state.mark(activity_id, STATE_FAILED, content_hash=content_hash, error=str(e))
+                    result["failed"].append({"activity_id": activity_id, "error": str(e)})
+                    continue
+            uploaded = response is not None
+            sync_state.mark(activity_id, STATE_UPLOADED if uploaded else STATE_DUPLICATE, content_hash=content_hash,
+                            garmin_upload_id=GarminService.extract_upload_id(response))
+            result["uploaded" if uploaded else "duplicates"] += 1
+    logger.info(f"Imported {path}: {result['uploaded']} uploaded, {result['duplicates']} duplicates, "
+                f"{result['remaining']} remaining")
+    return result
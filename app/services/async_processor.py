@@ -0,0 +1,245 @@
+"""Activity processor running the network stages as coroutines."""
+
+import asyncio
+from concurrent.futures import Executor
+from functools import partial
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+import httpx
+
+from services.activity_processor import ActivityProcessor
+from services.zwift_service import AsyncZwiftService, ZwiftService
+from services.fit_file_service import FitFileService
+from services.garmin_service import AsyncGarminService, GarminService, UploadError
+from services.batch_sync import (
+    DOWNLOAD_WORKERS,
+    QUEUE_SIZE,
+    STAGE_CONVERT,
+    STAGE_DOWNLOAD,
+    STAGE_UPLOAD,
+    STAGE_VALIDATE,
+    STATUS_DUPLICATE,
+    STATUS_FAILED,
+    STATUS_SKIPPED,
+    STATUS_UPLOADED,
+    ActivityResult,
+)
+from services.upload_scheduler import UploadScheduler
+from services.fit_records import ActivityValidator
+from services.fit_cache import ConvertedFitCache
+from services.job_store import BatchCheckpoint
+from services.buffers import read_buffer
+from services.sync_state import (
+    SyncStateStore,
+    STATE_CONVERTED,
+    STATE_DOWNLOADED,
+    STATE_DUPLICATE,
+    STATE_FAILED,
+    STATE_UPLOADED,
+    fit_hash,
+)
+
+
+class AsyncActivityProcessor(ActivityProcessor):
+    """ActivityProcessor whose ``*_async`` flows run on the event loop.
+
+    Listing, downloads and uploads are awaited on a connection pool shared by
+    all accounts; validation and conversion run in ``executor``. Within a
+    batch up to DOWNLOAD_WORKERS downloads run at once, uploads of the account
+    go out one at a time, and at most DOWNLOAD_WORKERS + BATCH_QUEUE_SIZE
+    activities are in flight, like the queues of BatchSyncEngine. The
+    blocking flows of ActivityProcessor keep working next to them.
+    """
+
+    def __init__(self,
+                 zwift_service: ZwiftService, garmin_service: GarminService, fit_file_service: FitFileService,
+                 http: httpx.AsyncClient,
+                 executor: Optional[Executor] = None,
+                 sync_state: Optional[SyncStateStore] = None,
+                 fit_cache: Optional[ConvertedFitCache] = None,
+                 validator: Optional[ActivityValidator] = None):
+        """Initialize AsyncActivityProcessor.
+
+        Args:
+            zwift_service: Service for Zwift operations
+            garmin_service: Service for Garmin operations
+            fit_file_service: Service for FIT file operations
+            http: Connection pool shared by all async services
+            executor: Runs validation and conversion, the loop's default executor if omitted
+            sync_state: Index of transferred activities; without it nothing is skipped
+            fit_cache: Cache of converted files, may be shared between accounts
+            validator: Sanity check of downloaded activities, may be shared between accounts
+        """
+        super().__init__(zwift_service, garmin_service, fit_file_service, sync_state, fit_cache, validator)
+        self.async_zwift_service = AsyncZwiftService(zwift_service, http, executor)
+        self.async_garmin_service = AsyncGarminService(garmin_service, http)
+        self.upload_scheduler = UploadScheduler(garmin_service, sync_state,
+                                                async_garmin_service=self.async_garmin_service)
+        self.executor = executor
+        self._downloads = asyncio.Semaphore(DOWNLOAD_WORKERS)
+        self._uploads = asyncio.Lock()
+
+    async def process_latest_activity_async(self, profile: Optional[str] = None) -> bool:
+        """Coroutine variant of process_latest_activity()."""
+        try:
+            self.logger.info("Starting activity processing...")
+            await self._retry_pending_uploads_async()
+            await self.async_zwift_service.authenticate()
+            activity = await self.async_zwift_service.get_latest_activity()
+            synced = activity is not None and await self._in_executor(self._is_synced, activity)
+        except Exception:
+            self.logger.exception("Activity processing failed")
+            return False
+        if activity is None:
+            self.logger.info("No activities found to process")
+            return False
+        if synced:
+            self.logger.info(f"Latest activity {activity['id']} was already transferred")
+            return True
+        result = await self._transfer(activity, profile)
+        if result.success:
+            self.logger.info("Activity processing completed successfully")
+        return result.success
+
+    async def process_new_activities_async(self, profile: Optional[str] = None) -> List[ActivityResult]:
+        """Coroutine variant of process_new_activities()."""
+        if self.sync_state is None:
+            raise RuntimeError("Processing new activities requires a sync state store")
+        self.logger.info("Starting activity processing...")
+        await self._retry_pending_uploads_async()
+        await self.async_zwift_service.authenticate()
+        high_water_mark = await self._in_executor(self.sync_state.get_high_water_mark)
+        if high_water_mark is None:
+            activities = await self.async_zwift_service.get_last_x_activities(1)
+        else:
+            activities = await self.async_zwift_service.get_activities_after(
+                high_water_mark, await self._in_executor(self.sync_state.get_high_water_mark_start))
+        results = await self._process_batch_async(activities, profile)
+        await self._in_executor(self._advance_high_water_mark, activities, results)
+        return results
+
+    async def process_last_x_activities_async(self, x: int, profile: Optional[str] = None,
+                                              checkpoint: Optional[BatchCheckpoint] = None) -> List[ActivityResult]:
+        """Coroutine variant of process_last_x_activities()."""
+        self.logger.info("Starting activity processing...")
+        await self._retry_pending_uploads_async()
+        await self.async_zwift_service.authenticate()
+        activities = await self._in_executor(self._resumed, checkpoint)
+        if activities is None:
+            activities = await self._in_executor(
+                self._checkpoint, checkpoint, await self.async_zwift_service.get_last_x_activities(x))
+        return await self._process_batch_async(activities, profile)
+
+    async def process_activities_since_date_async(self, start_date: str, profile: Optional[str] = None,
+                                                  checkpoint: Optional[BatchCheckpoint] = None
+                                                  ) -> List[ActivityResult]:
+        """Coroutine variant of process_activities_since_date()."""
+        self.logger.info("Starting activity processing...")
+        await self._retry_pending_uploads_async()
+        await self.async_zwift_service.authenticate()
+        activities = await self._in_executor(self._resumed, checkpoint)
+        if activities is None:
+            activities = await self._in_executor(
+                self._checkpoint, checkpoint, await self.async_zwift_service.get_activities_since_date(start_date))
+        return await self._process_batch_async(activities, profile)
+
+    async def _retry_pending_uploads_async(self) -> None:
+        try:
+            retried = await self.upload_scheduler.retry_pending_async()
+        except Exception:
+            self.logger.exception("Retrying queued uploads failed")
+            return
+        if retried:
+            self.logger.info(f"Uploaded {retried} previously queued activities")
+
+    async def _process_batch_async(self, activities: List[Dict[str, Any]],
+                                   profile: Optional[str]) -> List[ActivityResult]:
+        pending = await self._in_executor(self._pending, activities)
+        transferred: Dict[Any, ActivityResult] = {}
+        if pending:
+            await self.async_garmin_service.authenticate()
+            in_flight = asyncio.Semaphore(DOWNLOAD_WORKERS + QUEUE_SIZE)
+
+            async def transfer(activity: Dict[str, Any]) -> ActivityResult:
+                async with in_flight:
+                    return await self._transfer(activity, profile)
+
+            results = await asyncio.gather(*(transfer(activity) for activity in pending))
+            transferred = {result.activity_id: result for result in results}
+        return self._batch_results(activities, transferred)
+
+    async def _in_executor(self, function, *args, **kwargs) -> Any:
+        """Run CPU or disk bound work (hashing, SQLite, the cache) off the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(function, *args, **kwargs))
+
+    def _downloaded(self, activity: Dict[str, Any], original: BinaryIO) -> Tuple[Optional[bytes], str]:
+        """Hash and record a download; no data if it is the content of a synced activity. Runs in the executor."""
+        data = read_buffer(original)
+        content_hash = fit_hash(data)
+        if self.sync_state is not None and self.sync_state.find_synced_hash(content_hash):
+            self._mark(activity, STATE_DUPLICATE, content_hash=content_hash)
+            return None, content_hash
+        self._mark(activity, STATE_DOWNLOADED, content_hash=content_hash)
+        return data, content_hash
+
+    def _convert(self, activity: Dict[str, Any], original: BinaryIO, content_hash: str,
+                 profile: Optional[str]) -> BinaryIO:
+        """Convert a download, cache and record the result; runs in the executor."""
+        with original:
+            modified = self.fit_file_service.modify_device_info_stream(original, profile)
+        try:
+            self.fit_cache.put(activity["id"], content_hash, self.fit_file_service.profile_key(profile), modified)
+            self._mark(activity, STATE_CONVERTED)
+        except BaseException:
+            modified.close()
+            raise
+        return modified
+
+    async def _transfer(self, activity: Dict[str, Any], profile: Optional[str]) -> ActivityResult:
+        """Download, convert and upload one activity, reporting the stage it ended in.
+
+        Only the network transfers are awaited on the loop; hashing, validation,
+        conversion and the sync state run in the executor.
+        """
+        activity_id = activity["id"]
+        stage = STAGE_DOWNLOAD
+        try:
+            # a retry of an activity that was already converted skips straight to the upload
+            modified = await self._in_executor(self._cached_conversion, activity, profile)
+            if modified is None:
+                async with self._downloads:
+                    original = await self.async_zwift_service.fetch_activity(activity)
+                try:
+                    data, content_hash = await self._in_executor(self._downloaded, activity, original)
+                    if data is None:
+                        original.close()
+                        self.logger.info(f"Activity {activity_id} has the content of an already synced activity")
+                        return ActivityResult(activity_id, STATUS_SKIPPED, STAGE_DOWNLOAD)
+                    stage = STAGE_VALIDATE
+                    await self._in_executor(self.validator.validate, activity_id, data)
+                except Exception:
+                    original.close()
+                    raise
+                stage = STAGE_CONVERT
+                modified = await self._in_executor(self._convert, activity, original, content_hash, profile)
+            stage = STAGE_UPLOAD
+            with modified:
+                async with self._uploads:
+                    response = await self.upload_scheduler.upload_async(
+                        activity_id, modified, f"zwift_activity_{activity_id}.fit")
+            status = STATUS_UPLOADED if response is not None else STATUS_DUPLICATE
+            await self._in_executor(self._mark, activity, STATE_UPLOADED if response is not None else STATE_DUPLICATE,
+                                    garmin_upload_id=self.garmin_service.extract_upload_id(response))
+        except Exception as e:
+            self.logger.exception(f"Transfer of activity {activity_id} failed at stage {stage}")
+            # uploads parked by the scheduler keep their retry_pending state
+            parked = isinstance(e, UploadError) and e.transient and self.sync_state is not None
+            if not parked:
+                try:
+                    await self._in_executor(self._mark, activity, STATE_FAILED, error=str(e))
+                except Exception:
+                    self.logger.exception(f"Failed to record the failure of activity {activity_id}")
+            return ActivityResult(activity_id, STATUS_FAILED, stage, str(e))
+
+        self.logger.info(f"Activity {activity_id}: {status}")
+        return ActivityResult(activity_id, status, STAGE_UPLOAD, response=response)
@@ -0,0 +1,287 @@
+"""Pipelined batch transfer of many activities from Zwift to Garmin."""
+
+import os
+import queue
+import threading
+import logging
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Dict, List, Optional
+
+from services.zwift_service import ZwiftService
+from services.fit_file_service import FitFileService, ENGINE_CSV
+from services.garmin_service import GarminService, UploadError
+from services.upload_scheduler import UploadScheduler
+from services.fit_records import ActivityValidator
+from services.fit_cache import ConvertedFitCache
+from services.buffers import read_buffer
+from services.metrics import ACTIVITIES_SYNCED
+from services.sync_state import (
+    SyncStateStore,
+    STATE_CONVERTED,
+    STATE_DOWNLOADED,
+    STATE_DUPLICATE,
+    STATE_FAILED,
+    STATE_UPLOADED,
+    fit_hash,
+)
+
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+CONVERT_WORKERS = int(os.getenv("CONVERT_WORKERS", "2"))
+# Maximum number of finished but not yet consumed buffers per stage
+QUEUE_SIZE = int(os.getenv("BATCH_QUEUE_SIZE", "8"))
+
+STATUS_UPLOADED = "uploaded"
+STATUS_DUPLICATE = "duplicate"
+STATUS_FAILED = "failed"
+STATUS_SKIPPED = "skipped"
+
+STAGE_DOWNLOAD = "download"
+STAGE_VALIDATE = "validate"
+STAGE_CONVERT = "convert"
+STAGE_UPLOAD = "upload"
+
+_DONE = object()
+
+
+@dataclass
+class ActivityResult:
+    """Outcome of transferring a single activity."""
+
+    activity_id: Any
+    status: str
+    stage: str
+    error: Optional[str] = None
+    response: Optional[Dict[str, Any]] = None
+
+    @property
+    def success(self) -> bool:
+        return self.status != STATUS_FAILED
+
+
+class BatchSyncEngine:
+    """Runs download, conversion and upload of a batch as concurrent stages.
+
+    Downloads and conversions run in small worker pools, uploads are done by a
+    single worker paced by the upload scheduler. The stages are connected by bounded queues so
+    only a handful of activities are held in memory at any time.
+    """
+
+    def __init__(self,
+                 zwift_service: ZwiftService, garmin_service: GarminService, fit_file_service: FitFileService,
+                 download_workers: int = DOWNLOAD_WORKERS,
+                 convert_workers: int = CONVERT_WORKERS,
+                 sync_state: Optional[SyncStateStore] = None,
+                 upload_scheduler: Optional[UploadScheduler] = None,
+                 validator: Optional[ActivityValidator] = None,
+                 fit_cache: Optional[ConvertedFitCache] = None,
+                 profile: Optional[str] = None):
+        """Initialize BatchSyncEngine with authenticated services.
+
+        Args:
+            zwift_service: Service for Zwift operations
+            garmin_service: Service for Garmin operations
+            fit_file_service: Service for FIT file operations
+            download_workers: Number of parallel downloads
+            convert_workers: Number of parallel conversions
+            sync_state: Index of transferred activities, updated after every stage
+            upload_scheduler: Rate limiter and retry policy for uploads
+            validator: Sanity check run on every download before its conversion
+            fit_cache: Cache of converted files; retried activities skip download and conversion
+            profile: Device profile the activities are converted to, defaults to the configured one
+        """
+        self.zwift_service = zwift_service
+        self.garmin_service = garmin_service
+        self.fit_file_service = fit_file_service
+        self.download_workers = max(1, download_workers)
+        # the CSV tool runs through a static Java main and is not safe to run concurrently
+        self.convert_workers = 1 if fit_file_service.engine == ENGINE_CSV else max(1, convert_workers)
+        self.sync_state = sync_state
+        self.upload_scheduler = upload_scheduler or UploadScheduler(garmin_service, sync_state)
+        self.validator = validator or ActivityValidator()
+        self.fit_cache = fit_cache
+        self.profile = profile
+        self.logger = logging.getLogger(__name__)
+
+    def run(self, activities: List[Dict[str, Any]]) -> List[ActivityResult]:
+        """Transfer ``activities`` and report the outcome of each one.
+
+        Args:
+            activities: Zwift activity dicts as returned by the activity listing
+
+        Returns:
+            One result per activity, in the order of ``activities``
+        """
+        results: Dict[Any, ActivityResult] = {}
+        results_lock = threading.Lock()
+
+        def record(result: ActivityResult) -> None:
+            with results_lock:
+                results[result.activity_id] = result
+            ACTIVITIES_SYNCED.inc(status=result.status)
+
+        download_queue: queue.Queue = queue.Queue()
+        convert_queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+        upload_queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+        for activity in activities:
+            download_queue.put(activity)
+
+        download_threads = self._start(self.download_workers, self._download_worker,
+                                       download_queue, convert_queue, record)
+        convert_threads = self._start(self.convert_workers, self._convert_worker,
+                                      convert_queue, upload_queue, record)
+        upload_threads = self._start(1, self._upload_worker, upload_queue, None, record)
+
+        # shut the pipeline down stage by stage once the previous one has drained
+        for _ in download_threads:
+            download_queue.put(_DONE)
+        self._join(download_threads, convert_queue, len(convert_threads))
+        self._join(convert_threads, upload_queue, len(upload_threads))
+        self._join(upload_threads, None, 0)
+
+        # a worker that failed even to record a result leaves a gap, report it instead of raising
+        return [results.get(activity["id"]) or ActivityResult(activity["id"], STATUS_FAILED, STAGE_DOWNLOAD,
+                                                              "No result was recorded")
+                for activity in activities]
+
+    @staticmethod
+    def _start(count, target, in_queue, out_queue, record) -> List[threading.Thread]:
+        threads = []
+        for i in range(count):
+            thread = threading.Thread(target=target, args=(in_queue, out_queue, record),
+                                      name=f"{target.__name__}-{i}", daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    @staticmethod
+    def _join(threads, next_queue, next_workers) -> None:
+        for thread in threads:
+            thread.join()
+        for _ in range(next_workers):
+            next_queue.put(_DONE)
+
+    def _mark(self, activity_id, state: str, **kwargs) -> None:
+        if self.sync_state is not None:
+            self.sync_state.mark(activity_id, state, **kwargs)
+
+    def _fail(self, record, activity, stage: str, error: Exception) -> None:
+        try:
+            self._mark(activity["id"], STATE_FAILED, error=str(error))
+        except Exception:
+            self.logger.exception(f"Failed to record the failure of activity {activity['id']}")
+        record(ActivityResult(activity["id"], STATUS_FAILED, stage, str(error)))
+
+    # Each worker handles an item in a catch-all: an error outside the transfer
+    # itself (sync state, cache, disk) fails that activity instead of killing the
+    # thread, which would stall the bounded queues and the whole batch.
+
+    def _download_worker(self, in_queue, out_queue, record) -> None:
+        while True:
+            activity = in_queue.get()
+            if activity is _DONE:
+                return
+            try:
+                self._download(activity, out_queue, record)
+            except Exception as e:
+                self.logger.exception(f"Download of activity {activity['id']} failed")
+                self._fail(record, activity, STAGE_DOWNLOAD, e)
+
+    def _download(self, activity, out_queue, record) -> None:
+        cached = self._cached_conversion(activity)
+        if cached is not None:
+            # converted in an earlier attempt, the convert stage passes it through
+            out_queue.put((activity, cached, None, True))
+            return
+        buffer = self.zwift_service.fetch_activity(activity)
+        try:
+            content_hash = fit_hash(read_buffer(buffer))
+            buffer.seek(0)
+            if self.sync_state is not None:
+                if self.sync_state.find_synced_hash(content_hash):
+                    buffer.close()
+                    self.logger.info(f"Activity {activity['id']} has the content of an already synced activity")
+                    self._mark(activity["id"], STATE_DUPLICATE, content_hash=content_hash)
+                    record(ActivityResult(activity["id"], STATUS_SKIPPED, STAGE_DOWNLOAD))
+                    return
+                self._mark(activity["id"], STATE_DOWNLOADED, content_hash=content_hash)
+        except BaseException:
+            buffer.close()
+            raise
+        out_queue.put((activity, buffer, content_hash, False))
+
+    def _cached_conversion(self, activity) -> Optional[BinaryIO]:
+        if self.fit_cache is None or self.sync_state is None:
+            return None
+        state = self.sync_state.get(activity["id"])
+        if state is None:
+            return None
+        return self.fit_cache.get(activity["id"], state["fit_hash"], self.fit_file_service.profile_key(self.profile))
+
+    def _convert_worker(self, in_queue, out_queue, record) -> None:
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                return
+            activity, buffer = item[:2]
+            try:
+                self._convert(item, out_queue, record)
+            except Exception as e:
+                buffer.close()
+                self.logger.exception(f"Conversion of activity {activity['id']} failed")
+                self._fail(record, activity, STAGE_CONVERT, e)
+
+    def _convert(self, item, out_queue, record) -> None:
+        activity, buffer, content_hash, converted = item
+        if converted:
+            out_queue.put((activity, buffer))
+            return
+        try:
+            self.validator.validate(activity["id"], read_buffer(buffer))
+        except Exception as e:
+            buffer.close()
+            self.logger.error(str(e))
+            self._fail(record, activity, STAGE_VALIDATE, e)
+            return
+        with buffer:
+            modified: BinaryIO = self.fit_file_service.modify_device_info_stream(buffer, self.profile)
+        try:
+            if self.fit_cache is not None:
+                self.fit_cache.put(activity["id"], content_hash, self.fit_file_service.profile_key(self.profile),
+                                   modified)
+            self._mark(activity["id"], STATE_CONVERTED)
+        except BaseException:
+            modified.close()
+            raise
+        out_queue.put((activity, modified))
+
+    def _upload_worker(self, in_queue, out_queue, record) -> None:
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                return
+            activity, buffer = item
+            try:
+                self._upload(activity, buffer, record)
+            except Exception as e:
+                self.logger.exception(f"Upload of activity {activity['id']} failed")
+                self._fail(record, activity, STAGE_UPLOAD, e)
+
+    def _upload(self, activity, buffer, record) -> None:
+        try:
+            with buffer:
+                response = self.upload_scheduler.upload(
+                    activity["id"], buffer, f"zwift_activity_{activity['id']}.fit")
+        except UploadError as e:
+            self.logger.error(f"Upload of activity {activity['id']} failed: {e}")
+            if e.transient and self.sync_state is not None:
+                # parked by the scheduler, keep its retry_pending state
+                record(ActivityResult(activity["id"], STATUS_FAILED, STAGE_UPLOAD, str(e)))
+            else:
+                self._fail(record, activity, STAGE_UPLOAD, e)
+            return
+        # upload_activity_stream swallows 409 conflicts and returns nothing
+        status = STATUS_UPLOADED if response is not None else STATUS_DUPLICATE
+        self._mark(activity["id"], STATE_UPLOADED if response is not None else STATE_DUPLICATE,
+                   garmin_upload_id=GarminService.extract_upload_id(response))
+        self.logger.info(f"Activity {activity['id']}: {status}")
+        record(ActivityResult(activity["id"], status, STAGE_UPLOAD, response=response))
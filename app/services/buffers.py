@@ -0,0 +1,32 @@
+"""In-memory buffers for passing FIT files between pipeline stages."""
+
+import os
+import tempfile
+from typing import BinaryIO
+
+# Buffers larger than this are spooled to disk, everything else stays in memory
+SPOOL_MAX_SIZE = int(os.getenv("SPOOL_MAX_SIZE", str(16 * 1024 * 1024)))
+SPOOL_DIR = os.getenv("SPOOL_DIR") or None
+
+
+def new_buffer(max_size: int = SPOOL_MAX_SIZE) -> BinaryIO:
+    """Create an empty buffer that spools to disk above ``max_size`` bytes.
+
+    The spooled file (if any) is anonymous and removed as soon as the buffer
+    is closed, so a crashing stage never leaves files behind.
+    """
+    return tempfile.SpooledTemporaryFile(max_size=max_size, mode="w+b", dir=SPOOL_DIR)
+
+
+def buffer_from_bytes(data: bytes, max_size: int = SPOOL_MAX_SIZE) -> BinaryIO:
+    """Wrap ``data`` in a buffer positioned at the start."""
+    buffer = new_buffer(max_size)
+    buffer.write(data)
+    buffer.seek(0)
+    return buffer
+
+
+def read_buffer(buffer: BinaryIO) -> bytes:
+    """Return the full content of ``buffer`` regardless of its position."""
+    buffer.seek(0)
+    return buffer.read()
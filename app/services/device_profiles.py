@@ -0,0 +1,71 @@
+"""Named target devices that converted activities are attributed to."""
+
+import os
+import json
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from services.sync_state import DATA_DIR
+
+GARMIN_MANUFACTURER = 1
+EDGE_530_PRODUCT = 3570
+EDGE_840_PRODUCT = 4062
+FR965_PRODUCT = 4315
+
+# JSON file with additional profiles: {"name": {"manufacturer": 1, "product": 4062, ...}}
+DEVICE_PROFILES_FILE = os.getenv("DEVICE_PROFILES_FILE", os.path.join(DATA_DIR, "device_profiles.json"))
+DEFAULT_PROFILE = os.getenv("DEVICE_PROFILE", "edge_530")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class DeviceProfile:
+    """Device identity written into the file_id and creator device_info messages.
+
+    Fields left as None are kept as recorded by Zwift.
+    """
+
+    name: str
+    manufacturer: int = GARMIN_MANUFACTURER
+    product: int = EDGE_530_PRODUCT
+    software_version: Optional[float] = None
+    serial_number: Optional[int] = None
+
+    @property
+    def key(self) -> str:
+        """Identifies the bytes this profile produces, independent of its name."""
+        return f"{self.manufacturer}:{self.product}:{self.software_version}:{self.serial_number}"
+
+
+BUILTIN_PROFILES = {
+    "edge_530": DeviceProfile("edge_530", GARMIN_MANUFACTURER, EDGE_530_PRODUCT),
+    "edge_840": DeviceProfile("edge_840", GARMIN_MANUFACTURER, EDGE_840_PRODUCT),
+    "fr965": DeviceProfile("fr965", GARMIN_MANUFACTURER, FR965_PRODUCT),
+}
+
+
+def load_profiles(path: str = DEVICE_PROFILES_FILE) -> Dict[str, DeviceProfile]:
+    """Return the built-in profiles extended (or overridden) by those in ``path``.
+
+    Raises:
+        ValueError: If the profile file is malformed
+    """
+    profiles = dict(BUILTIN_PROFILES)
+    if not os.path.exists(path):
+        return profiles
+    try:
+        with open(path) as f_in:
+            entries = json.load(f_in)
+        for name, entry in entries.items():
+            profiles[name] = DeviceProfile(
+                name,
+                int(entry.get("manufacturer", GARMIN_MANUFACTURER)),
+                int(entry["product"]),
+                None if entry.get("software_version") is None else float(entry["software_version"]),
+                None if entry.get("serial_number") is None else int(entry["serial_number"]))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"Invalid device profile file {path}: {e}") from e
+    logger.info(f"Loaded {len(entries)} device profiles from {path}")
+    return profiles
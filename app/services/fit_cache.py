@@ -0,0 +1,159 @@
+"""On-disk cache of converted FIT files."""
+
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, BinaryIO, Optional, Tuple
+
+from services.buffers import buffer_from_bytes, read_buffer
+from services.sync_state import DATA_DIR
+
+FIT_CACHE_DIR = os.getenv("FIT_CACHE_DIR", os.path.join(DATA_DIR, "fit_cache"))
+# Total size of the cached files in bytes, 0 disables the cache
+FIT_CACHE_MAX_SIZE = int(os.getenv("FIT_CACHE_MAX_SIZE", str(256 * 1024 * 1024)))
+# Entries not used for this many seconds are evicted
+FIT_CACHE_MAX_AGE = float(os.getenv("FIT_CACHE_MAX_AGE", str(30 * 24 * 3600)))
+
+CACHE_SUFFIX = ".fit"
+
+
+def cache_key(activity_id: Any, content_hash: str, profile: str) -> str:
+    """Key of a converted file: the same source converted for the same device."""
+    return hashlib.sha256(f"{activity_id}\0{content_hash}\0{profile}".encode()).hexdigest()
+
+
+class ConvertedFitCache:
+    """Content addressed store of modified FIT files with LRU eviction.
+
+    Entries are keyed by Zwift activity id, hash of the original FIT file and
+    the conversion profile, so a retried upload can skip download and
+    conversion. Files are written atomically; the access time used for LRU
+    eviction is kept in the file mtime, so the order survives restarts.
+    """
+
+    def __init__(self, cache_dir: str = FIT_CACHE_DIR,
+                 max_size: int = FIT_CACHE_MAX_SIZE,
+                 max_age: float = FIT_CACHE_MAX_AGE):
+        """Initialize ConvertedFitCache and index the existing entries.
+
+        Args:
+            cache_dir: Directory holding the cached files
+            max_size: Upper bound for the total size in bytes, 0 disables the cache
+            max_age: Seconds after the last use at which an entry is evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_age = max_age
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        # key -> (size, last use), least recently used first
+        self._entries: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self._size = 0
+        if self.enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + CACHE_SUFFIX)
+
+    def _load(self) -> None:
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not name.endswith(CACHE_SUFFIX):
+                # leftovers of interrupted writes
+                if name.endswith(".tmp"):
+                    self._remove(path)
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name[:-len(CACHE_SUFFIX)], stat.st_size))
+        for last_use, key, size in sorted(entries):
+            self._entries[key] = (size, last_use)
+            self._size += size
+        with self._lock:
+            self._evict()
+
+    def get(self, activity_id: Any, content_hash: Optional[str], profile: str) -> Optional[BinaryIO]:
+        """Return a buffer with the cached conversion, or None on a miss."""
+        if not self.enabled or content_hash is None:
+            return None
+        key = cache_key(activity_id, content_hash, profile)
+        with self._lock:
+            if key not in self._entries:
+                return None
+            size, _ = self._entries.pop(key)
+            now = time.time()
+            self._entries[key] = (size, now)
+        try:
+            with open(self._path(key), "rb") as f_in:
+                data = f_in.read()
+            os.utime(self._path(key), (now, now))
+        except OSError:
+            self.logger.warning(f"Cached conversion of activity {activity_id} vanished")
+            with self._lock:
+                self._forget(key)
+            return None
+        self.logger.info(f"Using cached conversion of activity {activity_id}")
+        return buffer_from_bytes(data)
+
+    def put(self, activity_id: Any, content_hash: Optional[str], profile: str, fit_file: BinaryIO) -> None:
+        """Store the converted FIT file held in ``fit_file``; failures are only logged."""
+        if not self.enabled or content_hash is None:
+            return
+        key = cache_key(activity_id, content_hash, profile)
+        data = read_buffer(fit_file)
+        fit_file.seek(0)
+        if len(data) > self.max_size:
+            return
+        try:
+            # written next to the target so the rename is atomic
+            fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+        except OSError as e:
+            self.logger.warning(f"Failed to cache conversion of activity {activity_id}: {e}")
+            return
+        try:
+            with os.fdopen(fd, "wb") as f_out:
+                f_out.write(data)
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            self.logger.warning(f"Failed to cache conversion of activity {activity_id}: {e}")
+            # not counted against the size limit, it would stay until the next restart
+            self._remove(temp_path)
+            return
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = (len(data), time.time())
+            self._size += len(data)
+            self._evict()
+
+    def _forget(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[0]
+
+    def _evict(self) -> None:
+        """Drop expired entries, then the least recently used until the size fits."""
+        expired = time.time() - self.max_age
+        while self._entries:
+            key, (size, last_use) = next(iter(self._entries.items()))
+            if last_use >= expired and self._size <= self.max_size:
+                break
+            self._forget(key)
+            self._remove(self._path(key))
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError as e:
+            self.logger.warning(f"Failed to remove cached file {path}: {e}")
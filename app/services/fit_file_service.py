@@ -1,87 +1,233 @@
 """FIT file service for handling file modifications."""
 
 import os
+import io
+import re
+import csv
 import tempfile
 import logging
-from typing import Optional
+from dataclasses import replace
+from typing import BinaryIO, Dict, Optional, Tuple
+
+from services.buffers import buffer_from_bytes, read_buffer
+from services.device_profiles import DEFAULT_PROFILE, DeviceProfile, load_profiles
+from services.fit_patcher import FitPatcher
+from services.metrics import STAGE_CONVERT, STAGE_CSV_TO_FIT, STAGE_FIT_TO_CSV, STAGE_MODIFY_CSV, timed
 
-import jpype
-from jpype.types import *
-import os 
-import csv
 # 1. Start the JVM and point to the JAR
 
 jar_path = os.path.abspath("/venv/FitCSVTool.jar")
 
+# "native" patches the FIT bytes directly, "jvm" re-encodes with the FIT SDK
+# on a warm worker pool, "csv" uses the FitCSVTool round trip
+ENGINE_NATIVE = "native"
+ENGINE_JVM = "jvm"
+ENGINE_CSV = "csv"
+FIT_ENGINE = os.getenv("FIT_ENGINE", ENGINE_NATIVE)
+
+# Size of the blocks copied by modify_csv_file
+CSV_BLOCK_SIZE = 1024 * 1024
+# device_index values of the recording device as printed by FitCSVTool
+CSV_CREATOR_DEVICE_INDEXES = ("0", "255", "creator")
+
+
+def default_csv_field_map(profile: DeviceProfile) -> Dict[str, Dict[str, Tuple[str, str]]]:
+    """Field mapping that turns the file_id/device_info messages into the given device."""
+    device_fields = {"manufacturer": ("manufacturer", str(profile.manufacturer))}
+    for name in ("product", "garmin_product", "favero_product"):
+        device_fields[name] = ("garmin_product", str(profile.product))
+    if profile.serial_number is not None:
+        device_fields["serial_number"] = ("serial_number", str(profile.serial_number))
+    info_fields = dict(device_fields)
+    if profile.software_version is not None:
+        info_fields["software_version"] = ("software_version", f"{profile.software_version:g}")
+    return {"file_id": device_fields, "device_info": info_fields}
+
 
 class FitFileService:
     """Service for modifying FIT files."""
 
-    def __init__(self):
-        """Initialize FitFileService."""
-        self.logger = logging.getLogger(__name__)
-        
-        if not os.path.exists(jar_path):
-            raise FileNotFoundError(f"Could not find JAR at {jar_path}")
+    def __init__(self, engine: str = FIT_ENGINE,
+                 profiles: Optional[Dict[str, DeviceProfile]] = None,
+                 default_profile: str = DEFAULT_PROFILE):
+        """Initialize FitFileService.
 
-        # only start the JVM if it isn't already running; jpype throws an error otherwise
-        if not jpype.isJVMStarted():
-            jpype.startJVM(classpath=[jar_path])
+        Args:
+            engine: Conversion engine, "native", "jvm" or "csv"
+            profiles: Device profiles by name, defaults to the built-in and configured ones
+            default_profile: Profile used when a conversion does not name one
+        """
+        self.logger = logging.getLogger(__name__)
+        if engine not in (ENGINE_NATIVE, ENGINE_JVM, ENGINE_CSV):
+            raise ValueError(f"Unknown FIT engine: {engine}")
+        self.engine = engine
+        self.profiles = profiles or load_profiles()
+        if default_profile not in self.profiles:
+            raise ValueError(f"Unknown device profile: {default_profile}")
+        self.default_profile = default_profile
+        # compiled once, switching profiles per activity is a dictionary lookup
+        self.patchers = {name: FitPatcher.from_profile(profile) for name, profile in self.profiles.items()}
+        self.csv_field_maps = {name: default_csv_field_map(profile) for name, profile in self.profiles.items()}
+        self.patcher = self.patchers[default_profile]
+        self.csv_field_map = self.csv_field_maps[default_profile]
+        self.codec = None
+        self.fit_csv_tool = None
+        if engine == ENGINE_NATIVE:
+            # the JVM is only needed for the FIT SDK engines, jpype is not even imported
+            return
+        import jpype
+        from services.jvm_fit_codec import get_codec, start_jvm
+
+        if engine == ENGINE_JVM:
+            # starts the JVM and loads the codec classes up front
+            self.codec = get_codec(jar_path)
+            return
+
+        start_jvm(jar_path)
         self.fit_csv_tool = jpype.JClass("com.garmin.fit.csv.CSVTool")
 
+    def get_profile(self, name: Optional[str] = None) -> DeviceProfile:
+        """Return the named device profile, or the default one.
 
+        Raises:
+            ValueError: If there is no profile with that name
+        """
+        profile = self.profiles.get(name or self.default_profile)
+        if profile is None:
+            raise ValueError(f"Unknown device profile: {name}")
+        return profile
+
+    def profile_key(self, profile: Optional[str] = None) -> str:
+        """Identifies the output of this service for a profile, converted files are cached under it."""
+        return f"{self.engine}:{self.get_profile(profile).key}"
+
+    @timed(STAGE_FIT_TO_CSV)
     def fit_to_csv(self, fit_file_path):
-        # Arguments: -b (batch mode) converts .fit to .csv
-        args = [fit_file_path]
-        #FitCSVTool = jpype.JClass("com.garmin.fit.csv.CSVTool")
+        """Dump a FIT file to a CSV file next to it with FitCSVTool.
+
+        Raises:
+            RuntimeError: If the tool fails or writes no CSV file
+        """
+        csv_file_path = fit_file_path.replace(".fit", ".csv")
         try:
-            self.fit_csv_tool.main(args)
-            print(f"Conversion complete: {fit_file_path.replace('.fit', '.csv')}")
+            self.fit_csv_tool.main([fit_file_path])
         except Exception as e:
-            print(f"Error: {e}")
-
-
-    def modify_csv_file(self, csv_file_in, csv_file_out):
-        with open(csv_file_in, 'r') as f_in, open(csv_file_out, 'w', newline='') as f_out:    
-            reader = csv.reader(f_in)
-            writer = csv.writer(f_out)        
-            for row in reader:
-                if row[6] == "manufacturer":
-                    row[7] = "1"
-                    row[9] = "garmin_product"
-                    row[10] = "3570"
-                    #print(row)
-                if row[0] == "Data" and row[12] == "manufacturer":
-                    row[13] = "1"
-                    row[15] = "garmin_product"
-                    row[16] = "3570"
-                    #print(row)
-                writer.writerow(row)
+            raise RuntimeError(f"Failed to convert {fit_file_path} to CSV: {e}") from e
+        if not os.path.exists(csv_file_path):
+            raise RuntimeError(f"FitCSVTool wrote no CSV file for {fit_file_path}")
+        self.logger.debug(f"Conversion complete: {csv_file_path}")
+
 
+    @timed(STAGE_MODIFY_CSV)
+    def modify_csv_file(self, csv_file_in, csv_file_out,
+                        field_map: Optional[Dict[str, Dict[str, Tuple[str, str]]]] = None):
+        """Rewrites the device fields of a FitCSVTool CSV dump.
 
+        Lines are copied as raw bytes in large blocks; only Definition/Data
+        lines of the messages in ``field_map`` are parsed and rewritten.
+
+        Args:
+            csv_file_in: CSV produced by fit_to_csv
+            csv_file_out: Destination of the modified CSV
+            field_map: message name -> CSV field name -> (new field name, new value),
+                defaults to the service's csv_field_map
+        """
+        field_map = field_map or self.csv_field_map
+        messages = b"|".join(re.escape(name.encode()) for name in field_map)
+        candidate = re.compile(rb"^(?:Data|Definition),[0-9]+,(?:" + messages + rb"),[^\n]*", re.M)
+
+        with open(csv_file_in, 'rb') as f_in, open(csv_file_out, 'wb') as f_out:
+            remainder = b""
+            while True:
+                block = f_in.read(CSV_BLOCK_SIZE)
+                data = remainder + block
+                # only scan complete lines, the tail is carried over to the next block
+                end = len(data) if not block else data.rfind(b"\n") + 1
+                position = 0
+                for match in candidate.finditer(data, 0, end):
+                    f_out.write(data[position:match.start()])
+                    f_out.write(self._rewrite_csv_line(match.group(), field_map))
+                    position = match.end()
+                f_out.write(data[position:end])
+                remainder = data[end:]
+                if not block:
+                    break
+
+
+    @staticmethod
+    def _rewrite_csv_line(line: bytes, field_map: Dict[str, Dict[str, Tuple[str, str]]]) -> bytes:
+        """Apply ``field_map`` to one CSV line, returning it unchanged if nothing matches."""
+        text = line.decode("utf-8")
+        carriage_return = text.endswith("\r")
+        row = next(csv.reader([text.rstrip("\r")]), [])
+        mapping = field_map.get(row[2]) if len(row) > 2 else None
+        if not mapping:
+            return line
+        is_data = row[0] == "Data"
+        # fields come in (name, value, units) triples after Type, Local Number and Message
+        fields = range(3, len(row) - 1, 3)
+        if is_data and row[2] == "device_info":
+            device_index = next((row[i + 1] for i in fields if row[i] == "device_index"), None)
+            if device_index not in (None, *CSV_CREATOR_DEVICE_INDEXES):
+                return line
+        changed = False
+        for i in fields:
+            if row[i] in mapping:
+                row[i], value = mapping[row[i]]
+                if is_data:
+                    row[i + 1] = value
+                changed = True
+        if not changed:
+            return line
+        out = io.StringIO()
+        csv.writer(out, lineterminator="\r" if carriage_return else "").writerow(row)
+        return out.getvalue().encode("utf-8")
+
+
+    @timed(STAGE_CSV_TO_FIT)
     def csv_to_fit(self, csv_file, fit_file):
-        # The main method in Java expects an array of strings (String[])
-        args = ["-c", csv_file, fit_file]
-        
+        """Encode a CSV dump back into a FIT file with FitCSVTool.
+
+        Raises:
+            RuntimeError: If the tool fails or writes no FIT file
+        """
         try:
-            # Call the static main method
-            self.fit_csv_tool.main(args)
-            print(f"Successfully converted {csv_file} to {fit_file}")
+            # the static Java main expects a String[]
+            self.fit_csv_tool.main(["-c", csv_file, fit_file])
         except Exception as e:
-            print(f"Java Error: {e}")
+            raise RuntimeError(f"Failed to convert {csv_file} to FIT: {e}") from e
+        if not os.path.exists(fit_file):
+            raise RuntimeError(f"FitCSVTool wrote no FIT file for {csv_file}")
+        self.logger.debug(f"Successfully converted {csv_file} to {fit_file}")
+
+
+    @timed(STAGE_CONVERT)
+    def _patch_bytes(self, data: bytes, profile: Optional[str] = None) -> bytes:
+        """Patch FIT content with the native patcher or the FIT SDK codec."""
+        device = self.get_profile(profile)
+        try:
+            if self.engine == ENGINE_JVM:
+                return self.codec.patch(data, device)
+            return self.patchers[device.name].patch(data)
+        except Exception as e:
+            raise RuntimeError(f"Failed to modify FIT file: {e}") from e
 
 
     def modify_device_info(self, fit_file_path: str,
                           manufacturer: Optional[int] = None,
                           product: Optional[int] = None,
-                          software_version: Optional[float] = None) -> str:
+                          software_version: Optional[float] = None,
+                          profile: Optional[str] = None,
+                          output_path: Optional[str] = None) -> str:
         """Modifies the device manufacturer and type in a .fit file.
 
         Args:
             fit_file_path: Path to the original FIT file
-            manufacturer: Device manufacturer (defaults to Garmin)
-            product: Device product (defaults to Edge 530)
-            software_version: Software version (defaults to 9.75)
+            manufacturer: Device manufacturer, overrides the profile
+            product: Device product, overrides the profile
+            software_version: Software version, overrides the profile
+            profile: Name of the device profile (defaults to the configured one)
+            output_path: Where the modified file is written, defaults to modified_<name> next to the original
 
         Returns:
             Path to the modified FIT file
@@ -93,59 +239,68 @@ class FitFileService:
         if not os.path.exists(fit_file_path):
             raise FileNotFoundError(f"FIT file not found: {fit_file_path}")
 
+        profile = self._resolve_profile(profile, manufacturer, product, software_version)
+        modified_fit_file_path = output_path or os.path.join(
+            os.path.dirname(os.path.abspath(fit_file_path)), "modified_" + os.path.basename(fit_file_path))
+        if self.engine != ENGINE_CSV:
+            with open(fit_file_path, "rb") as f_in:
+                modified = self._patch_bytes(f_in.read(), profile)
+            with open(modified_fit_file_path, "wb") as f_out:
+                f_out.write(modified)
+            self.logger.info(f"Modified FIT file saved to {modified_fit_file_path}")
+            return modified_fit_file_path
+
         self.fit_to_csv(fit_file_path)
         csv_file_in = fit_file_path.replace(".fit",".csv")
         csv_file_out = f"{csv_file_in}_mod"
-        modified_fit_file_path = os.path.join("/tmp/", "modified_" + os.path.basename(fit_file_path))
-        self.modify_csv_file(csv_file_in, csv_file_out)
+        self.modify_csv_file(csv_file_in, csv_file_out, self.csv_field_maps[self.get_profile(profile).name])
         self.csv_to_fit(csv_file_out, modified_fit_file_path)
         return modified_fit_file_path
 
-        # # Set defaults
-        # manufacturer = manufacturer or Manufacturer.GARMIN.value
-        # product = product or GarminProduct.EDGE_530.value
-        # software_version = software_version or 9.75
-
-        # self.logger.info(f"Modifying FIT file: {fit_file_path}")
-
-        # try:
-        #     fit_file = FitFile.from_file(fit_file_path)
+    def _resolve_profile(self, profile: Optional[str], manufacturer: Optional[int],
+                         product: Optional[int], software_version: Optional[float]) -> str:
+        """Name of the profile to apply, registering a derived one for explicit overrides."""
+        base = self.get_profile(profile)
+        overrides = {key: value for key, value in (
+            ("manufacturer", manufacturer), ("product", product), ("software_version", software_version))
+            if value is not None}
+        if not overrides:
+            return base.name
+        derived = replace(base, **overrides)
+        derived = replace(derived, name=f"{base.name}@{derived.key}")
+        if derived.name not in self.profiles:
+            self.profiles[derived.name] = derived
+            self.patchers[derived.name] = FitPatcher.from_profile(derived)
+            self.csv_field_maps[derived.name] = default_csv_field_map(derived)
+        return derived.name
+
+    def modify_device_info_stream(self, fit_file: BinaryIO, profile: Optional[str] = None) -> BinaryIO:
+        """Modifies the device manufacturer and type of a FIT file held in a buffer.
 
-        #     # CHANGE 1: Set auto_define to True to fix the RuntimeError
-        #     builder = FitFileBuilder(auto_define=True)
-
-        #     for record in fit_file.records:
-        #         message = record.message
-                
-        #         # CHANGE 2: Update the FileIdMessage (Primary device identification)
-        #         if isinstance(message, FileIdMessage):
-        #             message.manufacturer = manufacturer
-        #             message.garmin_product = product
-                
-        #         # CHANGE 3: Update DeviceInfoMessage (Hardware entries)
-        #         elif isinstance(message, DeviceInfoMessage):
-        #             # Only update the main device info, usually the first one
-        #             if message.device_index in [None, 0, 255]: 
-        #                 message.manufacturer = manufacturer
-        #                 message.garmin_product = product
-        #                 message.software_version = software_version
-
-        #         # Add the message (the builder now handles definitions automatically)
-        #         builder.add(message)
-
-
-        #     # Save the modified FIT file
-        #     temp_dir = tempfile.gettempdir()
-        #     modified_fit_file_path = os.path.join(temp_dir, "modified_" + os.path.basename(fit_file_path))
-
-        #     modified_file = builder.build()
-        #     modified_file.to_file(modified_fit_file_path)
+        Args:
+            fit_file: Buffer with the original FIT content
+            profile: Name of the device profile (defaults to the configured one)
 
-        #     self.logger.info(f"Modified FIT file saved to {modified_fit_file_path}")
-        #     return modified_fit_file_path
+        Returns:
+            New buffer with the modified FIT content
 
-        # except Exception as e:
-        #     raise RuntimeError(f"Failed to modify FIT file: {e}") from e
+        Raises:
+            RuntimeError: If file modification fails
+        """
+        data = read_buffer(fit_file)
+        if self.engine != ENGINE_CSV:
+            return buffer_from_bytes(self._patch_bytes(data, profile))
+
+        # the CSV tool only works on files, so spill to a private temp directory;
+        # every intermediate and the result stay inside it and go away with it
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fit_file_path = os.path.join(temp_dir, "activity.fit")
+            with open(fit_file_path, "wb") as f_out:
+                f_out.write(data)
+            modified_fit_file_path = self.modify_device_info(
+                fit_file_path, profile=profile, output_path=os.path.join(temp_dir, "modified_activity.fit"))
+            with open(modified_fit_file_path, "rb") as f_in:
+                return buffer_from_bytes(f_in.read())
 
     def cleanup_file(self, file_path: str) -> None:
         """Clean up a temporary file.
@@ -0,0 +1,200 @@
+"""Native FIT patcher that rewrites device information in place."""
+
+import logging
+import struct
+from typing import Dict, List, Optional, Tuple
+
+from services.device_profiles import DeviceProfile, EDGE_530_PRODUCT, GARMIN_MANUFACTURER
+
+from services.fit_protocol import (
+    MESG_DEVICE_INFO,
+    MESG_FILE_ID,
+    RECORD_DATA,
+    FitHeader,
+    MessageDefinition,
+    fit_crc,
+    iter_fit_files,
+    iter_runs,
+    patched_crc,
+    read_file_crc,
+    write_file_crc,
+)
+
+# Field numbers from the FIT profile
+FILE_ID_MANUFACTURER = 1
+FILE_ID_PRODUCT = 2
+FILE_ID_SERIAL_NUMBER = 3
+DEVICE_INFO_DEVICE_INDEX = 0
+DEVICE_INFO_SERIAL_NUMBER = 3
+DEVICE_INFO_MANUFACTURER = 2
+DEVICE_INFO_PRODUCT = 4
+DEVICE_INFO_SOFTWARE_VERSION = 5
+# software_version is stored in hundredths
+SOFTWARE_VERSION_SCALE = 100
+
+# struct formats of the unsigned integer fields by size
+_FORMATS = {2: "H", 4: "I"}
+
+# device_index values that describe the recording device itself
+CREATOR_DEVICE_INDEXES = (0, 255)
+
+# fields that make the upload look like the target device; without them the file is not patched
+REQUIRED_FIELDS = {
+    (MESG_FILE_ID, FILE_ID_MANUFACTURER): "file_id.manufacturer",
+    (MESG_FILE_ID, FILE_ID_PRODUCT): "file_id.product",
+    (MESG_DEVICE_INFO, DEVICE_INFO_MANUFACTURER): "device_info.manufacturer",
+    (MESG_DEVICE_INFO, DEVICE_INFO_PRODUCT): "device_info.product",
+}
+
+# (offset, packed value) pairs applied to a data message
+FieldPatch = Tuple[int, bytes]
+
+
+class FitPatchError(RuntimeError):
+    """Raised when a FIT file lacks a device field the patcher can only overwrite, not add."""
+
+
+class FitPatcher:
+    """Rewrites manufacturer/product fields of a FIT file without re-encoding it.
+
+    Only the bytes of the ``file_id`` and creator ``device_info`` messages are
+    touched, everything else is copied verbatim. Runs of other messages are
+    skipped without looking at them, and the file CRC is updated for the
+    patched bytes rather than computed over the whole file again, so a file
+    with a broken CRC keeps it broken.
+    """
+
+    def __init__(self, manufacturer: int = GARMIN_MANUFACTURER, product: int = EDGE_530_PRODUCT,
+                 software_version: Optional[float] = None, serial_number: Optional[int] = None):
+        """Initialize FitPatcher with the target device.
+
+        Args:
+            manufacturer: Manufacturer id written to the file (defaults to Garmin)
+            product: Product id written to the file (defaults to Edge 530)
+            software_version: Firmware version of the creator device, kept if None
+            serial_number: Serial number of the creator device, kept if None
+        """
+        self.manufacturer = manufacturer
+        self.product = product
+        self.software_version = software_version
+        self.serial_number = serial_number
+        self.logger = logging.getLogger(__name__)
+        # keyed by (global message number, field number)
+        self._values: Dict[Tuple[int, int], int] = {
+            (MESG_FILE_ID, FILE_ID_MANUFACTURER): manufacturer,
+            (MESG_FILE_ID, FILE_ID_PRODUCT): product,
+            (MESG_DEVICE_INFO, DEVICE_INFO_MANUFACTURER): manufacturer,
+            (MESG_DEVICE_INFO, DEVICE_INFO_PRODUCT): product,
+        }
+        if software_version is not None:
+            self._values[(MESG_DEVICE_INFO, DEVICE_INFO_SOFTWARE_VERSION)] = round(
+                software_version * SOFTWARE_VERSION_SCALE)
+        if serial_number is not None:
+            self._values[(MESG_FILE_ID, FILE_ID_SERIAL_NUMBER)] = serial_number
+            self._values[(MESG_DEVICE_INFO, DEVICE_INFO_SERIAL_NUMBER)] = serial_number
+        # packed field values by (endianness, size), built once so patching only copies bytes
+        self._packed: Dict[Tuple[str, int], Dict[Tuple[int, int], bytes]] = {
+            (endian, size): {key: struct.pack(endian + fmt, value)
+                             for key, value in self._values.items() if value < 1 << (8 * size)}
+            for endian in "<>" for size, fmt in _FORMATS.items()
+        }
+
+    @classmethod
+    def from_profile(cls, profile: DeviceProfile) -> "FitPatcher":
+        return cls(profile.manufacturer, profile.product, profile.software_version, profile.serial_number)
+
+    def _plan(self, definition: MessageDefinition) -> Tuple[List[FieldPatch], List[str]]:
+        """Compute the byte patches for data messages of ``definition``.
+
+        Returns:
+            The patches and the required fields that cannot be patched in place
+        """
+        patches = []
+        missing = []
+        for global_num, field_num in self._values:
+            if global_num != definition.global_num:
+                continue
+            required = REQUIRED_FIELDS.get((global_num, field_num))
+            location = definition.field_offset(field_num)
+            if location is None:
+                if required:
+                    missing.append(required)
+                continue
+            offset, size = location
+            value = self._packed.get((definition.endian, size), {}).get((global_num, field_num))
+            if value is None:
+                if required:
+                    missing.append(f"{required} (size {size})")
+                else:
+                    self.logger.warning(
+                        f"Skipping field {field_num} of message {global_num}: unexpected size {size}")
+                continue
+            patches.append((offset, value))
+        return patches, missing
+
+    def patch(self, data) -> bytes:
+        """Patch a FIT file held in memory.
+
+        Args:
+            data: Raw FIT file content
+
+        Returns:
+            The patched FIT file content
+
+        Raises:
+            FitFormatError: If the data is not a valid FIT file
+            FitPatchError: If a file has no file_id message, or it or the creator's device_info
+                lacks the manufacturer or product field; the jvm and csv engines can add them
+        """
+        buf = bytearray(data)
+        patched = 0
+        for header in iter_fit_files(buf):
+            crc = read_file_crc(buf, header)
+            file_ids = 0
+            # keyed by id(); the definition is kept alive so ids are never reused
+            plans: Dict[int, Tuple[MessageDefinition, List[FieldPatch], List[str]]] = {}
+            for kind, offset, definition, count in iter_runs(buf, header):
+                if kind != RECORD_DATA or definition.global_num not in (MESG_FILE_ID, MESG_DEVICE_INFO):
+                    continue
+                cached = plans.get(id(definition))
+                if cached is None:
+                    cached = plans[id(definition)] = (definition, *self._plan(definition))
+                _, plan, missing = cached
+                for index in range(count):
+                    message = offset + index * (1 + definition.size)
+                    if not self._is_target(buf, message, definition):
+                        continue
+                    if missing:
+                        raise FitPatchError(f"Cannot patch the device, the file lacks {', '.join(missing)}")
+                    for field_offset, value in plan:
+                        crc = self._write(buf, header, message + field_offset, value, crc)
+                    patched += 1
+                    file_ids += definition.global_num == MESG_FILE_ID
+            if not file_ids:
+                raise FitPatchError("Cannot patch the device, the file has no file_id message")
+            if header.header_size == 14:
+                header_crc = fit_crc(buf[header.offset:header.offset + 12]).to_bytes(2, "little")
+                crc = self._write(buf, header, header.offset + 12, header_crc, crc)
+            write_file_crc(buf, header, crc)
+        self.logger.info(f"Patched {patched} device messages")
+        return bytes(buf)
+
+    @staticmethod
+    def _write(buf: bytearray, header: FitHeader, start: int, value: bytes, crc: int) -> int:
+        """Overwrite bytes of a FIT file and return its file CRC updated for them."""
+        end = start + len(value)
+        old = bytes(buf[start:end])
+        if old == value:
+            return crc
+        buf[start:end] = value
+        return patched_crc(crc, old, value, header.data_end - end)
+
+    @staticmethod
+    def _is_target(buf, offset: int, definition: MessageDefinition) -> bool:
+        """Only the creator entry of device_info is rewritten, sensors are left alone."""
+        if definition.global_num != MESG_DEVICE_INFO:
+            return True
+        location = definition.field_offset(DEVICE_INFO_DEVICE_INDEX)
+        if location is None:
+            return True
+        return buf[offset + location[0]] in CREATOR_DEVICE_INDEXES
@@ -0,0 +1,458 @@
+"""Low level helpers for the binary FIT protocol (headers, definitions, CRC)."""
+
+import struct
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+FIT_SIGNATURE = b".FIT"
+FILE_CRC_SIZE = 2
+
+# Global message numbers used by this application
+MESG_FILE_ID = 0
+MESG_DEVICE_INFO = 23
+MESG_RECORD = 20
+
+# Record header bits
+COMPRESSED_HEADER_MASK = 0x80
+DEFINITION_MASK = 0x40
+DEVELOPER_DATA_MASK = 0x20
+LOCAL_MESG_NUM_MASK = 0x0F
+
+RECORD_DEFINITION = "definition"
+RECORD_DATA = "data"
+
+# CRC-16 table as published in the FIT SDK (poly 0xA001, reflected, init 0)
+_CRC_TABLE = [
+    0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+    0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400,
+]
+
+# Inputs shorter than this are checksummed byte by byte, the vectorized CRC only pays off for whole files
+VECTOR_CRC_MIN_SIZE = 4096
+# Bytes per lane of the vectorized CRC; every lane is checksummed separately and the lanes are combined
+_LANE_SIZE = 64
+
+_crc_byte_table: Optional[List[int]] = None
+_crc_word_table: Optional[List[int]] = None
+_crc_word_array = None
+# images of the 16 single bit CRC states after 2**n zero bytes, by number of bytes
+_shift_bases: Dict[int, Tuple[int, ...]] = {}
+# the same as lookup tables for the low and high byte of a CRC, as numpy arrays
+_shift_arrays: Dict[int, tuple] = {}
+
+
+class FitFormatError(RuntimeError):
+    """Raised when a buffer is not a well formed FIT file."""
+
+
+class FitTruncatedError(FitFormatError):
+    """Raised when a buffer holds the start of a FIT file, but not all of it."""
+
+
+def _crc_update_byte(crc: int, byte: int) -> int:
+    tmp = _CRC_TABLE[crc & 0xF]
+    crc = (crc >> 4) & 0x0FFF
+    crc = crc ^ tmp ^ _CRC_TABLE[byte & 0xF]
+    tmp = _CRC_TABLE[crc & 0xF]
+    crc = (crc >> 4) & 0x0FFF
+    return crc ^ tmp ^ _CRC_TABLE[(byte >> 4) & 0xF]
+
+
+def _tables() -> Tuple[List[int], List[int]]:
+    """Build the byte and word lookup tables on first use."""
+    global _crc_byte_table, _crc_word_table
+    if _crc_word_table is None:
+        byte_table = [_crc_update_byte(0, b) for b in range(256)]
+        # A reflected 16 bit CRC fed two bytes at once only depends on crc ^ word
+        word_table = [0] * 0x10000
+        for value in range(0x10000):
+            crc = (value >> 8) ^ byte_table[value & 0xFF]
+            word_table[value] = (crc >> 8) ^ byte_table[crc & 0xFF]
+        _crc_byte_table = byte_table
+        _crc_word_table = word_table
+    return _crc_byte_table, _crc_word_table
+
+
+def _shift_basis(count: int) -> Tuple[int, ...]:
+    """Where each single bit CRC state ends up after ``count`` zero bytes; ``count`` is a power of two."""
+    basis = _shift_bases.get(count)
+    if basis is None:
+        if count == 1:
+            byte_table, _ = _tables()
+            basis = tuple((1 << bit >> 8) ^ byte_table[1 << bit & 0xFF] for bit in range(16))
+        else:
+            half = _shift_basis(count // 2)
+            basis = tuple(_apply(half, image) for image in half)
+        _shift_bases[count] = basis
+    return basis
+
+
+def _apply(basis: Tuple[int, ...], crc: int) -> int:
+    """Apply the linear map given by the images of the 16 single bit states."""
+    result = 0
+    for bit, image in enumerate(basis):
+        if crc >> bit & 1:
+            result ^= image
+    return result
+
+
+def crc_shift(crc: int, count: int) -> int:
+    """Return the CRC after ``count`` more zero bytes.
+
+    The FIT CRC starts at 0 and is linear, so this is how a change ``count``
+    bytes before the end of the checksummed data changes its CRC.
+    """
+    size = 1
+    while count:
+        if count & 1:
+            crc = _apply(_shift_basis(size), crc)
+        count >>= 1
+        size <<= 1
+    return crc
+
+
+def _crc_vectorized(view: memoryview, crc: int) -> int:
+    """FIT CRC of a large buffer with numpy.
+
+    The data is split into lanes of _LANE_SIZE bytes that are checksummed side
+    by side, then neighbouring lanes are combined pairwise: the CRC of A + B is
+    the CRC of A shifted over len(B) zero bytes, xor the CRC of B.
+    """
+    import numpy as np
+
+    global _crc_word_array
+    if _crc_word_array is None:
+        _crc_word_array = np.array(_tables()[1], dtype=np.uint16)
+    lanes = 1 << (-(-len(view) // _LANE_SIZE) - 1).bit_length()
+    padded = np.zeros(lanes * _LANE_SIZE, dtype=np.uint8)
+    # leading zeros leave a CRC starting at 0 unchanged, so the data is padded in front
+    start = len(padded) - len(view)
+    padded[start:] = np.frombuffer(view, dtype=np.uint8)
+    # continuing from ``crc`` is the same as starting at 0 with it xored into the first two bytes
+    padded[start] ^= crc & 0xFF
+    padded[start + 1] ^= crc >> 8
+    words = np.ascontiguousarray(padded.view("<u2").reshape(lanes, _LANE_SIZE // 2).T)
+    state = np.zeros(lanes, dtype=np.uint16)
+    for column in words:
+        state = _crc_word_array[state ^ column]
+    size = _LANE_SIZE
+    while len(state) > 1:
+        low, high = _shift_tables(size)
+        left = state[0::2]
+        state = low[left & 0xFF] ^ high[left >> 8] ^ state[1::2]
+        size *= 2
+    return int(state[0])
+
+
+def _shift_tables(count: int) -> tuple:
+    """crc_shift(crc, count) as lookup tables for the low and high byte of the CRC."""
+    tables = _shift_arrays.get(count)
+    if tables is None:
+        import numpy as np
+
+        basis = np.array(_shift_basis(count), dtype=np.uint16)
+        values = np.arange(256)[:, None]
+        bits = ((values >> np.arange(8)) & 1).astype(bool)
+        low = np.bitwise_xor.reduce(np.where(bits, basis[:8], 0), axis=1).astype(np.uint16)
+        high = np.bitwise_xor.reduce(np.where(bits, basis[8:], 0), axis=1).astype(np.uint16)
+        tables = _shift_arrays[count] = (low, high)
+    return tables
+
+
+def fit_crc(data, crc: int = 0) -> int:
+    """Compute the FIT CRC-16 of a bytes-like object.
+
+    Buffers of VECTOR_CRC_MIN_SIZE bytes and more are checksummed with numpy.
+
+    Args:
+        data: Bytes to checksum
+        crc: Initial CRC value, used to continue a running checksum
+
+    Returns:
+        The updated 16 bit CRC
+    """
+    view = memoryview(data).cast("B")
+    if len(view) >= VECTOR_CRC_MIN_SIZE:
+        return _crc_vectorized(view, crc)
+    byte_table, word_table = _tables()
+    even = len(view) & ~1
+    if even:
+        for (word,) in struct.iter_unpack("<H", view[:even]):
+            crc = word_table[crc ^ word]
+    if even != len(view):
+        crc = (crc >> 8) ^ byte_table[(crc ^ view[-1]) & 0xFF]
+    return crc
+
+
+def patched_crc(crc: int, old, new, following: int) -> int:
+    """Update a CRC for bytes of the checksummed data that were overwritten.
+
+    Args:
+        crc: CRC of the data before the change
+        old: The bytes that were replaced
+        new: The bytes that replaced them, as many as ``old``
+        following: Number of checksummed bytes after the replaced ones
+
+    Returns:
+        The CRC of the changed data
+    """
+    delta = bytes(a ^ b for a, b in zip(old, new))
+    return crc ^ crc_shift(fit_crc(delta), following)
+
+
+@dataclass
+class FitHeader:
+    """Parsed FIT file header."""
+
+    offset: int
+    header_size: int
+    protocol_version: int
+    profile_version: int
+    data_size: int
+    header_crc: Optional[int] = None
+
+    @property
+    def data_start(self) -> int:
+        return self.offset + self.header_size
+
+    @property
+    def data_end(self) -> int:
+        return self.data_start + self.data_size
+
+    @property
+    def end(self) -> int:
+        """Offset just past the trailing file CRC."""
+        return self.data_end + FILE_CRC_SIZE
+
+
+@dataclass
+class FieldDefinition:
+    """A single field entry of a definition message."""
+
+    num: int
+    size: int
+    base_type: int
+
+
+@dataclass
+class MessageDefinition:
+    """Layout of the data messages for one local message type."""
+
+    global_num: int
+    little_endian: bool
+    fields: List[FieldDefinition]
+    developer_data_size: int = 0
+    offsets: Dict[int, Tuple[int, int]] = field(default_factory=dict)
+    size: int = 0
+
+    def __post_init__(self):
+        offset = 0
+        for field_def in self.fields:
+            # the first occurrence wins if a field is (illegally) repeated
+            self.offsets.setdefault(field_def.num, (offset, field_def.size))
+            offset += field_def.size
+        self.size = offset + self.developer_data_size
+
+    @property
+    def endian(self) -> str:
+        return "<" if self.little_endian else ">"
+
+    def field_offset(self, field_num: int) -> Optional[Tuple[int, int]]:
+        """Return (offset, size) of a field inside the data message, if defined."""
+        return self.offsets.get(field_num)
+
+
+def parse_header(buf, offset: int = 0) -> FitHeader:
+    """Parse the FIT file header starting at ``offset``.
+
+    Raises:
+        FitTruncatedError: If the header or the file it announces is cut off
+        FitFormatError: If the header is invalid or the signature is missing
+    """
+    if len(buf) - offset < 12:
+        raise FitTruncatedError("Buffer too small for a FIT header")
+    header_size = buf[offset]
+    if header_size not in (12, 14):
+        raise FitFormatError(f"Invalid FIT header size: {header_size}")
+    if len(buf) - offset < header_size:
+        raise FitTruncatedError(f"Buffer too small for a FIT header of {header_size} bytes")
+    if bytes(buf[offset + 8:offset + 12]) != FIT_SIGNATURE:
+        raise FitFormatError("Missing .FIT signature")
+    profile_version, data_size = struct.unpack_from("<HI", buf, offset + 2)
+    header_crc = None
+    if header_size == 14:
+        (header_crc,) = struct.unpack_from("<H", buf, offset + 12)
+    header = FitHeader(offset, header_size, buf[offset + 1], profile_version, data_size, header_crc)
+    if header.end > len(buf):
+        raise FitTruncatedError(
+            f"FIT file truncated: expected {header.end - offset} bytes, got {len(buf) - offset}")
+    return header
+
+
+def iter_fit_files(buf) -> Iterator[FitHeader]:
+    """Yield the headers of every (possibly chained) FIT file in ``buf``."""
+    offset = 0
+    while offset < len(buf):
+        header = parse_header(buf, offset)
+        yield header
+        offset = header.end
+
+
+def validate_fit(buf) -> int:
+    """Check that ``buf`` holds complete FIT files with valid CRCs.
+
+    Returns:
+        Number of (chained) FIT files found
+
+    Raises:
+        FitFormatError: If a header is invalid, the data is truncated or a CRC does not match
+    """
+    count = 0
+    for header in iter_fit_files(buf):
+        if header.header_crc and fit_crc(memoryview(buf)[header.offset:header.offset + 12]) != header.header_crc:
+            raise FitFormatError("FIT header CRC mismatch")
+        # the CRC over data plus the stored CRC is zero for an intact file
+        if fit_crc(memoryview(buf)[header.offset:header.end]) != 0:
+            raise FitFormatError("FIT file CRC mismatch")
+        count += 1
+    if count == 0:
+        raise FitFormatError("Empty FIT file")
+    return count
+
+
+def parse_definition(buf, offset: int, developer_data: bool,
+                     end: Optional[int] = None) -> Tuple[MessageDefinition, int]:
+    """Parse a definition message body.
+
+    Args:
+        buf: Buffer holding the FIT data
+        offset: Offset of the definition content (just after the record header)
+        developer_data: Whether the record header flagged developer fields
+        end: Offset the definition has to end before, the end of ``buf`` if omitted
+
+    Returns:
+        The parsed definition and the offset just past it
+
+    Raises:
+        FitFormatError: If the definition is cut off
+    """
+    end = len(buf) if end is None else min(end, len(buf))
+    start = offset
+
+    def require(size: int) -> None:
+        if offset + size > end:
+            raise FitFormatError(f"Definition message at {start} is truncated")
+
+    require(5)
+    little_endian = buf[offset + 1] == 0
+    (global_num,) = struct.unpack_from("<H" if little_endian else ">H", buf, offset + 2)
+    num_fields = buf[offset + 4]
+    offset += 5
+    require(3 * num_fields + developer_data)
+    fields = [FieldDefinition(buf[i], buf[i + 1], buf[i + 2])
+              for i in range(offset, offset + 3 * num_fields, 3)]
+    offset += 3 * num_fields
+    developer_data_size = 0
+    if developer_data:
+        num_dev_fields = buf[offset]
+        offset += 1
+        require(3 * num_dev_fields)
+        developer_data_size = sum(buf[i + 1] for i in range(offset, offset + 3 * num_dev_fields, 3))
+        offset += 3 * num_dev_fields
+    return MessageDefinition(global_num, little_endian, fields, developer_data_size), offset
+
+
+def iter_runs(buf, header: FitHeader) -> Iterator[Tuple[str, int, MessageDefinition, int]]:
+    """Walk the records of a single FIT file, a run of data messages of one local type at a time.
+
+    Activities are mostly long runs of record messages, which are found with
+    a strided slice of their header bytes instead of one step per message.
+
+    Yields:
+        Tuples of (record kind, content offset, definition, count). For
+        definition records the content offset points at the definition body
+        and the count is 1. Data records come in runs of ``count`` messages,
+        ``1 + definition.size`` bytes apart, the first one's fields starting
+        at the content offset.
+
+    Raises:
+        FitFormatError: On unknown local message types or truncated records
+    """
+    definitions: Dict[int, MessageDefinition] = {}
+    offset = header.data_start
+    end = header.data_end
+    while offset < end:
+        record_header = buf[offset]
+        if record_header & COMPRESSED_HEADER_MASK:
+            local_num = (record_header >> 5) & 0x03
+        elif record_header & DEFINITION_MASK:
+            local_num = record_header & LOCAL_MESG_NUM_MASK
+            definition, next_offset = parse_definition(
+                buf, offset + 1, bool(record_header & DEVELOPER_DATA_MASK), end)
+            definitions[local_num] = definition
+            yield RECORD_DEFINITION, offset + 1, definition, 1
+            offset = next_offset
+            continue
+        else:
+            local_num = record_header & LOCAL_MESG_NUM_MASK
+        definition = definitions.get(local_num)
+        if definition is None:
+            raise FitFormatError(f"Data message for undefined local type {local_num} at {offset}")
+        stride = 1 + definition.size
+        count = _run_length(buf, offset, stride, end, record_header)
+        yield RECORD_DATA, offset + 1, definition, count
+        offset += count * stride
+    if offset != end:
+        raise FitFormatError("Last record overruns the FIT data section")
+
+
+# maps a compressed timestamp header to its local message type bits
+_COMPRESSED_TYPE_BITS = bytes(b & 0xE0 if b & COMPRESSED_HEADER_MASK else b for b in range(256))
+
+
+def _run_length(buf, offset: int, stride: int, end: int, record_header: int) -> int:
+    """Count the data messages from ``offset`` on, ``stride`` bytes apart, that share a record header.
+
+    Compressed timestamp headers match on their local message type, the time
+    offset differs from message to message.
+    """
+    compressed = bool(record_header & COMPRESSED_HEADER_MASK)
+    key = bytes([_COMPRESSED_TYPE_BITS[record_header]])
+    count = 0
+    window = 16
+    while True:
+        start = offset + count * stride
+        stop = min(end, start + window * stride)
+        headers = bytes(buf[start:stop:stride])
+        if compressed:
+            headers = headers.translate(_COMPRESSED_TYPE_BITS)
+        matched = len(headers) - len(headers.lstrip(key))
+        count += matched
+        if matched < len(headers) or stop >= end:
+            return count
+        window *= 2
+
+
+def iter_records(buf, header: FitHeader) -> Iterator[Tuple[str, int, MessageDefinition]]:
+    """Walk the records of a single FIT file one at a time.
+
+    Yields:
+        Tuples of (record kind, content offset, definition). For definition
+        records the content offset points at the definition body, for data
+        records it points at the first field of the data message.
+
+    Raises:
+        FitFormatError: On unknown local message types or truncated records
+    """
+    for kind, offset, definition, count in iter_runs(buf, header):
+        for index in range(count):
+            yield kind, offset + index * (1 + definition.size), definition
+
+
+def read_file_crc(buf, header: FitHeader) -> int:
+    (crc,) = struct.unpack_from("<H", buf, header.data_end)
+    return crc
+
+
+def write_file_crc(buf: bytearray, header: FitHeader, crc: int) -> None:
+    struct.pack_into("<H", buf, header.data_end, crc)
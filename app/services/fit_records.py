@@ -0,0 +1,301 @@
+"""Columnar decoding of FIT record messages and activity sanity checks."""
+
+from __future__ import annotations
+
+import os
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from services.fit_protocol import (
+    COMPRESSED_HEADER_MASK,
+    MESG_RECORD,
+    RECORD_DATA,
+    FitFormatError,
+    MessageDefinition,
+    iter_fit_files,
+    iter_runs,
+)
+from services.metrics import STAGE_VALIDATE, timed
+
+if TYPE_CHECKING:
+    # numpy is imported by the functions using it, the first validation pays for it instead of startup
+    import numpy as np
+
+# Seconds between the unix epoch and the FIT epoch (1989-12-31 00:00 UTC)
+FIT_EPOCH_OFFSET = 631065600
+# Activities recorded before 2010 or more than a day in the future are bogus
+MIN_TIMESTAMP = 1262304000
+MAX_CLOCK_SKEW = 24 * 3600
+# Rides shorter than this are reported as suspicious
+MIN_DURATION = 60
+
+# "off" skips validation, "warn" only logs problems, "strict" rejects bad files
+VALIDATION_OFF = "off"
+VALIDATION_WARN = "warn"
+VALIDATION_STRICT = "strict"
+FIT_VALIDATION = os.getenv("FIT_VALIDATION", VALIDATION_WARN)
+
+# record message fields: column -> (field number, scale, offset) as in the FIT profile, value = raw / scale - offset
+RECORD_FIELDS = {
+    "timestamp": (253, 1, -FIT_EPOCH_OFFSET),
+    "power": (7, 1, 0),
+    "heart_rate": (3, 1, 0),
+    "cadence": (4, 1, 0),
+    "speed": (6, 1000, 0),
+    "distance": (5, 100, 0),
+    "altitude": (2, 5, 500),
+}
+# enhanced fields carry the same values with a wider range and win if present
+ENHANCED_FIELDS = {
+    "speed": (73, 1000, 0),
+    "altitude": (78, 5, 500),
+}
+
+_UNSIGNED = {1: "u1", 2: "u2", 4: "u4"}
+# uint8z, uint16z and uint32z mark invalid values with 0 instead of all ones
+_ZERO_INVALID_BASE_TYPES = (0x0A, 0x8B, 0x8C)
+_COMPRESSED_TIME_MASK = 0x1F
+
+
+@dataclass
+class RecordColumns:
+    """Record messages of an activity as one float array per field.
+
+    Timestamps are unix seconds, speed is m/s, distance and altitude are
+    meters. Missing or invalid values are NaN.
+    """
+
+    timestamp: np.ndarray
+    power: np.ndarray
+    heart_rate: np.ndarray
+    cadence: np.ndarray
+    speed: np.ndarray
+    distance: np.ndarray
+    altitude: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.timestamp)
+
+
+def _field_values(raw: np.ndarray, offsets: np.ndarray, definition: MessageDefinition,
+                  field_num: int) -> Optional[np.ndarray]:
+    """Gather one field of many data messages sharing ``definition``."""
+    import numpy as np
+
+    location = definition.field_offset(field_num)
+    if location is None or location[1] not in _UNSIGNED:
+        return None
+    field_offset, size = location
+    base_type = next(f.base_type for f in definition.fields if f.num == field_num)
+    # one row of ``size`` bytes per message, reinterpreted as a single integer
+    rows = raw[offsets[:, None] + (field_offset + np.arange(size))]
+    values = rows.view(np.dtype(definition.endian + _UNSIGNED[size])).ravel()
+    invalid = 0 if base_type in _ZERO_INVALID_BASE_TYPES else (1 << (8 * size)) - 1
+    result = values.astype(np.float64)
+    result[values == invalid] = np.nan
+    return result
+
+
+def _compressed_timestamps(time_offsets: np.ndarray, last_timestamp: Optional[int]) -> np.ndarray:
+    """Resolve a run of compressed timestamp headers, in FIT seconds.
+
+    Every header carries the low 5 bits of its timestamp and counts from the
+    one before, the first from the last full timestamp of the file.
+    """
+    import numpy as np
+
+    if last_timestamp is None:
+        return np.full(len(time_offsets), np.nan)
+    steps = np.diff(time_offsets.astype(np.int64), prepend=last_timestamp & _COMPRESSED_TIME_MASK)
+    return (last_timestamp + np.cumsum(steps & _COMPRESSED_TIME_MASK)).astype(np.float64)
+
+
+def decode_records(data) -> RecordColumns:
+    """Decode every record message of a (possibly chained) FIT file.
+
+    The buffer is walked a run of messages at a time (see iter_runs), the
+    fields are then extracted for all messages of a definition at once.
+
+    Compressed timestamp headers are resolved against the last timestamp of
+    any message before them, as the FIT protocol defines.
+
+    Raises:
+        FitFormatError: If the buffer is not a well formed FIT file
+    """
+    import numpy as np
+
+    raw = np.frombuffer(data, dtype=np.uint8)
+    timestamp_field = RECORD_FIELDS["timestamp"][0]
+    # definition id -> (definition, row numbers, content offsets), one array per run
+    groups: Dict[int, Tuple[MessageDefinition, List[np.ndarray], List[np.ndarray]]] = {}
+    # rows of records with compressed timestamp headers and their timestamps in FIT seconds
+    compressed: List[Tuple[np.ndarray, np.ndarray]] = []
+    rows = 0
+    for header in iter_fit_files(data):
+        last_timestamp: Optional[int] = None
+        for kind, offset, definition, count in iter_runs(data, header):
+            if kind != RECORD_DATA:
+                continue
+            offsets = offset + (1 + definition.size) * np.arange(count)
+            timestamps = None
+            if data[offset - 1] & COMPRESSED_HEADER_MASK:
+                timestamps = _compressed_timestamps(raw[offsets - 1] & _COMPRESSED_TIME_MASK, last_timestamp)
+            elif definition.field_offset(timestamp_field) is not None:
+                timestamps = _field_values(raw, offsets, definition, timestamp_field)
+            if timestamps is not None:
+                valid = timestamps[~np.isnan(timestamps)]
+                if len(valid):
+                    last_timestamp = int(valid[-1])
+            if definition.global_num != MESG_RECORD:
+                continue
+            row_numbers = np.arange(rows, rows + count)
+            group = groups.get(id(definition))
+            if group is None:
+                # keeping the definition alive keeps its id unique
+                group = groups[id(definition)] = (definition, [], [])
+            group[1].append(row_numbers)
+            group[2].append(offsets)
+            if data[offset - 1] & COMPRESSED_HEADER_MASK:
+                compressed.append((row_numbers, timestamps))
+            rows += count
+
+    columns = {name: np.full(rows, np.nan) for name in RECORD_FIELDS}
+    for definition, row_numbers, offsets in groups.values():
+        row_numbers = np.concatenate(row_numbers)
+        offsets = np.concatenate(offsets)
+        for name, spec in RECORD_FIELDS.items():
+            for field_num, scale, offset in filter(None, (ENHANCED_FIELDS.get(name), spec)):
+                values = _field_values(raw, offsets, definition, field_num)
+                if values is not None:
+                    columns[name][row_numbers] = values / scale - offset
+                    break
+
+    for row_numbers, timestamps in compressed:
+        columns["timestamp"][row_numbers] = timestamps + FIT_EPOCH_OFFSET
+    return RecordColumns(**columns)
+
+
+def _nanstat(func, values: np.ndarray) -> Optional[float]:
+    import numpy as np
+
+    valid = values[~np.isnan(values)]
+    return float(func(valid)) if len(valid) else None
+
+
+@dataclass
+class ActivitySummary:
+    """Totals of an activity and the problems found in it."""
+
+    records: int = 0
+    start_time: Optional[float] = None
+    duration: float = 0.0
+    distance: Optional[float] = None
+    elevation_gain: Optional[float] = None
+    avg_power: Optional[float] = None
+    max_power: Optional[float] = None
+    avg_heart_rate: Optional[float] = None
+    max_heart_rate: Optional[float] = None
+    avg_cadence: Optional[float] = None
+    errors: List[str] = field(default_factory=list)
+    warnings: List[str] = field(default_factory=list)
+
+    @property
+    def valid(self) -> bool:
+        return not self.errors
+
+
+def summarize(columns: RecordColumns, now: Optional[float] = None) -> ActivitySummary:
+    """Compute the totals of an activity and flag implausible data."""
+    import numpy as np
+
+    summary = ActivitySummary(records=len(columns))
+    if not len(columns):
+        summary.errors.append("no record messages")
+        return summary
+
+    timestamps = columns.timestamp[~np.isnan(columns.timestamp)]
+    if not len(timestamps):
+        summary.errors.append("records without timestamps")
+    else:
+        summary.start_time = float(timestamps[0])
+        summary.duration = float(timestamps[-1] - timestamps[0])
+        latest = (time.time() if now is None else now) + MAX_CLOCK_SKEW
+        if timestamps.min() < MIN_TIMESTAMP or timestamps.max() > latest:
+            summary.errors.append("timestamps outside the plausible range")
+        if np.any(np.diff(timestamps) < 0):
+            summary.errors.append("timestamps going backwards")
+        elif summary.duration < MIN_DURATION:
+            summary.warnings.append(f"only {summary.duration:.0f}s long")
+
+    summary.distance = _nanstat(np.max, columns.distance)
+    if not summary.distance:
+        summary.warnings.append("no distance covered")
+    altitude = columns.altitude[~np.isnan(columns.altitude)]
+    if len(altitude) > 1:
+        steps = np.diff(altitude)
+        summary.elevation_gain = float(steps[steps > 0].sum())
+    summary.avg_power = _nanstat(np.mean, columns.power)
+    summary.max_power = _nanstat(np.max, columns.power)
+    if summary.max_power is None:
+        summary.warnings.append("no power data")
+    summary.avg_heart_rate = _nanstat(np.mean, columns.heart_rate)
+    summary.max_heart_rate = _nanstat(np.max, columns.heart_rate)
+    if summary.max_heart_rate is None:
+        summary.warnings.append("no heart rate data")
+    summary.avg_cadence = _nanstat(np.mean, columns.cadence)
+    return summary
+
+
+class ActivityValidationError(RuntimeError):
+    """Raised in strict mode for activities that should not be uploaded."""
+
+
+class ActivityValidator:
+    """Summarizes downloaded activities and rejects broken ones."""
+
+    def __init__(self, mode: str = FIT_VALIDATION):
+        """Initialize ActivityValidator.
+
+        Args:
+            mode: "off", "warn" or "strict"
+        """
+        if mode not in (VALIDATION_OFF, VALIDATION_WARN, VALIDATION_STRICT):
+            raise ValueError(f"Unknown validation mode: {mode}")
+        self.mode = mode
+        self.logger = logging.getLogger(__name__)
+
+    @timed(STAGE_VALIDATE)
+    def validate(self, activity_id, data: bytes) -> Optional[ActivitySummary]:
+        """Check a downloaded FIT file.
+
+        Args:
+            activity_id: Zwift activity id, used for logging
+            data: Content of the FIT file
+
+        Returns:
+            The activity summary, or None if validation is disabled
+
+        Raises:
+            ActivityValidationError: In strict mode, if the file is broken
+        """
+        if self.mode == VALIDATION_OFF:
+            return None
+        try:
+            summary = summarize(decode_records(data))
+        except FitFormatError as e:
+            summary = ActivitySummary(errors=[f"undecodable FIT file: {e}"])
+
+        for warning in summary.warnings:
+            self.logger.warning(f"Activity {activity_id}: {warning}")
+        if summary.errors:
+            message = f"Activity {activity_id} failed validation: {', '.join(summary.errors)}"
+            if self.mode == VALIDATION_STRICT:
+                raise ActivityValidationError(message)
+            self.logger.warning(message)
+        else:
+            self.logger.info(
+                f"Activity {activity_id}: {summary.records} records, {summary.duration:.0f}s, "
+                f"{(summary.distance or 0) / 1000:.1f}km, avg power {summary.avg_power or 0:.0f}W")
+        return summary
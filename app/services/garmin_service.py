@@ -1,32 +1,121 @@
 """Garmin service for handling authentication and activity uploads."""
 
+import os
+import re
+import time
+import asyncio
 import logging
-from typing import Dict, Any
-from garminconnect import (
-    Garmin,
-    GarminConnectAuthenticationError,
-    GarminConnectTooManyRequestsError,
-    GarminConnectConnectionError
-)
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, BinaryIO, Optional
+import httpx
+
+from services.metrics import STAGE_GARMIN_AUTH, STAGE_UPLOAD, UPLOAD_DUPLICATES, stage_timer, timed
 
 TOKEN_FILE="/app/data/.garth"
+# Refresh the OAuth2 token when it expires within this many seconds
+TOKEN_REFRESH_MARGIN = int(os.getenv("GARMIN_TOKEN_REFRESH_MARGIN", "300"))
+# Upload endpoint of the async service, only changed to point at a stand-in server
+UPLOAD_URL = os.getenv("GARMIN_UPLOAD_URL", "https://connectapi.{domain}{path}")
+
+# HTTP statuses that are worth retrying later, everything else is permanent
+TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+HTTP_CONFLICT = 409
+HTTP_TOO_MANY_REQUESTS = 429
+
+
+class UploadError(RuntimeError):
+    """Raised when Garmin Connect rejects or fails an upload.
+
+    Attributes:
+        status_code: HTTP status of the failed request, if known
+        retry_after: Seconds the server asked us to wait, if it said so
+        transient: Whether retrying the same upload later may succeed
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None,
+                 retry_after: Optional[float] = None, transient: bool = False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.transient = transient
+
+
+def _error_response(error: Exception) -> Optional[Any]:
+    """Find the HTTP response behind a garth, requests or garminconnect error."""
+    for candidate in (getattr(error, "error", None), error):
+        response = getattr(candidate, "response", None)
+        if response is not None:
+            return response
+    return None
+
+
+def _retry_after(response: Any) -> Optional[float]:
+    value = getattr(response, "headers", {}).get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def error_status_code(error: Exception) -> Optional[int]:
+    """Return the HTTP status of a failed Garmin request, if it can be determined."""
+    from garminconnect import GarminConnectTooManyRequestsError
+
+    if isinstance(error, GarminConnectTooManyRequestsError):
+        return HTTP_TOO_MANY_REQUESTS
+    response = _error_response(error)
+    if response is not None and getattr(response, "status_code", None) is not None:
+        return response.status_code
+    # newer garminconnect releases only keep the status in the message
+    match = re.search(r"\b(?:API Error|Error) (\d{3})\b", str(error))
+    return int(match.group(1)) if match else None
+
+
+def classify_upload_error(error: Exception) -> UploadError:
+    """Turn any upload exception into an UploadError with its retry semantics."""
+    if isinstance(error, UploadError):
+        return error
+    from garminconnect import GarminConnectConnectionError
+
+    status_code = error_status_code(error)
+    if status_code is None:
+        # no HTTP status means the request never completed (network problems)
+        transient = isinstance(error, (GarminConnectConnectionError, httpx.TransportError,
+                                       OSError, ConnectionError, TimeoutError))
+    else:
+        transient = status_code in TRANSIENT_STATUS_CODES
+    return UploadError(f"Upload failed: {error}", status_code, _retry_after(_error_response(error)), transient)
 
 
 class GarminService:
     """Service for interacting with Garmin Connect."""
 
-    def __init__(self, username: str, password: str):
+    def __init__(self, username: str, password: str, token_file: str = TOKEN_FILE):
         """Initialize GarminService with credentials.
 
         Args:
             username: Garmin Connect username
             password: Garmin Connect password
+            token_file: Location of the stored session tokens of this account
         """
         self.username = username
         self.password = password
+        self.token_file = token_file
+        # garminconnect and garth take longer to import than the rest of the app,
+        # they are loaded with the first account instead of at startup
+        from garminconnect import Garmin
+
         self.client: Garmin = Garmin()
         self.logger = logging.getLogger(__name__)
         self._authenticated = False
+        # the startup warm-up may log in while the first sync does
+        self._auth_lock = threading.Lock()
 
     def authenticate(self) -> None:
         """Authenticate with Garmin Connect.
@@ -37,25 +126,58 @@ class GarminService:
             GarminConnectConnectionError: Network connection issues
             RuntimeError: Other authentication failures
         """
-        self.logger.info("Logging in to Garmin Connect...")
+        from garminconnect import (
+            GarminConnectAuthenticationError,
+            GarminConnectTooManyRequestsError,
+            GarminConnectConnectionError
+        )
 
-        try:
-            self.client.login(TOKEN_FILE)
-            self._authenticated = True
-            self.logger.info("Successfully authenticated with Garmin Connect")
-        except GarminConnectAuthenticationError:
-            self.logger.exception("Authentication error. Check your credentials.")
-            raise
-        except GarminConnectTooManyRequestsError:
-            self.logger.exception("Too many requests. Try again later.")
-            raise
-        except GarminConnectConnectionError:
-            self.logger.exception("Connection error. Check your internet connection.")
-            raise
-        except Exception as e:
-            self.logger.exception(f"Failed to login to Garmin Connect: {e}")
-            raise RuntimeError(f"Authentication failed: {e}") from e
+        with self._auth_lock:
+            if self._authenticated and not self._token_expiring():
+                self.logger.debug("Reusing Garmin Connect session")
+                return
+
+            try:
+                with stage_timer(STAGE_GARMIN_AUTH):
+                    if self._authenticated:
+                        self.logger.info("Refreshing Garmin Connect token...")
+                        self.client.garth.refresh_oauth2()
+                        # persist the refreshed token so a restart does not need to refresh again
+                        self.client.garth.dump(self.token_file)
+                    else:
+                        self.logger.info("Logging in to Garmin Connect...")
+                        self.client.login(self.token_file)
+                self._authenticated = True
+                self.logger.info("Successfully authenticated with Garmin Connect")
+            except GarminConnectAuthenticationError:
+                self.logger.exception("Authentication error. Check your credentials.")
+                raise
+            except GarminConnectTooManyRequestsError:
+                self.logger.exception("Too many requests. Try again later.")
+                raise
+            except GarminConnectConnectionError:
+                self.logger.exception("Connection error. Check your internet connection.")
+                raise
+            except Exception as e:
+                self.logger.exception(f"Failed to login to Garmin Connect: {e}")
+                raise RuntimeError(f"Authentication failed: {e}") from e
+
+    def _token_expiring(self) -> bool:
+        """Check if the OAuth2 token expires within the refresh margin."""
+        garth_client = getattr(self.client, "garth", None)
+        if garth_client is None:
+            # newer garminconnect releases refresh their tokens on every request
+            return False
+        token = getattr(garth_client, "oauth2_token", None)
+        if token is None:
+            return True
+        return token.expires_at - time.time() < TOKEN_REFRESH_MARGIN
+
+    def _http_client(self):
+        """The garth client of older garminconnect releases, the native client of newer ones."""
+        return getattr(self.client, "garth", None) or self.client.client
 
+    @timed(STAGE_UPLOAD)
     def upload_activity(self, fit_file_path: str) -> Dict[str, Any]:
         """Upload a .fit file to Garmin Connect.
 
@@ -66,7 +188,8 @@ class GarminService:
             Upload response from Garmin Connect
 
         Raises:
-            RuntimeError: If not authenticated or upload fails
+            RuntimeError: If not authenticated
+            UploadError: If the upload fails for another reason than a duplicate
         """
         if not self._authenticated:
             raise RuntimeError("Must authenticate before uploading activities")
@@ -79,10 +202,58 @@ class GarminService:
             self.logger.debug(f"Upload response: {response}")
             return response
         except Exception as e:
-            self.logger.exception(f"Failed to upload activity: {e}")
+            self._handle_upload_error(e)
+
+    @timed(STAGE_UPLOAD)
+    def upload_activity_stream(self, fit_file: BinaryIO, file_name: str) -> Dict[str, Any]:
+        """Upload a FIT file held in a buffer to Garmin Connect.
+
+        Args:
+            fit_file: Buffer with the FIT content
+            file_name: File name reported to Garmin, must end with .fit
+
+        Returns:
+            Upload response from Garmin Connect
+
+        Raises:
+            RuntimeError: If not authenticated
+            UploadError: If the upload fails for another reason than a duplicate
+        """
+        if not self._authenticated:
+            raise RuntimeError("Must authenticate before uploading activities")
+
+        self.logger.info(f"Uploading {file_name} to Garmin Connect...")
+
+        fit_file.seek(0)
+        try:
+            # same request as Garmin.upload_activity, without the detour through a file path
+            response = self._http_client().post(
+                "connectapi", self.client.garmin_connect_upload,
+                files={"file": (file_name, fit_file)}, api=True)
+            self.logger.info("Upload successful")
+            self.logger.debug(f"Upload response: {response}")
+            return response
+        except Exception as e:
+            self._handle_upload_error(e)
+
+    def _handle_upload_error(self, error: Exception) -> None:
+        """Swallow duplicate uploads (409), raise everything else as UploadError."""
+        upload_error = classify_upload_error(error)
+        if upload_error.status_code == HTTP_CONFLICT:
+            self.logger.info("Activity already exists on Garmin Connect")
+            UPLOAD_DUPLICATES.inc()
+            return None
+        self.logger.error(f"Failed to upload activity: {error}")
+        raise upload_error from error
 
-            if e.error.response.status_code != 409:
-                raise RuntimeError(f"Upload failed: {e}") from e
+    @staticmethod
+    def extract_upload_id(response: Any) -> Optional[Any]:
+        """Return the Garmin upload id from an upload response, if it has one."""
+        try:
+            payload = response.json() if hasattr(response, "json") else response
+            return payload["detailedImportResult"]["uploadId"]
+        except Exception:
+            return None
 
     def is_authenticated(self) -> bool:
         """Check if the service is authenticated.
@@ -91,3 +262,62 @@ class GarminService:
             True if authenticated, False otherwise
         """
         return self._authenticated
+
+
+class AsyncGarminService:
+    """Coroutine variant of the Garmin upload.
+
+    Uploads go through an ``httpx.AsyncClient`` shared by all accounts, with
+    the OAuth2 token of the wrapped GarminService. Logging in and refreshing
+    the token stay with garminconnect/garth and run in a thread.
+    """
+
+    def __init__(self, garmin_service: GarminService, http: httpx.AsyncClient):
+        """Initialize AsyncGarminService.
+
+        Args:
+            garmin_service: Holds the credentials and the garminconnect session
+            http: Connection pool shared by all async services
+        """
+        self.garmin_service = garmin_service
+        self.http = http
+        self.logger = logging.getLogger(__name__)
+        self._auth_lock = asyncio.Lock()
+
+    async def authenticate(self) -> None:
+        """Authenticate with Garmin Connect, see GarminService.authenticate."""
+        if self.is_authenticated() and not self.garmin_service._token_expiring():
+            return
+        async with self._auth_lock:
+            await asyncio.to_thread(self.garmin_service.authenticate)
+
+    def is_authenticated(self) -> bool:
+        return self.garmin_service.is_authenticated()
+
+    async def upload_activity_stream(self, fit_file: BinaryIO, file_name: str) -> Any:
+        """Upload a FIT file held in a buffer, see GarminService.upload_activity_stream.
+
+        Returns:
+            Upload response, or None if Garmin already has the activity
+        """
+        if not self.is_authenticated():
+            raise RuntimeError("Must authenticate before uploading activities")
+        garth_client = getattr(self.garmin_service.client, "garth", None)
+        if garth_client is None:
+            # newer garminconnect releases bring their own HTTP client, use it from a thread
+            return await asyncio.to_thread(self.garmin_service.upload_activity_stream, fit_file, file_name)
+
+        from garth.http import USER_AGENT
+
+        self.logger.info(f"Uploading {file_name} to Garmin Connect...")
+        url = UPLOAD_URL.format(domain=garth_client.domain, path=self.garmin_service.client.garmin_connect_upload)
+        headers = {"Authorization": str(garth_client.oauth2_token), **USER_AGENT}
+        fit_file.seek(0)
+        with stage_timer(STAGE_UPLOAD):
+            try:
+                response = await self.http.post(url, files={"file": (file_name, fit_file)}, headers=headers)
+                response.raise_for_status()
+            except Exception as e:
+                return self.garmin_service._handle_upload_error(e)
+        self.logger.info("Upload successful")
+        return response
@@ -0,0 +1,377 @@
+"""In-process job queue for running syncs in the background."""
+
+import os
+import uuid
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from services.job_store import BatchCheckpoint, JobStore
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Jobs running at the same time on the event loop; waiting on the network costs no thread
+ASYNC_JOB_WORKERS = int(os.getenv("ASYNC_JOB_WORKERS", "32"))
+# Number of finished jobs kept for status queries
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", "100"))
+# Seconds running jobs get to finish at shutdown before they are cancelled and left to resume on restart
+JOB_SHUTDOWN_GRACE = float(os.getenv("JOB_SHUTDOWN_GRACE", "5"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+DEFAULT_ACCOUNT = "default"
+
+
+@dataclass
+class Job:
+    """A sync request and its outcome."""
+
+    kind: str
+    params: Dict[str, Any]
+    account: str = DEFAULT_ACCOUNT
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = JOB_QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Any = None
+    error: Optional[str] = None
+    done: threading.Event = field(default_factory=threading.Event, repr=False)
+    # activities of a batch job, kept so a resumed run transfers the same ones; None without a job store
+    checkpoint: Optional["BatchCheckpoint"] = field(default=None, init=False, repr=False)
+    _callbacks: List[Callable[[], None]] = field(default_factory=list, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    @property
+    def key(self) -> Tuple[str, str, Tuple]:
+        """Identical requests share a key and are coalesced while in flight."""
+        return self.account, self.kind, tuple(sorted(self.params.items()))
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until the job finished; returns False on timeout."""
+        return self.done.wait(timeout)
+
+    async def wait_async(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the job without blocking the event loop; returns False on timeout."""
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+
+        def resolve() -> None:
+            try:
+                loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(True))
+            except RuntimeError:
+                # the waiting loop is already closed
+                pass
+
+        with self._lock:
+            if self.done.is_set():
+                return True
+            self._callbacks.append(resolve)
+        try:
+            await asyncio.wait_for(finished, timeout)
+            return True
+        except asyncio.TimeoutError:
+            with self._lock:
+                if resolve in self._callbacks:
+                    self._callbacks.remove(resolve)
+            return False
+
+    def _set_done(self) -> None:
+        with self._lock:
+            self.done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "account": self.account,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """Runs jobs on a worker pool, one job per account at a time, accounts taking turns.
+
+    Submitting a job that is identical to a queued or running one returns the
+    existing job instead of starting a second transfer. With a job store,
+    jobs a previous process left queued or running are queued again at start.
+    """
+
+    def __init__(self, runner: Callable[[Job], Any], workers: int = JOB_WORKERS,
+                 store: Optional["JobStore"] = None):
+        """Initialize JobManager and start its workers.
+
+        Args:
+            runner: Executes a job and returns its (JSON serializable) result
+            workers: Number of jobs that may run at the same time
+            store: Keeps the jobs across restarts; without it they only live in memory
+        """
+        self.runner = runner
+        self.store = store
+        self.logger = logging.getLogger(__name__)
+        self._condition = threading.Condition()
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._in_flight: Dict[Tuple, Job] = {}
+        # accounts with queued jobs, in the order they get their next turn
+        self._pending: "OrderedDict[str, Deque[Job]]" = OrderedDict()
+        self._busy_accounts = set()
+        self._stopped = False
+        self._workers = []
+        self._resume()
+        self._start(max(1, workers))
+
+    def _resume(self) -> None:
+        """Queue the jobs a previous process left unfinished, in their original order."""
+        if self.store is None:
+            return
+        for job in self.store.unfinished():
+            job.status = JOB_QUEUED
+            job.started_at = None
+            self._enqueue(job)
+            self.logger.info(f"Resuming job {job.id} ({job.kind}) for account {job.account}")
+
+    def _start(self, workers: int) -> None:
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _wake(self) -> None:
+        """Tell idle workers about a new job or a finished account; called with the condition held."""
+        self._condition.notify_all()
+
+    def submit(self, kind: str, params: Optional[Dict[str, Any]] = None, account: str = DEFAULT_ACCOUNT) -> Job:
+        """Queue a job, or return the identical job that is already in flight."""
+        job = Job(kind, params or {}, account)
+        with self._condition:
+            existing = self._in_flight.get(job.key)
+            if existing is not None:
+                self.logger.info(f"Coalescing {kind} request into job {existing.id}")
+                return existing
+            self._enqueue(job)
+            self._prune()
+            self._wake()
+        self.logger.info(f"Queued job {job.id} ({kind}) for account {account}")
+        return job
+
+    def retry(self, job_id: str) -> Optional[Job]:
+        """Queue a finished job again under its id, or return it if it is still in flight.
+
+        A batch job transfers the activities it listed the first time; those
+        that reached Garmin Connect meanwhile are skipped.
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None and self.store is not None:
+                job = self.store.load(job_id)
+            if job is None or not job.done.is_set():
+                return job
+            existing = self._in_flight.get(job.key)
+            if existing is not None:
+                self.logger.info(f"Coalescing retry of job {job_id} into job {existing.id}")
+                return existing
+            job = Job(job.kind, job.params, job.account, id=job.id)
+            self._jobs.pop(job.id, None)
+            self._enqueue(job)
+            self._wake()
+        self.logger.info(f"Queued retry of job {job.id} ({job.kind}) for account {job.account}")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._condition:
+            job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            # finished before the last restart, or dropped from the history kept in memory
+            job = self.store.load(job_id)
+            if job is not None:
+                job.checkpoint = self.store.checkpoint(job.id)
+        return job
+
+    def _enqueue(self, job: Job) -> None:
+        """Add a job to the queue of its account; called with the condition held."""
+        if self.store is not None:
+            job.checkpoint = self.store.checkpoint(job.id)
+        self._jobs[job.id] = job
+        self._in_flight[job.key] = job
+        self._pending.setdefault(job.account, deque()).append(job)
+        self._save(job)
+
+    def _save(self, job: Job) -> None:
+        if self.store is None:
+            return
+        try:
+            self.store.save(job)
+            if job.finished_at is not None:
+                self.store.prune(JOB_HISTORY)
+        except Exception:
+            # the job still runs, it just would not survive a restart
+            self.logger.exception(f"Failed to persist job {job.id}")
+
+    def shutdown(self) -> None:
+        """Stop the workers after their current job."""
+        with self._condition:
+            self._stopped = True
+            self._wake()
+        for worker in self._workers:
+            worker.join()
+
+    async def aclose(self) -> None:
+        """Stop the workers after their current job without blocking the event loop."""
+        await asyncio.to_thread(self.shutdown)
+
+    def _prune(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.done.is_set()]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del self._jobs[job_id]
+
+    def _next_job(self) -> Optional[Job]:
+        """Take the oldest job of the next account in turn that has nothing running.
+
+        Accounts take turns round-robin, so a long backlog of one rider never
+        delays the syncs of the others by more than one job.
+        """
+        for account, pending in self._pending.items():
+            if account in self._busy_accounts:
+                continue
+            job = pending.popleft()
+            if pending:
+                self._pending.move_to_end(account)
+            else:
+                del self._pending[account]
+            return job
+        return None
+
+    def _claim(self) -> Optional[Job]:
+        """Take the next job and mark it running; called with the condition held, the caller saves it."""
+        job = self._next_job()
+        if job is not None:
+            self._busy_accounts.add(job.account)
+            job.status = JOB_RUNNING
+            job.started_at = time.time()
+        return job
+
+    def _finish(self, job: Job) -> None:
+        job.finished_at = time.time()
+        self._save(job)
+        self._release(job)
+
+    def _release(self, job: Job) -> None:
+        """Let the next job of a finished job's account run."""
+        with self._condition:
+            self._busy_accounts.discard(job.account)
+            self._in_flight.pop(job.key, None)
+            job._set_done()
+            # another worker may now run the next job of this account
+            self._wake()
+
+    def _failed(self, job: Job, error: Exception) -> None:
+        self.logger.exception(f"Job {job.id} failed")
+        job.error = str(error)
+        job.status = JOB_FAILED
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                job = self._claim()
+                while job is None and not self._stopped:
+                    self._condition.wait()
+                    job = self._claim()
+                if job is None:
+                    return
+
+            self._save(job)
+            try:
+                job.result = self.runner(job)
+                job.status = JOB_SUCCEEDED
+            except Exception as e:
+                self._failed(job, e)
+            self._finish(job)
+
+
+class AsyncJobManager(JobManager):
+    """JobManager whose jobs are coroutines running as tasks on the event loop.
+
+    Scheduling, coalescing and the one-job-per-account rule are the same; a
+    job waiting on the network is a suspended task rather than a blocked
+    thread, so far more of them can be in flight. Has to be created on the
+    loop it runs on; jobs may still be submitted from other threads.
+    """
+
+    def __init__(self, runner: Callable[[Job], Awaitable[Any]], workers: int = ASYNC_JOB_WORKERS,
+                 store: Optional["JobStore"] = None):
+        """Initialize AsyncJobManager and start its worker tasks.
+
+        Args:
+            runner: Coroutine function executing a job and returning its (JSON serializable) result
+            workers: Number of jobs that may run at the same time
+            store: Keeps the jobs across restarts; without it they only live in memory
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        super().__init__(runner, workers, store)
+
+    def _start(self, workers: int) -> None:
+        self._workers = [self._loop.create_task(self._work_async(), name=f"job-worker-{i}")
+                         for i in range(workers)]
+
+    def _wake(self) -> None:
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def shutdown(self) -> None:
+        raise RuntimeError("AsyncJobManager is stopped with aclose()")
+
+    async def aclose(self, grace: float = JOB_SHUTDOWN_GRACE) -> None:
+        """Stop the workers, cancelling the jobs that are still running after ``grace`` seconds.
+
+        A cancelled job stays running in the job store, so it is resumed on
+        the next start; a long backfill or a rate limit backoff does not hold
+        up the container stop.
+        """
+        with self._condition:
+            self._stopped = True
+            self._wake()
+        _, running = await asyncio.wait(self._workers, timeout=grace)
+        if running:
+            self.logger.warning(f"Cancelling {len(running)} running jobs, they resume on the next start")
+        for worker in running:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    async def _work_async(self) -> None:
+        while True:
+            self._wakeup.clear()
+            with self._condition:
+                job = self._claim()
+                stopped = self._stopped
+            if job is None:
+                if stopped:
+                    return
+                await self._wakeup.wait()
+                continue
+
+            # the job store is SQLite, it is written in a thread rather than on the loop
+            await asyncio.to_thread(self._save, job)
+            try:
+                job.result = await self.runner(job)
+                job.status = JOB_SUCCEEDED
+            except Exception as e:
+                self._failed(job, e)
+            job.finished_at = time.time()
+            await asyncio.to_thread(self._save, job)
+            self._release(job)
@@ -0,0 +1,133 @@
+"""Persistent record of the job queue, so jobs survive a restart of the container."""
+
+import os
+import json
+import logging
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+from services.job_queue import JOB_FAILED, JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, Job
+from services.sync_state import DATA_DIR
+
+JOBS_DB = os.path.join(DATA_DIR, "jobs.db")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    account TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    result TEXT,
+    error TEXT,
+    activities TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+"""
+
+_JOB_COLUMNS = ("id", "kind", "params", "account", "status", "created_at", "started_at", "finished_at",
+                "result", "error")
+
+
+class JobStore:
+    """SQLite backed copy of the jobs of a JobManager and the activities of their batches."""
+
+    def __init__(self, db_path: str = JOBS_DB):
+        """Initialize JobStore and create the database if needed.
+
+        Args:
+            db_path: Location of the SQLite database
+        """
+        self.db_path = db_path
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(_SCHEMA)
+
+    def save(self, job: Job) -> None:
+        """Insert or update a job, keeping the activities recorded for it."""
+        values = (job.id, job.kind, json.dumps(job.params), job.account, job.status, job.created_at,
+                  job.started_at, job.finished_at,
+                  None if job.result is None else json.dumps(job.result), job.error)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in _JOB_COLUMNS[1:])
+        with self._lock:
+            self._connection.execute(
+                f"INSERT INTO jobs ({', '.join(_JOB_COLUMNS)}) VALUES ({', '.join('?' for _ in _JOB_COLUMNS)}) "
+                f"ON CONFLICT (id) DO UPDATE SET {updates}",
+                values)
+
+    def load(self, job_id: str) -> Optional[Job]:
+        """Return a stored job, or None if it is unknown."""
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def unfinished(self) -> List[Job]:
+        """Return the jobs that were queued or running when the process stopped, oldest first."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY created_at",
+                (JOB_QUEUED, JOB_RUNNING)).fetchall()
+        return [self._job(row) for row in rows]
+
+    def save_activities(self, job_id: str, activities: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._connection.execute("UPDATE jobs SET activities = ? WHERE id = ?",
+                                     (json.dumps(activities), job_id))
+
+    def activities(self, job_id: str) -> Optional[List[Dict[str, Any]]]:
+        """Return the activities recorded for a job, or None if it did not get as far as listing them."""
+        with self._lock:
+            row = self._connection.execute("SELECT activities FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row["activities"]) if row and row["activities"] is not None else None
+
+    def prune(self, keep: int) -> None:
+        """Delete all but the ``keep`` most recently finished jobs."""
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND id NOT IN "
+                "(SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY finished_at DESC LIMIT ?)",
+                (JOB_SUCCEEDED, JOB_FAILED, JOB_SUCCEEDED, JOB_FAILED, keep))
+
+    def checkpoint(self, job_id: str) -> "BatchCheckpoint":
+        return BatchCheckpoint(self, job_id)
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> Job:
+        job = Job(row["kind"], json.loads(row["params"]), row["account"], id=row["id"], status=row["status"],
+                  created_at=row["created_at"], started_at=row["started_at"], finished_at=row["finished_at"],
+                  result=None if row["result"] is None else json.loads(row["result"]), error=row["error"])
+        if job.status in (JOB_SUCCEEDED, JOB_FAILED):
+            job.done.set()
+        return job
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class BatchCheckpoint:
+    """The activities a batch job set out to transfer.
+
+    Recorded once they are listed, so a resumed or retried job transfers the
+    same activities instead of listing them again. How far each of them got is
+    in the account's sync state, the converted files in the FIT cache.
+    """
+
+    def __init__(self, store: JobStore, job_id: str):
+        self.store = store
+        self.job_id = job_id
+
+    def load(self) -> Optional[List[Dict[str, Any]]]:
+        return self.store.activities(self.job_id)
+
+    def save(self, activities: List[Dict[str, Any]]) -> None:
+        self.store.save_activities(self.job_id, activities)
@@ -0,0 +1,151 @@
+"""FIT codec driving the Garmin FIT SDK decoder/encoder inside a warm JVM."""
+
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import jpype
+
+from services.device_profiles import DeviceProfile
+from services.fit_patcher import CREATOR_DEVICE_INDEXES, SOFTWARE_VERSION_SCALE
+
+# Number of conversions that may run in the JVM at the same time
+JVM_WORKERS = int(os.getenv("JVM_WORKERS", "2"))
+
+
+class FitCodecError(RuntimeError):
+    """Raised when the FIT SDK fails to decode or encode a file."""
+
+
+def start_jvm(jar_path: str) -> None:
+    """Start the JVM with the FIT SDK on the classpath, if it is not running yet."""
+    if not os.path.exists(jar_path):
+        raise FileNotFoundError(f"Could not find JAR at {jar_path}")
+
+    # only start the JVM if it isn't already running; jpype throws an error otherwise
+    if not jpype.isJVMStarted():
+        jpype.startJVM(classpath=[jar_path])
+
+
+@jpype.JImplements("com.garmin.fit.MesgListener", deferred=True)
+class _PatchingListener:
+    """Forwards decoded messages to an encoder, rewriting the device messages."""
+
+    def __init__(self, codec: "JvmFitCodec", encoder, profile: DeviceProfile):
+        self.codec = codec
+        self.encoder = encoder
+        self.profile = profile
+
+    @jpype.JOverride
+    def onMesg(self, mesg):
+        self.encoder.write(self.codec.patch_mesg(mesg, self.profile))
+
+
+class JvmFitCodec:
+    """Rewrites device information by decoding and re-encoding with the FIT SDK.
+
+    The FIT SDK classes are loaded once and conversions run on a bounded pool
+    of worker threads, each with its own decoder and encoder, so several files
+    can be converted in parallel. SDK errors are raised as FitCodecError.
+    """
+
+    def __init__(self, jar_path: str,
+                 profile: DeviceProfile = DeviceProfile("default"),
+                 workers: int = JVM_WORKERS):
+        """Initialize JvmFitCodec, starting the JVM and loading the SDK classes.
+
+        Args:
+            jar_path: Location of the FIT SDK jar
+            profile: Device written to the file unless patch() is given another one
+            workers: Number of parallel conversions
+        """
+        self.profile = profile
+        self.logger = logging.getLogger(__name__)
+        start_jvm(jar_path)
+
+        self._Decode = jpype.JClass("com.garmin.fit.Decode")
+        self._BufferEncoder = jpype.JClass("com.garmin.fit.BufferEncoder")
+        self._ProtocolVersion = jpype.JClass("com.garmin.fit.Fit$ProtocolVersion")
+        self._MesgNum = jpype.JClass("com.garmin.fit.MesgNum")
+        self._FileIdMesg = jpype.JClass("com.garmin.fit.FileIdMesg")
+        self._DeviceInfoMesg = jpype.JClass("com.garmin.fit.DeviceInfoMesg")
+        self._ByteArrayInputStream = jpype.JClass("java.io.ByteArrayInputStream")
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="fit-codec")
+        self._warm_up()
+
+    def _warm_up(self) -> None:
+        """Run a tiny encode/decode cycle so the codec classes are loaded and linked."""
+        file_id = self._FileIdMesg()
+        file_id.setManufacturer(jpype.JInt(self.profile.manufacturer))
+        encoder = self._BufferEncoder(self._ProtocolVersion.V2_0)
+        encoder.write(file_id)
+        self._convert(bytes(encoder.close()), self.profile)
+        self.logger.info("FIT SDK codec ready")
+
+    def patch_mesg(self, mesg, profile: DeviceProfile):
+        """Return ``mesg`` with the identity of ``profile``, if it describes the device."""
+        num = mesg.getNum()
+        if num == self._MesgNum.FILE_ID:
+            file_id = self._FileIdMesg(mesg)
+            file_id.setManufacturer(jpype.JInt(profile.manufacturer))
+            file_id.setProduct(jpype.JInt(profile.product))
+            if profile.serial_number is not None:
+                file_id.setSerialNumber(jpype.JLong(profile.serial_number))
+            return file_id
+        if num == self._MesgNum.DEVICE_INFO:
+            device_info = self._DeviceInfoMesg(mesg)
+            device_index = device_info.getDeviceIndex()
+            if device_index is None or int(device_index) in CREATOR_DEVICE_INDEXES:
+                device_info.setManufacturer(jpype.JInt(profile.manufacturer))
+                device_info.setProduct(jpype.JInt(profile.product))
+                if profile.software_version is not None:
+                    device_info.setSoftwareVersion(jpype.JFloat(
+                        round(profile.software_version * SOFTWARE_VERSION_SCALE) / SOFTWARE_VERSION_SCALE))
+                if profile.serial_number is not None:
+                    device_info.setSerialNumber(jpype.JLong(profile.serial_number))
+            return device_info
+        return mesg
+
+    def _convert(self, data: bytes, profile: DeviceProfile) -> bytes:
+        try:
+            decoder = self._Decode()
+            encoder = self._BufferEncoder(self._ProtocolVersion.V2_0)
+            stream = self._ByteArrayInputStream(jpype.JArray(jpype.JByte)(data))
+            if not decoder.read(stream, _PatchingListener(self, encoder, profile)):
+                raise FitCodecError("FIT SDK could not decode the file")
+            return bytes(encoder.close())
+        except jpype.JException as e:
+            raise FitCodecError(f"FIT SDK error: {e.getMessage()}") from e
+
+    def patch(self, data: bytes, profile: Optional[DeviceProfile] = None) -> bytes:
+        """Patch a FIT file on one of the codec worker threads.
+
+        Args:
+            data: Raw FIT file content
+            profile: Target device, defaults to the codec's profile
+
+        Returns:
+            The re-encoded FIT file content
+
+        Raises:
+            FitCodecError: If the FIT SDK fails to process the file
+        """
+        return self._executor.submit(self._convert, data, profile or self.profile).result()
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+_codec: Optional[JvmFitCodec] = None
+_codec_lock = threading.Lock()
+
+
+def get_codec(jar_path: str) -> JvmFitCodec:
+    """Return the process wide codec; the JVM can only be started once anyway."""
+    global _codec
+    with _codec_lock:
+        if _codec is None:
+            _codec = JvmFitCodec(jar_path)
+        return _codec
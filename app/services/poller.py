@@ -0,0 +1,182 @@
+"""Built-in polling of Zwift for new activities."""
+
+import os
+import random
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Deque, Dict, Iterable, Optional, Tuple
+
+from services.metrics import POLLS
+from services.job_queue import JOB_SUCCEEDED, Job
+from services.service_context import JOB_NEW, ServiceContext
+from services.zwift_service import ZwiftService
+
+POLL_ENABLED = os.getenv("POLL_ENABLED", "false").lower() in ("1", "true", "yes")
+# Polling interval right after a new activity and while rides usually end
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "120"))
+# Upper bound the interval backs off to while nothing happens
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "3600"))
+POLL_BACKOFF = float(os.getenv("POLL_BACKOFF", "2"))
+# Number of most recent activities used to learn when the rider usually finishes
+POLL_HISTORY = int(os.getenv("POLL_HISTORY", "30"))
+
+POLL_UNCHANGED = "unchanged"
+POLL_CHANGED = "changed"
+POLL_RETRY = "retry"
+POLL_ERROR = "error"
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class PollSchedule:
+    """Adaptive polling interval of one account.
+
+    The hours of the week in which the last ``history`` rides ended are
+    remembered, older ones are forgotten; around those hours, and right after a new activity showed up, the account is
+    polled at the minimum interval. Otherwise every quiet poll multiplies the
+    interval by the backoff factor up to the maximum.
+    """
+
+    def __init__(self, min_interval: float = POLL_MIN_INTERVAL,
+                 max_interval: float = POLL_MAX_INTERVAL,
+                 backoff: float = POLL_BACKOFF,
+                 history: int = POLL_HISTORY):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = max(1.0, backoff)
+        self.interval = min_interval
+        self.learned = False
+        # (weekday, hour) of the most recent rides; a bounded window, so the
+        # hours do not pile up until every hour of the week looks active
+        self._ride_ends: Deque[Tuple[int, int]] = deque(maxlen=max(1, history))
+
+    def learn(self, end_dates: Iterable[datetime]) -> None:
+        """Remember when activities ended (naive UTC datetimes), oldest first."""
+        for end_date in end_dates:
+            self._ride_ends.append((end_date.weekday(), end_date.hour))
+        self.learned = True
+
+    def likely_active(self, now: datetime) -> bool:
+        """Whether a recent ride ended within an hour of ``now``'s time of the week."""
+        return any((moment.weekday(), moment.hour) in self._ride_ends
+                   for moment in (now - timedelta(hours=1), now, now + timedelta(hours=1)))
+
+    def next_interval(self, changed: bool, now: Optional[datetime] = None) -> float:
+        """Seconds until the next poll, given whether this poll found a new activity."""
+        if changed or self.likely_active(now or _utcnow()):
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        return self.interval
+
+
+class ActivityPoller:
+    """Polls the newest activity of every account and queues a sync when it changes.
+
+    A poll costs a single one-item listing call on an already authenticated
+    session; the transfer pipeline only runs when the newest activity id
+    differs from the last one synced (initially the account's high-water
+    mark). An activity counts as synced once its job succeeded; after a failed
+    job the following polls queue it again, backing off like quiet polls.
+    """
+
+    def __init__(self, context: ServiceContext, submit: Callable[..., Any]):
+        """Initialize ActivityPoller.
+
+        Args:
+            context: Services of the configured accounts
+            submit: Queues a job, called as submit(kind, params, account)
+        """
+        self.context = context
+        self.submit = submit
+        self.logger = logging.getLogger(__name__)
+        self.schedules: Dict[str, PollSchedule] = {name: PollSchedule() for name in context.accounts}
+        self._last_seen: Dict[str, Optional[str]] = {}
+        # the job queued for an account by the last poll that found something, and the activity it was for
+        self._submitted: Dict[str, Tuple[Job, str]] = {}
+        self._attempted: Dict[str, str] = {}
+
+    def check(self, account: str) -> bool:
+        """Poll one account and queue a sync if it has a new activity.
+
+        Returns:
+            True if a new activity was found
+        """
+        try:
+            # polls do not count as use, an account without syncs is still released when idle
+            with self.context.pinned(account) as account_context:
+                zwift_service = account_context.zwift_service
+                zwift_service.authenticate()
+                schedule = self.schedules[account]
+                if not schedule.learned:
+                    history = zwift_service.get_last_x_activities(POLL_HISTORY)
+                    schedule.learn(ZwiftService.activity_end_date(activity) for activity in reversed(history))
+                    latest = history[0] if history else None
+                else:
+                    latest = zwift_service.get_latest_activity()
+                if account not in self._last_seen:
+                    self._last_seen[account] = account_context.sync_state.get_high_water_mark()
+        except Exception:
+            self.logger.exception(f"Polling Zwift for account {account} failed")
+            POLLS.inc(result=POLL_ERROR)
+            return False
+
+        latest_id = None if latest is None else str(latest["id"])
+        in_flight = self._settle(account)
+        if latest_id is None or latest_id in (self._last_seen[account], in_flight):
+            POLLS.inc(result=POLL_UNCHANGED)
+            return False
+
+        retry = latest_id == self._attempted.get(account)
+        if retry:
+            self.logger.info(f"Activity {latest_id} of account {account} is not synced yet, queueing another sync")
+            POLLS.inc(result=POLL_RETRY)
+        else:
+            self.logger.info(f"New activity {latest_id} for account {account}, queueing a sync")
+            POLLS.inc(result=POLL_CHANGED)
+            schedule.learn([ZwiftService.activity_end_date(latest)])
+        self._submitted[account] = (self.submit(JOB_NEW, {}, account), latest_id)
+        self._attempted[account] = latest_id
+        # a retry backs off like a quiet poll, an activity that keeps failing is not hammered
+        return not retry
+
+    def _settle(self, account: str) -> Optional[str]:
+        """Take note of the outcome of the sync queued by an earlier poll.
+
+        Returns:
+            The activity id the queued sync is still working on, if it has not finished
+        """
+        submitted = self._submitted.get(account)
+        if submitted is None:
+            return None
+        job, activity_id = submitted
+        if not job.done.is_set():
+            return activity_id
+        del self._submitted[account]
+        if job.status == JOB_SUCCEEDED and job.result and job.result.get("success"):
+            self._last_seen[account] = activity_id
+        else:
+            self.logger.warning(f"Sync of activity {activity_id} for account {account} did not succeed")
+        return None
+
+    async def run(self) -> None:
+        """Poll all accounts until cancelled."""
+        loop = asyncio.get_running_loop()
+        accounts = list(self.schedules)
+        # spread the first polls so accounts do not hit Zwift at the same moment
+        next_due = {account: loop.time() + random.uniform(0, POLL_MIN_INTERVAL) * (len(accounts) > 1)
+                    for account in accounts}
+        self.logger.info(f"Polling Zwift for {len(accounts)} accounts")
+        while True:
+            account = min(next_due, key=next_due.get)
+            delay = next_due[account] - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            changed = await asyncio.to_thread(self.check, account)
+            interval = self.schedules[account].next_interval(changed)
+            self.logger.debug(f"Next poll of account {account} in {interval:.0f}s")
+            next_due[account] = loop.time() + interval
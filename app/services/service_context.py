@@ -0,0 +1,478 @@
+"""Application scoped service instances shared by all requests."""
+
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import asdict, dataclass
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import httpx
+
+from services.zwift_service import DOWNLOAD_TIMEOUT, HTTP_POOL_SIZE, ZwiftService
+from services.fit_file_service import ENGINE_CSV, FitFileService
+from services.garmin_service import GarminService, TOKEN_FILE
+from services.activity_processor import ActivityProcessor
+from services.async_processor import AsyncActivityProcessor
+from services.batch_sync import CONVERT_WORKERS, ActivityResult
+from services.fit_cache import ConvertedFitCache
+from services.fit_records import VALIDATION_OFF, ActivityValidator
+from services.sync_state import DATA_DIR, SYNC_STATE_DB, SyncStateStore
+from services.job_queue import DEFAULT_ACCOUNT, Job
+from services.archive import archive_path, convert_archive, export_archive, import_archive, iter_export
+
+JOB_LATEST = "latest"
+JOB_LAST_X = "last_x"
+JOB_SINCE_DATE = "since_date"
+JOB_NEW = "new"
+# backfills through archives in ARCHIVE_DIR, see services.archive
+JOB_ARCHIVE_EXPORT = "archive_export"
+JOB_ARCHIVE_CONVERT = "archive_convert"
+JOB_ARCHIVE_IMPORT = "archive_import"
+ARCHIVE_JOBS = (JOB_ARCHIVE_EXPORT, JOB_ARCHIVE_CONVERT, JOB_ARCHIVE_IMPORT)
+
+# Reported for the activities of a batch job that it has not got to yet
+STATE_PENDING = "pending"
+
+# JSON file describing the riders: {"name": {"zwift_username": ..., "garmin_password": ..., "profile": ...}}
+ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE", os.path.join(DATA_DIR, "accounts.json"))
+# Token store and sync state of each configured account live in a subdirectory
+ACCOUNTS_DIR = os.path.join(DATA_DIR, "accounts")
+# Services of accounts without a sync for this many seconds are released
+ACCOUNT_IDLE_TIMEOUT = float(os.getenv("ACCOUNT_IDLE_TIMEOUT", "1800"))
+# Run syncs as coroutines on the event loop instead of one thread per sync
+ASYNC_IO = os.getenv("ASYNC_IO", "true").lower() in ("1", "true", "yes")
+# Connections of the pool shared by all async syncs
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "64"))
+
+_ACCOUNT_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+_CREDENTIALS = ("zwift_username", "zwift_password", "garmin_username", "garmin_password")
+
+
+@dataclass(frozen=True)
+class AccountConfig:
+    """Credentials and preferences of one rider."""
+
+    name: str
+    zwift_username: str
+    zwift_password: str
+    garmin_username: str
+    garmin_password: str
+    profile: Optional[str] = None
+
+    @property
+    def data_dir(self) -> str:
+        return DATA_DIR if self.name == DEFAULT_ACCOUNT else os.path.join(ACCOUNTS_DIR, self.name)
+
+    @property
+    def token_file(self) -> str:
+        return TOKEN_FILE if self.name == DEFAULT_ACCOUNT else os.path.join(self.data_dir, ".garth")
+
+    @property
+    def sync_state_db(self) -> str:
+        return SYNC_STATE_DB if self.name == DEFAULT_ACCOUNT else os.path.join(self.data_dir, "sync_state.db")
+
+
+def load_accounts(path: str = ACCOUNTS_FILE) -> Dict[str, AccountConfig]:
+    """Read the configured accounts, falling back to the single account in the environment.
+
+    Values in the file may reference environment variables as ``${NAME}``.
+
+    Raises:
+        ValueError: If the file is malformed or credentials are missing
+    """
+    if not os.path.exists(path):
+        credentials = [os.getenv(name.upper()) for name in _CREDENTIALS]
+        # Validate required environment variables
+        if not all(credentials):
+            raise ValueError("Missing required environment variables.")
+        return {DEFAULT_ACCOUNT: AccountConfig(DEFAULT_ACCOUNT, *credentials)}
+
+    try:
+        with open(path) as f_in:
+            entries = json.load(f_in)
+        accounts = {}
+        for name, entry in entries.items():
+            if not _ACCOUNT_NAME.match(name):
+                raise ValueError(f"invalid account name {name!r}")
+            values = {key: os.path.expandvars(str(value)) for key, value in entry.items()}
+            missing = [key for key in _CREDENTIALS if not values.get(key)]
+            if missing:
+                raise ValueError(f"account {name} lacks {', '.join(missing)}")
+            accounts[name] = AccountConfig(name, *(values[key] for key in _CREDENTIALS), values.get("profile"))
+    except (OSError, ValueError, AttributeError) as e:
+        raise ValueError(f"Invalid accounts file {path}: {e}") from e
+    if not accounts:
+        raise ValueError(f"No accounts configured in {path}")
+    return accounts
+
+
+class AccountContext:
+    """Sessions, token store and sync state of a single account."""
+
+    def __init__(self, config: AccountConfig, fit_file_service: FitFileService,
+                 fit_cache: Optional[ConvertedFitCache] = None,
+                 validator: Optional[ActivityValidator] = None,
+                 http: Optional[httpx.AsyncClient] = None,
+                 executor: Optional[ThreadPoolExecutor] = None):
+        """Initialize AccountContext.
+
+        Args:
+            config: The account
+            fit_file_service: Conversion service shared by all accounts
+            fit_cache: Cache of converted files shared by all accounts
+            validator: Sanity check shared by all accounts
+            http: Connection pool shared by all accounts; with it the processor can run async
+            executor: Conversion workers shared by all accounts, used by the async processor
+        """
+        self.config = config
+        os.makedirs(config.data_dir, exist_ok=True)
+        self.zwift_service = ZwiftService(config.zwift_username, config.zwift_password)
+        self.garmin_service = GarminService(config.garmin_username, config.garmin_password, config.token_file)
+        self.sync_state = SyncStateStore(config.sync_state_db)
+        if http is not None:
+            self.processor = AsyncActivityProcessor(self.zwift_service, self.garmin_service, fit_file_service,
+                                                    http, executor, self.sync_state, fit_cache, validator)
+        else:
+            self.processor = ActivityProcessor(self.zwift_service, self.garmin_service, fit_file_service,
+                                               self.sync_state, fit_cache, validator)
+        self.last_used = time.monotonic()
+        self.active = 0
+
+    def close(self) -> None:
+        """Release pooled connections and the database."""
+        self.zwift_service.close()
+        self.sync_state.close()
+
+
+class ServiceContext:
+    """Holds the services for the lifetime of the application.
+
+    Conversion (including the JVM), the converted-file cache and validation
+    are shared by all accounts. The sessions, tokens and sync state of an
+    account are created on its first sync, kept between syncs so only the
+    first one pays for the logins, and released after ACCOUNT_IDLE_TIMEOUT,
+    so memory follows the active accounts rather than the configured ones.
+    Syncs of one account are serialized by the job queue.
+
+    With ``async_io`` all accounts share one httpx connection pool and one
+    conversion executor, and jobs are run with run_job_async().
+    """
+
+    def __init__(self, accounts: Dict[str, AccountConfig], fit_file_service: FitFileService,
+                 fit_cache: Optional[ConvertedFitCache] = None,
+                 validator: Optional[ActivityValidator] = None,
+                 async_io: bool = ASYNC_IO):
+        """Initialize ServiceContext with the shared services.
+
+        Args:
+            accounts: Configured accounts by name
+            fit_file_service: Service for FIT file operations
+            fit_cache: Cache of converted files
+            validator: Sanity check of downloaded activities
+            async_io: Whether syncs run as coroutines on the event loop
+        """
+        self.accounts = accounts
+        self.fit_file_service = fit_file_service
+        self.fit_cache = fit_cache or ConvertedFitCache()
+        self.validator = validator or ActivityValidator()
+        self.async_io = async_io
+        self.http: Optional[httpx.AsyncClient] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if async_io:
+            self.http = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                    max_keepalive_connections=HTTP_POOL_SIZE),
+                timeout=DOWNLOAD_TIMEOUT, follow_redirects=True)
+            # the CSV tool runs through a static Java main and is not safe to run concurrently
+            workers = 1 if fit_file_service.engine == ENGINE_CSV else max(1, CONVERT_WORKERS)
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix="convert")
+        self.logger = logging.getLogger(__name__)
+        self._contexts: Dict[str, AccountContext] = {}
+        self._lock = threading.Lock()
+        for config in accounts.values():
+            if config.profile is not None:
+                # fail at startup rather than on the first sync of the account
+                fit_file_service.get_profile(config.profile)
+
+    @classmethod
+    def from_env(cls) -> "ServiceContext":
+        """Create the services from the accounts file or the credentials in the environment.
+
+        Raises:
+            ValueError: If the configuration is missing or invalid
+        """
+        return cls(load_accounts(), FitFileService())
+
+    def resolve_account(self, name: Optional[str] = None) -> str:
+        """Name of the account a request is for; it may only be omitted with a single or default account.
+
+        Raises:
+            ValueError: If the account is unknown or ambiguous
+        """
+        if name is None:
+            if len(self.accounts) == 1:
+                return next(iter(self.accounts))
+            if DEFAULT_ACCOUNT in self.accounts:
+                return DEFAULT_ACCOUNT
+            raise ValueError("account is required when several accounts are configured")
+        if name not in self.accounts:
+            raise ValueError(f"Unknown account: {name}")
+        return name
+
+    def account(self, name: str = DEFAULT_ACCOUNT) -> AccountContext:
+        """Return the services of an account, creating them on first use.
+
+        Raises:
+            ValueError: If the account is not configured
+        """
+        with self._lock:
+            context = self._contexts.get(name) or self._create(name)
+            context.last_used = time.monotonic()
+            return context
+
+    def _create(self, name: str) -> AccountContext:
+        """Set up the services of an account; called with the lock held."""
+        config = self.accounts.get(name)
+        if config is None:
+            raise ValueError(f"Unknown account: {name}")
+        self.logger.info(f"Setting up services for account {name}")
+        context = self._contexts[name] = AccountContext(
+            config, self.fit_file_service, self.fit_cache, self.validator, self.http, self.executor)
+        return context
+
+    @contextmanager
+    def pinned(self, name: str, create: bool = True) -> Iterator[Optional[AccountContext]]:
+        """Keep the services of an account from being released while they are used, without counting it as used.
+
+        Polls and status queries go through here, so only syncs keep an account
+        loaded. Yields None if the account is not loaded and ``create`` is False.
+
+        Raises:
+            ValueError: If the account is not configured
+        """
+        with self._lock:
+            context = self._contexts.get(name)
+            if context is None and create:
+                context = self._create(name)
+            if context is not None:
+                context.active += 1
+        try:
+            yield context
+        finally:
+            if context is not None:
+                with self._lock:
+                    context.active -= 1
+
+    def warm_up(self) -> None:
+        """Load what a sync needs ahead of the first request, and log in when a single account is configured.
+
+        The Garmin and Zwift clients and numpy are not imported at startup, so
+        the server is ready sooner; this pays for them before the first sync does.
+        """
+        import garminconnect  # noqa: F401
+        import zwift  # noqa: F401
+        if self.validator.mode != VALIDATION_OFF:
+            import numpy  # noqa: F401
+        if len(self.accounts) != 1:
+            return
+        context = self.account(next(iter(self.accounts)))
+        try:
+            context.zwift_service.authenticate()
+            context.garmin_service.authenticate()
+        except Exception:
+            # not fatal, the first sync will retry the login
+            self.logger.exception("Failed to authenticate at startup")
+
+    @contextmanager
+    def _running(self, name: str) -> Iterator[AccountContext]:
+        """Keep an account's services from being released while one of its jobs runs."""
+        context = self._acquire(name)
+        try:
+            yield context
+        finally:
+            self._release(context)
+
+    @asynccontextmanager
+    async def _running_async(self, name: str) -> AsyncIterator[AccountContext]:
+        """Coroutine variant of _running(), setting up and releasing the account in a thread.
+
+        That opens and closes the account's databases, which would otherwise block the event loop.
+        """
+        context = await asyncio.to_thread(self._acquire, name)
+        try:
+            yield context
+        finally:
+            await asyncio.to_thread(self._release, context)
+
+    def _acquire(self, name: str) -> AccountContext:
+        context = self.account(name)
+        with self._lock:
+            context.active += 1
+        return context
+
+    def _release(self, context: AccountContext) -> None:
+        with self._lock:
+            context.active -= 1
+            context.last_used = time.monotonic()
+        self.release_idle()
+
+    def run_job(self, job: Job) -> Any:
+        """Execute a sync job and return its JSON serializable result.
+
+        Raises:
+            ValueError: For unknown job kinds, accounts, device profiles or missing parameters
+        """
+        with self._running(job.account) as context:
+            processor = context.processor
+            profile = self._profile(context, job)
+            if job.kind in ARCHIVE_JOBS:
+                return self._run_archive_job(context, job, profile)
+            if job.kind == JOB_LATEST:
+                return {"success": processor.process_latest_activity(profile)}
+            if job.kind == JOB_LAST_X:
+                results = processor.process_last_x_activities(int(job.params["count"]), profile, job.checkpoint)
+            elif job.kind == JOB_SINCE_DATE:
+                results = processor.process_activities_since_date(job.params["start_date"], profile,
+                                                                  job.checkpoint)
+            elif job.kind == JOB_NEW:
+                results = processor.process_new_activities(profile)
+            else:
+                raise ValueError(f"Unknown job kind: {job.kind}")
+            return self._batch_result(results)
+
+    async def run_job_async(self, job: Job) -> Any:
+        """Coroutine variant of run_job(), requires ``async_io``."""
+        async with self._running_async(job.account) as context:
+            processor = context.processor
+            profile = self._profile(context, job)
+            if job.kind in ARCHIVE_JOBS:
+                # long running and mostly blocking, they keep the event loop free by running in a thread
+                return await asyncio.to_thread(self._run_archive_job, context, job, profile)
+            if job.kind == JOB_LATEST:
+                return {"success": await processor.process_latest_activity_async(profile)}
+            if job.kind == JOB_LAST_X:
+                results = await processor.process_last_x_activities_async(int(job.params["count"]), profile,
+                                                                          job.checkpoint)
+            elif job.kind == JOB_SINCE_DATE:
+                results = await processor.process_activities_since_date_async(job.params["start_date"], profile,
+                                                                              job.checkpoint)
+            elif job.kind == JOB_NEW:
+                results = await processor.process_new_activities_async(profile)
+            else:
+                raise ValueError(f"Unknown job kind: {job.kind}")
+            return self._batch_result(results)
+
+    def _run_archive_job(self, context: AccountContext, job: Job, profile: Optional[str]) -> Dict[str, Any]:
+        params = job.params
+        if job.kind == JOB_ARCHIVE_EXPORT:
+            return export_archive(context.zwift_service, archive_path(params["archive"]),
+                                  params["start_date"], params.get("end_date"))
+        if job.kind == JOB_ARCHIVE_CONVERT:
+            return convert_archive(self.fit_file_service, archive_path(params["archive"]),
+                                   archive_path(params["output"]), profile)
+        return import_archive(context.processor.upload_scheduler, context.sync_state,
+                              archive_path(params["archive"]), params.get("count"))
+
+    def export_stream(self, name: str, start_date: str, end_date: Optional[str] = None) -> Iterator[bytes]:
+        """Stream the raw activities of an account as a .tar.gz archive, see services.archive.iter_export."""
+        with self._running(name) as context:
+            yield from iter_export(context.zwift_service, start_date, end_date)
+
+    def _profile(self, context: AccountContext, job: Job) -> Optional[str]:
+        profile = job.params.get("profile") or context.config.profile
+        if profile is not None:
+            # fail the job up front instead of every single activity
+            self.fit_file_service.get_profile(profile)
+        return profile
+
+    @staticmethod
+    def _batch_result(results: List[ActivityResult]) -> Dict[str, Any]:
+        # a batch that could not start raises and fails the job, no results means nothing was to do
+        activities = [{k: v for k, v in asdict(result).items() if k != "response"} for result in results]
+        return {"success": all(result.success for result in results), "activities": activities}
+
+    def job_progress(self, job: Job) -> Optional[List[Dict[str, Any]]]:
+        """Transfer state of each activity of a batch job, also while it runs and after it failed.
+
+        None if the job has no recorded activities or its account is not loaded.
+        """
+        activities = job.checkpoint.load() if job.checkpoint is not None else None
+        if activities is None or job.account not in self.accounts:
+            return None
+        # a status query neither sets up an idle account nor keeps it loaded
+        with self.pinned(job.account, create=False) as context:
+            if context is None:
+                return None
+            progress = []
+            for activity in activities:
+                state = context.sync_state.get(activity["id"]) or {}
+                progress.append({"activity_id": activity["id"], "state": state.get("state", STATE_PENDING),
+                                 "error": state.get("error")})
+        return progress
+
+    def release_idle(self, idle_timeout: float = ACCOUNT_IDLE_TIMEOUT) -> None:
+        """Drop the services of accounts that have not synced for ``idle_timeout`` seconds."""
+        if len(self.accounts) == 1:
+            # a single account keeps its session like before
+            return
+        deadline = time.monotonic() - idle_timeout
+        with self._lock:
+            idle = [name for name, context in self._contexts.items()
+                    if not context.active and context.last_used < deadline]
+            released = [self._contexts.pop(name) for name in idle]
+        for context in released:
+            self.logger.info(f"Releasing services of idle account {context.config.name}")
+            context.close()
+
+    def close(self) -> None:
+        """Release pooled connections."""
+        with self._lock:
+            contexts = list(self._contexts.values())
+            self._contexts.clear()
+        for context in contexts:
+            context.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    async def aclose(self) -> None:
+        """Release pooled connections, including the shared async pool."""
+        if self.http is not None:
+            await self.http.aclose()
+        self.close()
+
+
+_context: Optional[ServiceContext] = None
+_context_lock = threading.Lock()
+
+
+def get_context() -> ServiceContext:
+    """Return the application wide ServiceContext, creating it on first use."""
+    global _context
+    with _context_lock:
+        if _context is None:
+            _context = ServiceContext.from_env()
+        return _context
+
+
+def close_context() -> None:
+    """Tear down the application wide ServiceContext, if one was created."""
+    global _context
+    with _context_lock:
+        if _context is not None:
+            _context.close()
+            _context = None
+
+
+async def aclose_context() -> None:
+    """Coroutine variant of close_context() that also closes the async connection pool."""
+    global _context
+    with _context_lock:
+        context, _context = _context, None
+    if context is not None:
+        await context.aclose()
@@ -0,0 +1,197 @@
+"""Persistent index of activities that were already transferred."""
+
+import os
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+DATA_DIR = os.getenv("DATA_DIR", "/app/data")
+SYNC_STATE_DB = os.path.join(DATA_DIR, "sync_state.db")
+
+STATE_DOWNLOADED = "downloaded"
+STATE_CONVERTED = "converted"
+STATE_UPLOADED = "uploaded"
+STATE_DUPLICATE = "duplicate"
+STATE_FAILED = "failed"
+STATE_RETRY_PENDING = "retry_pending"
+
+# States after which an activity never has to be transferred again
+FINAL_STATES = (STATE_UPLOADED, STATE_DUPLICATE)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS activities (
+    activity_id TEXT PRIMARY KEY,
+    fit_hash TEXT,
+    state TEXT NOT NULL,
+    garmin_upload_id TEXT,
+    error TEXT,
+    downloaded_at REAL,
+    converted_at REAL,
+    uploaded_at REAL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS activities_fit_hash ON activities (fit_hash);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS upload_retries (
+    activity_id TEXT PRIMARY KEY,
+    file_path TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT
+);
+"""
+
+HIGH_WATER_MARK = "high_water_mark"
+HIGH_WATER_MARK_START = "high_water_mark_start"
+
+_TIMESTAMP_COLUMNS = {
+    STATE_DOWNLOADED: "downloaded_at",
+    STATE_CONVERTED: "converted_at",
+    STATE_UPLOADED: "uploaded_at",
+    STATE_DUPLICATE: "uploaded_at",
+}
+
+
+def fit_hash(data: bytes) -> str:
+    """Content hash used to recognise the same FIT file under another id."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class SyncStateStore:
+    """SQLite backed record of the transfer state of each Zwift activity."""
+
+    def __init__(self, db_path: str = SYNC_STATE_DB):
+        """Initialize SyncStateStore and create the database if needed.
+
+        Args:
+            db_path: Location of the SQLite database
+        """
+        self.db_path = db_path
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(_SCHEMA)
+
+    def get(self, activity_id: Any) -> Optional[Dict[str, Any]]:
+        """Return the stored state of an activity, or None if it is unknown."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT * FROM activities WHERE activity_id = ?", (str(activity_id),)).fetchone()
+        return dict(row) if row else None
+
+    def is_synced(self, activity_id: Any) -> bool:
+        """Check if an activity has already reached Garmin Connect."""
+        state = self.get(activity_id)
+        return state is not None and state["state"] in FINAL_STATES
+
+    def find_synced_hash(self, content_hash: str) -> Optional[Dict[str, Any]]:
+        """Return an already transferred activity with the same FIT content, if any."""
+        placeholders = ",".join("?" for _ in FINAL_STATES)
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT * FROM activities WHERE fit_hash = ? AND state IN ({placeholders}) LIMIT 1",
+                (content_hash, *FINAL_STATES)).fetchone()
+        return dict(row) if row else None
+
+    def mark(self, activity_id: Any, state: str,
+             content_hash: Optional[str] = None,
+             garmin_upload_id: Optional[Any] = None,
+             error: Optional[str] = None) -> None:
+        """Record that an activity reached ``state``.
+
+        Args:
+            activity_id: Zwift activity id
+            state: One of the STATE_* constants
+            content_hash: Hash of the original FIT file, kept if omitted
+            garmin_upload_id: Upload id returned by Garmin, kept if omitted
+            error: Error message for failed transfers
+        """
+        now = time.time()
+        columns = ["activity_id", "fit_hash", "state", "garmin_upload_id", "error", "updated_at"]
+        values = [str(activity_id), content_hash, state,
+                  None if garmin_upload_id is None else str(garmin_upload_id), error, now]
+        updates = [
+            "fit_hash = COALESCE(excluded.fit_hash, fit_hash)",
+            "state = excluded.state",
+            "garmin_upload_id = COALESCE(excluded.garmin_upload_id, garmin_upload_id)",
+            "error = excluded.error",
+            "updated_at = excluded.updated_at",
+        ]
+        timestamp_column = _TIMESTAMP_COLUMNS.get(state)
+        if timestamp_column:
+            columns.append(timestamp_column)
+            values.append(now)
+            updates.append(f"{timestamp_column} = excluded.{timestamp_column}")
+        placeholders = ",".join("?" for _ in columns)
+        with self._lock:
+            self._connection.execute(
+                f"INSERT INTO activities ({','.join(columns)}) VALUES ({placeholders}) "
+                f"ON CONFLICT (activity_id) DO UPDATE SET {', '.join(updates)}",
+                values)
+        self.logger.debug(f"Activity {activity_id} marked as {state}")
+
+    def get_high_water_mark(self) -> Optional[str]:
+        """Return the id of the newest activity up to which everything was synced."""
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM meta WHERE key = ?", (HIGH_WATER_MARK,)).fetchone()
+        return row["value"] if row else None
+
+    def get_high_water_mark_start(self) -> Optional[datetime]:
+        """Return the (naive, UTC) start date of the high-water mark activity, if it was recorded."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM meta WHERE key = ?", (HIGH_WATER_MARK_START,)).fetchone()
+        return datetime.fromisoformat(row["value"]) if row else None
+
+    def set_high_water_mark(self, activity_id: Any, start_date: Optional[datetime] = None) -> None:
+        """Remember that all activities up to ``activity_id``, started at ``start_date``, were synced."""
+        values = [(HIGH_WATER_MARK, str(activity_id))]
+        if start_date is not None:
+            values.append((HIGH_WATER_MARK_START, start_date.isoformat()))
+        with self._lock:
+            if start_date is None:
+                self._connection.execute("DELETE FROM meta WHERE key = ?", (HIGH_WATER_MARK_START,))
+            self._connection.executemany(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                values)
+
+    def save_upload_retry(self, activity_id: Any, file_path: str, file_name: str,
+                          attempts: int, next_attempt_at: float, last_error: Optional[str]) -> None:
+        """Queue (or reschedule) a persisted upload for a later retry."""
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO upload_retries (activity_id, file_path, file_name, attempts, next_attempt_at, last_error) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (activity_id) DO UPDATE SET file_path = excluded.file_path, "
+                "file_name = excluded.file_name, attempts = excluded.attempts, "
+                "next_attempt_at = excluded.next_attempt_at, last_error = excluded.last_error",
+                (str(activity_id), file_path, file_name, attempts, next_attempt_at, last_error))
+
+    def due_upload_retries(self, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Return the queued uploads whose next attempt is due, oldest first."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT * FROM upload_retries WHERE next_attempt_at <= ? ORDER BY next_attempt_at",
+                (time.time() if now is None else now,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete_upload_retry(self, activity_id: Any) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM upload_retries WHERE activity_id = ?", (str(activity_id),))
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,335 @@
+"""Rate limited, retrying uploads to Garmin Connect."""
+
+import os
+import time
+import asyncio
+import random
+import logging
+import threading
+from typing import Any, BinaryIO, Optional
+
+from services.buffers import buffer_from_bytes
+from services.garmin_service import (
+    AsyncGarminService,
+    GarminService,
+    UploadError,
+    classify_upload_error,
+    HTTP_TOO_MANY_REQUESTS,
+)
+from services.metrics import RETRIES, STAGE_UPLOAD
+from services.sync_state import (
+    SyncStateStore,
+    STATE_DUPLICATE,
+    STATE_FAILED,
+    STATE_RETRY_PENDING,
+    STATE_UPLOADED,
+)
+
+# Average seconds between uploads and the burst allowed on top of that rate
+UPLOAD_INTERVAL = float(os.getenv("UPLOAD_INTERVAL", "2.0"))
+UPLOAD_BURST = int(os.getenv("UPLOAD_BURST", "3"))
+# Immediate attempts per upload before it is parked in the retry queue
+UPLOAD_ATTEMPTS = int(os.getenv("UPLOAD_ATTEMPTS", "4"))
+UPLOAD_BACKOFF = float(os.getenv("UPLOAD_BACKOFF", "5.0"))
+UPLOAD_MAX_BACKOFF = float(os.getenv("UPLOAD_MAX_BACKOFF", "600"))
+# Attempts from the persisted retry queue before an upload is given up
+UPLOAD_QUEUE_ATTEMPTS = int(os.getenv("UPLOAD_QUEUE_ATTEMPTS", "10"))
+# Parked uploads are kept in this directory next to the account's sync state database
+UPLOAD_RETRY_DIR_NAME = "upload_retries"
+
+
+class TokenBucket:
+    """Token bucket whose refill rate backs off when the server pushes back.
+
+    The rate is halved (down to 1/16 of the configured rate) on every
+    penalty and grows back by 10% per successful request.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        """Initialize TokenBucket.
+
+        Args:
+            rate: Tokens added per second
+            capacity: Maximum number of tokens, i.e. the allowed burst
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> float:
+        """Take a token if one is available.
+
+        Returns:
+            0 if a token was taken, otherwise the seconds to wait before trying again
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self._blocked_until and self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+
+    def acquire(self) -> None:
+        """Block until a token is available and take it."""
+        wait = self.try_acquire()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    async def acquire_async(self) -> None:
+        """Wait for a token without blocking the event loop and take it."""
+        wait = self.try_acquire()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.try_acquire()
+
+    def penalize(self, delay: float) -> None:
+        """Stop handing out tokens for ``delay`` seconds and slow down afterwards."""
+        with self._lock:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self._tokens = 0.0
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+
+    def reward(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+class UploadScheduler:
+    """Uploads activities at the highest rate Garmin Connect tolerates.
+
+    Every upload takes a token from a shared bucket. Transient failures
+    (429, 5xx, network errors) are retried with exponential backoff that
+    honours Retry-After, 429s additionally slow the bucket down. Duplicates
+    are reported as success, permanent failures are raised right away, and
+    uploads that keep failing transiently are parked on disk and retried by
+    retry_pending() on a later sync.
+    """
+
+    def __init__(self, garmin_service: GarminService,
+                 sync_state: Optional[SyncStateStore] = None,
+                 interval: float = UPLOAD_INTERVAL,
+                 burst: int = UPLOAD_BURST,
+                 attempts: int = UPLOAD_ATTEMPTS,
+                 async_garmin_service: Optional[AsyncGarminService] = None):
+        """Initialize UploadScheduler.
+
+        Args:
+            garmin_service: Service for Garmin operations
+            sync_state: Store for the persisted retry queue; without it nothing is parked
+            interval: Average number of seconds between uploads
+            burst: Number of uploads allowed back to back
+            attempts: Immediate attempts per upload
+            async_garmin_service: Service used by the coroutine variants, sharing the bucket
+        """
+        self.garmin_service = garmin_service
+        self.async_garmin_service = async_garmin_service
+        self.sync_state = sync_state
+        self.retry_dir = None if sync_state is None else os.path.join(
+            os.path.dirname(os.path.abspath(sync_state.db_path)), UPLOAD_RETRY_DIR_NAME)
+        self.bucket = TokenBucket(1 / interval if interval > 0 else 1000.0, burst)
+        self.attempts = max(1, attempts)
+        self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def backoff(attempt: int, error: UploadError) -> float:
+        """Delay before retry number ``attempt``, preferring the server's Retry-After."""
+        if error.retry_after is not None:
+            return min(UPLOAD_MAX_BACKOFF, error.retry_after)
+        delay = min(UPLOAD_MAX_BACKOFF, UPLOAD_BACKOFF * 2 ** (attempt - 1))
+        # jitter keeps parallel workers from retrying in lock step
+        return delay * random.uniform(0.8, 1.2)
+
+    def _attempt(self, fit_file: BinaryIO, file_name: str) -> Any:
+        from garminconnect import GarminConnectAuthenticationError
+
+        self.bucket.acquire()
+        try:
+            self.garmin_service.authenticate()
+            response = self.garmin_service.upload_activity_stream(fit_file, file_name)
+        except GarminConnectAuthenticationError as e:
+            raise UploadError(f"Authentication failed: {e}") from e
+        except Exception as e:
+            raise classify_upload_error(e) from e
+        self.bucket.reward()
+        return response
+
+    def _delay(self, attempt: int, error: UploadError) -> float:
+        delay = self.backoff(attempt, error)
+        if error.status_code == HTTP_TOO_MANY_REQUESTS:
+            self.bucket.penalize(delay)
+        RETRIES.inc(stage=STAGE_UPLOAD)
+        return delay
+
+    def upload(self, activity_id: Any, fit_file: BinaryIO, file_name: str) -> Any:
+        """Upload a FIT buffer, retrying transient failures.
+
+        Args:
+            activity_id: Zwift activity id, used for the retry queue
+            fit_file: Buffer with the FIT content
+            file_name: File name reported to Garmin
+
+        Returns:
+            Upload response, or None if Garmin already has the activity
+
+        Raises:
+            UploadError: If the upload failed; ``transient`` tells whether it was parked for a retry
+        """
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return self._attempt(fit_file, file_name)
+            except UploadError as e:
+                if not e.transient:
+                    self.logger.error(f"Upload of activity {activity_id} failed permanently: {e}")
+                    raise
+                error = e
+            if attempt < self.attempts:
+                delay = self._delay(attempt, error)
+                self.logger.warning(f"Upload of activity {activity_id} failed ({error}), retry in {delay:.1f}s")
+                time.sleep(delay)
+
+        self._park(activity_id, fit_file, file_name, error)
+        raise error
+
+    async def _attempt_async(self, fit_file: BinaryIO, file_name: str) -> Any:
+        from garminconnect import GarminConnectAuthenticationError
+
+        await self.bucket.acquire_async()
+        try:
+            await self.async_garmin_service.authenticate()
+            response = await self.async_garmin_service.upload_activity_stream(fit_file, file_name)
+        except GarminConnectAuthenticationError as e:
+            raise UploadError(f"Authentication failed: {e}") from e
+        except Exception as e:
+            raise classify_upload_error(e) from e
+        self.bucket.reward()
+        return response
+
+    async def upload_async(self, activity_id: Any, fit_file: BinaryIO, file_name: str) -> Any:
+        """Coroutine variant of upload(), through the async Garmin service."""
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return await self._attempt_async(fit_file, file_name)
+            except UploadError as e:
+                if not e.transient:
+                    self.logger.error(f"Upload of activity {activity_id} failed permanently: {e}")
+                    raise
+                error = e
+            if attempt < self.attempts:
+                delay = self._delay(attempt, error)
+                self.logger.warning(f"Upload of activity {activity_id} failed ({error}), retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+        # the file and the SQLite row are written in a thread, not on the event loop
+        await asyncio.to_thread(self._park, activity_id, fit_file, file_name, error)
+        raise error
+
+    def _park(self, activity_id: Any, fit_file: BinaryIO, file_name: str, error: UploadError) -> None:
+        """Persist an upload that keeps failing so a later sync can retry it.
+
+        If the file cannot be written the upload is not parked; the caller
+        still raises the original error and a later sync transfers it again.
+        """
+        if self.sync_state is None:
+            return
+        file_path = os.path.join(self.retry_dir, f"{activity_id}.fit")
+        temp_path = f"{file_path}.tmp"
+        try:
+            os.makedirs(self.retry_dir, exist_ok=True)
+            fit_file.seek(0)
+            with open(temp_path, "wb") as f_out:
+                f_out.write(fit_file.read())
+            os.replace(temp_path, file_path)
+        except OSError as e:
+            self.logger.error(f"Failed to queue the upload of activity {activity_id} for a retry: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        self.sync_state.save_upload_retry(
+            activity_id, file_path, file_name, 1,
+            time.time() + self.backoff(1, error), str(error))
+        self.sync_state.mark(activity_id, STATE_RETRY_PENDING, error=str(error))
+        self.logger.info(f"Upload of activity {activity_id} queued for a later retry")
+
+    def retry_pending(self) -> int:
+        """Give every due upload from the retry queue one more attempt.
+
+        Returns:
+            Number of uploads that went through
+        """
+        if self.sync_state is None:
+            return 0
+        succeeded = 0
+        for entry in self.sync_state.due_upload_retries():
+            try:
+                with open(entry["file_path"], "rb") as fit_file:
+                    response = self._attempt(fit_file, entry["file_name"])
+            except (FileNotFoundError, UploadError) as e:
+                self._retry_failed(entry, e)
+                continue
+            self._retry_succeeded(entry, response)
+            succeeded += 1
+        return succeeded
+
+    async def retry_pending_async(self) -> int:
+        """Coroutine variant of retry_pending(), through the async Garmin service.
+
+        The queue, the parked files and the sync state are read and written in
+        a thread; only the uploads are awaited on the event loop.
+        """
+        if self.sync_state is None:
+            return 0
+        succeeded = 0
+        for entry in await asyncio.to_thread(self.sync_state.due_upload_retries):
+            try:
+                data = await asyncio.to_thread(self._read_parked, entry["file_path"])
+                with buffer_from_bytes(data) as fit_file:
+                    response = await self._attempt_async(fit_file, entry["file_name"])
+            except (FileNotFoundError, UploadError) as e:
+                await asyncio.to_thread(self._retry_failed, entry, e)
+                continue
+            await asyncio.to_thread(self._retry_succeeded, entry, response)
+            succeeded += 1
+        return succeeded
+
+    @staticmethod
+    def _read_parked(file_path: str) -> bytes:
+        with open(file_path, "rb") as fit_file:
+            return fit_file.read()
+
+    def _retry_failed(self, entry, error: Exception) -> None:
+        activity_id = entry["activity_id"]
+        if isinstance(error, FileNotFoundError):
+            self.logger.warning(f"Parked upload of activity {activity_id} vanished, dropping it")
+            self.sync_state.delete_upload_retry(activity_id)
+            return
+        attempts = entry["attempts"] + 1
+        if not error.transient or attempts >= UPLOAD_QUEUE_ATTEMPTS:
+            self.logger.error(f"Giving up on upload of activity {activity_id}: {error}")
+            self.sync_state.mark(activity_id, STATE_FAILED, error=str(error))
+            self._drop(entry)
+        else:
+            self.sync_state.save_upload_retry(
+                activity_id, entry["file_path"], entry["file_name"], attempts,
+                time.time() + self._delay(attempts, error), str(error))
+
+    def _retry_succeeded(self, entry, response: Any) -> None:
+        self.sync_state.mark(entry["activity_id"], STATE_UPLOADED if response is not None else STATE_DUPLICATE,
+                             garmin_upload_id=GarminService.extract_upload_id(response))
+        self._drop(entry)
+
+    def _drop(self, entry) -> None:
+        self.sync_state.delete_upload_retry(entry["activity_id"])
+        try:
+            os.remove(entry["file_path"])
+        except OSError:
+            pass
@@ -1,13 +1,50 @@
 """Zwift service for handling authentication and activity downloads."""
 
 import os
+import asyncio
 import tempfile
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+import time
 import logging
-from typing import Optional, Dict, Any
-from zwift import Client as ZwiftClient
+import threading
+from itertools import islice
+from concurrent.futures import Executor
+from typing import Optional, Dict, Any, AsyncIterator, BinaryIO, Callable, Iterator, List
 from datetime import datetime, timezone
 
+from services.buffers import new_buffer
+from services.fit_protocol import FitFormatError, FitTruncatedError, validate_fit
+from services.metrics import (
+    BYTES_DOWNLOADED,
+    RETRIES,
+    STAGE_DOWNLOAD,
+    STAGE_ZWIFT_AUTH,
+    STAGE_ZWIFT_LIST,
+    stage_timer,
+    timed,
+)
+
+# Number of activities requested per listing call
+PAGE_SIZE = int(os.getenv("ZWIFT_PAGE_SIZE", "10"))
+# Maximum number of pooled connections per host
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "8"))
+# Download tuning: chunk size in bytes, attempts after the first one, base backoff in seconds
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(64 * 1024)))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "4"))
+DOWNLOAD_BACKOFF = float(os.getenv("DOWNLOAD_BACKOFF", "1.0"))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "10"))
+# Location of the .fit files, only changed to point at a stand-in server
+FIT_FILE_URL = os.getenv("ZWIFT_FIT_FILE_URL", "https://{bucket}.s3.amazonaws.com/{key}")
+# Zwift API used by the async listing, only changed to point at a stand-in server
+API_URL = os.getenv("ZWIFT_API_URL", "https://us-or-rly101.zwift.com")
+
+# HTTP statuses worth retrying, everything else is a permanent failure
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+# Answer to a resumed download whose range lies past the end of the file; it is retried from the start
+HTTP_RANGE_NOT_SATISFIABLE = 416
+
 class ZwiftService:
     """Service for interacting with Zwift API."""
 
@@ -20,40 +57,129 @@ class ZwiftService:
         """
         self.username = username
         self.password = password
-        self.client: Optional[ZwiftClient] = None
+        # zwift.Client, created on authenticate()
+        self.client = None
         self.logger = logging.getLogger(__name__)
+        # the startup warm-up may log in while the first sync does
+        self._auth_lock = threading.Lock()
         # Save the .fit file to a temporary location
         self.temp_dir = tempfile.gettempdir()        
+        # Keep-alive connections to S3 shared by all downloads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     def authenticate(self) -> None:
-        """Authenticate with Zwift."""
-        self.logger.info("Authenticating with Zwift...")
-        self.client = ZwiftClient(self.username, self.password)
-        self.logger.info("Successfully authenticated with Zwift")
+        """Authenticate with Zwift.
+
+        The client is created once and reused; it refreshes its access token
+        by itself when it expires, so repeated calls cost no login round trip.
+        """
+        if self.client is not None:
+            self.logger.debug("Reusing authenticated Zwift client")
+            return
+        # zwift-client builds its protobuf messages on import, only do that when needed
+        from zwift import Client as ZwiftClient
+
+        with self._auth_lock:
+            if self.client is not None:
+                return
+            self.logger.info("Authenticating with Zwift...")
+            with stage_timer(STAGE_ZWIFT_AUTH):
+                self.client = ZwiftClient(self.username, self.password)
+            self.logger.info("Successfully authenticated with Zwift")
+
+
+    def close(self) -> None:
+        """Release pooled connections."""
+        self.session.close()
 
 
-    def _get_activities(self) -> []:
+    def iter_activities(self, page_size: int = PAGE_SIZE) -> Iterator[Dict[str, Any]]:
+        """Lazily yields activities, newest first, fetching one page at a time.
+
+        Pages are only requested when the consumer asks for more activities, so
+        stopping the iteration early avoids listing the full history.
+
+        Args:
+            page_size: Number of activities requested per API call
+        """
         if not self.client:
             raise RuntimeError("Must authenticate before downloading activities")
 
         profile = self.client.get_profile()
         start = 0
-        limit = 10
-        activities = []
         while True:
-            act = profile.get_activities(start, limit)
-            activities.extend(act)
-            start += limit
-            if len(act) != limit:
+            with stage_timer(STAGE_ZWIFT_LIST):
+                act = profile.get_activities(start, page_size)
+            self.logger.debug(f"Fetched {len(act)} activities starting at {start}")
+            yield from act
+            start += page_size
+            if len(act) != page_size:
                 break
 
+
+    def _get_activities(self, stop: Optional[Callable[[Dict[str, Any]], bool]] = None,
+                        page_size: int = PAGE_SIZE) -> List[Dict[str, Any]]:
+        """Lists activities, newest first, until ``stop`` returns True for one.
+
+        Args:
+            stop: Predicate that ends the listing; the matching activity is excluded
+            page_size: Number of activities requested per API call
+
+        Returns:
+            The activities seen before the listing stopped
+        """
+        activities = []
+        for activity in self.iter_activities(page_size):
+            if stop is not None and stop(activity):
+                break
+            activities.append(activity)
+
         self.logger.info(f"Activities found: {len(activities)}")
 
         if len(activities) == 0:
             self.logger.info("No activities found on Zwift")
-            return None
         return activities
-    
+
+
+    @staticmethod
+    def activity_start_date(activity: Dict[str, Any]) -> datetime:
+        """Returns the (naive, UTC) start date of an activity."""
+        start_date = datetime.strptime(activity["startDate"], "%Y-%m-%dT%H:%M:%S.%f%z")
+        return start_date.astimezone(timezone.utc).replace(tzinfo=None)
+
+    @staticmethod
+    def activity_end_date(activity: Dict[str, Any]) -> datetime:
+        """Returns the (naive, UTC) end date of an activity, its start date if it has none."""
+        if not activity.get("endDate"):
+            return ZwiftService.activity_start_date(activity)
+        end_date = datetime.strptime(activity["endDate"], "%Y-%m-%dT%H:%M:%S.%f%z")
+        return end_date.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+    def get_activities_after(self, activity_id: Optional[Any],
+                             start_date: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """Returns all activities newer than ``activity_id``, newest first.
+
+        Args:
+            activity_id: High-water mark of the last synced activity, None lists everything
+            start_date: Start of the high-water mark activity; the listing also stops at older
+                activities, so a mark deleted on Zwift does not page through the whole history
+        """
+        if activity_id is None:
+            return self._get_activities()
+        return self._get_activities(stop=self._after_mark(activity_id, start_date))
+
+    @staticmethod
+    def _after_mark(activity_id: Any, start_date: Optional[datetime]) -> Callable[[Dict[str, Any]], bool]:
+        """Listing stop at the high-water mark activity, or at the first activity started before it."""
+        def stop(activity: Dict[str, Any]) -> bool:
+            if str(activity["id"]) == str(activity_id):
+                return True
+            return start_date is not None and ZwiftService.activity_start_date(activity) < start_date
+        return stop
 
     def download_last_activity(self) -> Optional[str]:
         """Downloads the last activity's .fit file from Zwift.
@@ -65,52 +191,355 @@ class ZwiftService:
             RuntimeError: If not authenticated or download fails
         """
 
-        activities = self._get_activities()
-        return self.download_activity(activities[0])
+        activity = self.get_latest_activity()
+        if activity is None:
+            return None
+        return self.download_activity(activity)
+
 
+    def fetch_last_activity(self) -> Optional[BinaryIO]:
+        """Downloads the last activity's .fit file from Zwift into memory.
 
-    def download_activity(self, activity):
+        Returns:
+            Buffer with the .fit content, or None if no activities found
+
+        Raises:
+            RuntimeError: If not authenticated or download fails
+        """
+        activity = self.get_latest_activity()
+        if activity is None:
+            return None
+        return self.fetch_activity(activity)
+
+
+    def get_latest_activity(self) -> Optional[Dict[str, Any]]:
+        """Returns the metadata of the newest activity, or None if there is none."""
+        return next(self.iter_activities(page_size=1), None)
+
+
+    def _download_into(self, activity, out: BinaryIO) -> int:
+        """Streams an activity's .fit file into ``out`` and validates it.
+
+        Interrupted transfers are resumed with an HTTP Range request and
+        retried with exponential backoff, as are files that end early. A file
+        with a bad CRC, or a resume the server answers with 416, starts over.
+
+        Returns:
+            Number of bytes written
+
+        Raises:
+            RuntimeError: If the download keeps failing
+        """
         activity_id = activity['id']
         self.logger.info(f"Downloading activity {activity_id}...")
 
-        link = f"https://{activity['fitFileBucket']}.s3.amazonaws.com/{activity['fitFileKey']}"
+        link = FIT_FILE_URL.format(bucket=activity['fitFileBucket'], key=activity['fitFileKey'])
         self.logger.info(f"Download link: {link}")
 
-        try:
-            response = requests.get(link, timeout=10)
+        received = 0
+        attempt = 0
+        while True:
+            try:
+                received = self._download_attempt(link, out, received)
+                out.seek(0)
+                validate_fit(out.read())
+                out.seek(0)
+                self.logger.info(f"Activity {activity_id} downloaded ({received} bytes)")
+                return received
+            except (requests.RequestException, FitFormatError) as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                if self._permanent(status):
+                    raise RuntimeError(f"Failed to download activity: {e}") from e
+                received = self._resume_point(e, status, out)
+                attempt += 1
+                if attempt > DOWNLOAD_RETRIES:
+                    raise RuntimeError(f"Failed to download activity: {e}") from e
+                delay = DOWNLOAD_BACKOFF * 2 ** (attempt - 1)
+                self.logger.warning(
+                    f"Download of activity {activity_id} failed ({e}), retry {attempt} in {delay:.1f}s "
+                    f"from byte {received}")
+                RETRIES.inc(stage=STAGE_DOWNLOAD)
+                time.sleep(delay)
+
+
+    @staticmethod
+    def _permanent(status: Optional[int]) -> bool:
+        return status is not None and status not in RETRYABLE_STATUS_CODES and status != HTTP_RANGE_NOT_SATISFIABLE
+
+    @staticmethod
+    def _resume_point(error: Exception, status: Optional[int], out: BinaryIO) -> int:
+        """Byte from which a failed download is retried."""
+        if status == HTTP_RANGE_NOT_SATISFIABLE:
+            # what arrived is no prefix of the file on the server, start over
+            return 0
+        if isinstance(error, FitFormatError) and not isinstance(error, FitTruncatedError):
+            # corrupt rather than incomplete, resuming would keep the bad bytes
+            return 0
+        # keep what arrived so the retry can resume from there
+        return out.seek(0, os.SEEK_END)
+
+
+    def _download_attempt(self, link: str, out: BinaryIO, received: int) -> int:
+        """Fetches ``link`` into ``out`` starting at byte ``received``.
+
+        Returns:
+            Total number of bytes in ``out``; raises if the body was cut short
+        """
+        headers = {"Range": f"bytes={received}-"} if received else {}
+        with self.session.get(link, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
             response.raise_for_status()
-        except requests.RequestException as e:
-            raise RuntimeError(f"Failed to download activity: {e}") from e
+            if received and response.status_code != 206:
+                self.logger.info("Server ignored the range request, restarting download")
+                received = 0
+            out.seek(received)
+            out.truncate()
+            expected = response.headers.get("Content-Length")
+            body = 0
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                out.write(chunk)
+                body += len(chunk)
+                BYTES_DOWNLOADED.inc(len(chunk))
+            received += body
+            if expected is not None and body < int(expected):
+                raise requests.exceptions.ChunkedEncodingError(
+                    f"Connection closed after {body} of {expected} bytes")
+        return received
+
 
+    @timed(STAGE_DOWNLOAD)
+    def fetch_activity(self, activity) -> BinaryIO:
+        """Downloads an activity's .fit file into a buffer.
 
+        The buffer stays in memory unless it exceeds the spool threshold.
+
+        Returns:
+            Buffer positioned at the start of the .fit content
+        """
+        buffer = new_buffer()
+        try:
+            self._download_into(activity, buffer)
+        except Exception:
+            buffer.close()
+            raise
+        return buffer
+
+
+    @timed(STAGE_DOWNLOAD)
+    def download_activity(self, activity):
+        activity_id = activity['id']
         fit_file_path = os.path.join(self.temp_dir, f"zwift_activity_{activity_id}.fit")
 
-        with open(fit_file_path, "wb") as file:
-            file.write(response.content)
+        with open(fit_file_path, "w+b") as file:
+            self._download_into(activity, file)
 
         self.logger.info(f"Activity {activity_id} downloaded to {fit_file_path}")
         return fit_file_path
 
 
-    def download_last_x_activities(self, x: int) -> Optional[str]:
-        activities = self._get_activities()
+    def get_last_x_activities(self, x: int) -> List[Dict[str, Any]]:
+        """Returns the metadata of the last ``x`` activities, newest first."""
+        if x <= 0:
+            return []
+        return list(islice(self.iter_activities(page_size=min(x, PAGE_SIZE)), x))
+
+
+    def get_activities_since_date(self, start_date: str) -> List[Dict[str, Any]]:
+        """Returns the metadata of all activities started after ``start_date`` (YYYY-MM-DD)."""
+        start_date_dt = datetime.strptime(start_date, "%Y-%m-%d")
+        # the listing is newest first, so the first older activity ends it
+        return self._get_activities(stop=lambda activity: self.activity_start_date(activity) <= start_date_dt)
+
+
+    def download_last_x_activities(self, x: int) -> List[str]:
         fit_file_path_list = []
-        for i in range(0,x):
+        for i, activity in enumerate(self.get_last_x_activities(x)):
             self.logger.info(f"Download activitiy {i}")
-            fit_file_path_list.append(self.download_activity(activities[i]))
+            fit_file_path_list.append(self.download_activity(activity))
         return fit_file_path_list
 
 
-    def download_activities_since_date(self, start_date: str) -> Optional[str]:
-        start_date_dt = datetime.strptime(start_date, "%Y-%m-%d")
-        activities = self._get_activities()
+    def download_activities_since_date(self, start_date: str) -> List[str]:
         fit_file_path_list = []
-        for i, activity in enumerate(activities):
-            activity_start_date_dt = datetime.strptime(activity["startDate"], "%Y-%m-%dT%H:%M:%S.%f%z")
-            self.logger.info(f"Check activity with start_date {activity_start_date_dt}")
-            if start_date_dt < activity_start_date_dt.replace(tzinfo=None):
-                self.logger.info(f"Download activitiy {i}")
-                print(f"Download activitiy {i}: {activity_start_date_dt}")
-                fit_file_path_list.append(self.download_activity(activity))
+        for i, activity in enumerate(self.get_activities_since_date(start_date)):
+            self.logger.info(f"Download activitiy {i}")
+            fit_file_path_list.append(self.download_activity(activity))
         return fit_file_path_list
 
+
+class AsyncZwiftService:
+    """Coroutine variant of the Zwift listing and downloads.
+
+    Requests go through an ``httpx.AsyncClient`` that is shared by all
+    accounts, so a waiting sync costs a suspended task instead of a thread.
+    Logging in and refreshing the access token stay with zwift-client on the
+    wrapped ZwiftService; they run in a thread once per token lifetime.
+    """
+
+    def __init__(self, zwift_service: ZwiftService, http: httpx.AsyncClient,
+                 executor: Optional[Executor] = None):
+        """Initialize AsyncZwiftService.
+
+        Args:
+            zwift_service: Holds the credentials and the zwift-client session
+            http: Connection pool shared by all async services
+            executor: Runs the CRC check of downloads, the loop's default executor if omitted
+        """
+        self.zwift_service = zwift_service
+        self.http = http
+        self.executor = executor
+        self.logger = logging.getLogger(__name__)
+        self._token_lock = asyncio.Lock()
+        # numeric player id the activities endpoints need, resolved on the first listing
+        self._player_id: Optional[Any] = None
+
+    async def authenticate(self) -> None:
+        """Authenticate with Zwift, see ZwiftService.authenticate."""
+        if self.zwift_service.client is None:
+            await asyncio.to_thread(self.zwift_service.authenticate)
+
+    async def _access_token(self) -> str:
+        auth_token = self.zwift_service.client.auth_token
+        if auth_token.have_valid_access_token():
+            return auth_token.access_token
+        async with self._token_lock:
+            # the token endpoint is only called through zwift-client, in a thread
+            return await asyncio.to_thread(auth_token.get_access_token)
+
+    async def _activities_url(self) -> str:
+        """URL of the activity listing, under the player id like zwift-client's Profile.get_activities."""
+        if self._player_id is None:
+            profile = self.zwift_service.client.get_profile()
+            # "me" is only accepted by the profile endpoint itself; zwift-client looks the id up there
+            await asyncio.to_thread(profile.check_player_id)
+            self._player_id = profile.player_id
+        return f"{API_URL}/api/profiles/{self._player_id}/activities"
+
+    async def iter_activities(self, page_size: int = PAGE_SIZE) -> AsyncIterator[Dict[str, Any]]:
+        """Lazily yields activities, newest first, see ZwiftService.iter_activities."""
+        if not self.zwift_service.client:
+            raise RuntimeError("Must authenticate before downloading activities")
+
+        from zwift.request import Request as ZwiftRequest
+
+        url = await self._activities_url()
+        start = 0
+        while True:
+            headers = {"Accept": "application/json", "Authorization": f"Bearer {await self._access_token()}"}
+            headers.update(ZwiftRequest.DEFAULT_HEADERS)
+            with stage_timer(STAGE_ZWIFT_LIST):
+                response = await self.http.get(url, params={"start": start, "limit": page_size}, headers=headers)
+                response.raise_for_status()
+                act = response.json()
+            self.logger.debug(f"Fetched {len(act)} activities starting at {start}")
+            for activity in act:
+                yield activity
+            start += page_size
+            if len(act) != page_size:
+                break
+
+    async def _get_activities(self, stop: Optional[Callable[[Dict[str, Any]], bool]] = None,
+                              page_size: int = PAGE_SIZE) -> List[Dict[str, Any]]:
+        activities = []
+        async for activity in self.iter_activities(page_size):
+            if stop is not None and stop(activity):
+                break
+            activities.append(activity)
+        self.logger.info(f"Activities found: {len(activities)}")
+        return activities
+
+    async def get_latest_activity(self) -> Optional[Dict[str, Any]]:
+        """Returns the metadata of the newest activity, or None if there is none."""
+        async for activity in self.iter_activities(page_size=1):
+            return activity
+        return None
+
+    async def get_last_x_activities(self, x: int) -> List[Dict[str, Any]]:
+        """Returns the metadata of the last ``x`` activities, newest first."""
+        if x <= 0:
+            return []
+        activities = []
+        async for activity in self.iter_activities(page_size=min(x, PAGE_SIZE)):
+            activities.append(activity)
+            if len(activities) == x:
+                break
+        return activities
+
+    async def get_activities_after(self, activity_id: Optional[Any],
+                                   start_date: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """Returns all activities newer than ``activity_id``, see ZwiftService.get_activities_after."""
+        if activity_id is None:
+            return await self._get_activities()
+        return await self._get_activities(stop=ZwiftService._after_mark(activity_id, start_date))
+
+    async def get_activities_since_date(self, start_date: str) -> List[Dict[str, Any]]:
+        """Returns the metadata of all activities started after ``start_date`` (YYYY-MM-DD)."""
+        start_date_dt = datetime.strptime(start_date, "%Y-%m-%d")
+        return await self._get_activities(
+            stop=lambda activity: ZwiftService.activity_start_date(activity) <= start_date_dt)
+
+    @timed(STAGE_DOWNLOAD)
+    async def fetch_activity(self, activity) -> BinaryIO:
+        """Downloads an activity's .fit file into a buffer, see ZwiftService.fetch_activity."""
+        buffer = new_buffer()
+        try:
+            await self._download_into(activity, buffer)
+        except Exception:
+            buffer.close()
+            raise
+        return buffer
+
+    async def _download_into(self, activity, out: BinaryIO) -> int:
+        """Streams an activity's .fit file into ``out``, resuming and retrying like the sync variant."""
+        activity_id = activity['id']
+        link = FIT_FILE_URL.format(bucket=activity['fitFileBucket'], key=activity['fitFileKey'])
+        self.logger.info(f"Downloading activity {activity_id} from {link}")
+
+        received = 0
+        attempt = 0
+        while True:
+            try:
+                received = await self._download_attempt(link, out, received)
+                # the CRC runs over the whole file in Python, it would stall every sync on the loop
+                await asyncio.get_running_loop().run_in_executor(self.executor, self._validate, out)
+                self.logger.info(f"Activity {activity_id} downloaded ({received} bytes)")
+                return received
+            except (httpx.HTTPError, FitFormatError) as e:
+                status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+                if ZwiftService._permanent(status):
+                    raise RuntimeError(f"Failed to download activity: {e}") from e
+                received = ZwiftService._resume_point(e, status, out)
+                attempt += 1
+                if attempt > DOWNLOAD_RETRIES:
+                    raise RuntimeError(f"Failed to download activity: {e}") from e
+                delay = DOWNLOAD_BACKOFF * 2 ** (attempt - 1)
+                self.logger.warning(
+                    f"Download of activity {activity_id} failed ({e}), retry {attempt} in {delay:.1f}s "
+                    f"from byte {received}")
+                RETRIES.inc(stage=STAGE_DOWNLOAD)
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _validate(out: BinaryIO) -> None:
+        out.seek(0)
+        validate_fit(out.read())
+        out.seek(0)
+
+    async def _download_attempt(self, link: str, out: BinaryIO, received: int) -> int:
+        headers = {"Range": f"bytes={received}-"} if received else {}
+        async with self.http.stream("GET", link, headers=headers) as response:
+            response.raise_for_status()
+            if received and response.status_code != 206:
+                self.logger.info("Server ignored the range request, restarting download")
+                received = 0
+            out.seek(received)
+            out.truncate()
+            expected = response.headers.get("Content-Length")
+            body = 0
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                out.write(chunk)
+                body += len(chunk)
+                BYTES_DOWNLOADED.inc(len(chunk))
+            received += body
+            if expected is not None and body < int(expected):
+                raise httpx.RemoteProtocolError(f"Connection closed after {body} of {expected} bytes")
+        return received
@@ -0,0 +1,89 @@
+"""Synthetic Zwift-like FIT files for the benchmarks."""
+
+import math
+import random
+import struct
+import time
+from typing import Dict, Optional
+
+from services.fit_protocol import fit_crc
+from services.fit_records import FIT_EPOCH_OFFSET
+
+ZWIFT_MANUFACTURER = 260
+PROFILE_VERSION = 2132
+PROTOCOL_VERSION = 0x20
+
+# Ride lengths in seconds, recorded at 1 Hz
+DURATIONS: Dict[str, int] = {
+    "10min": 10 * 60,
+    "1h": 3600,
+    "4h": 4 * 3600,
+    "8h": 8 * 3600,
+}
+
+# (field number, size, base type)
+_FILE_ID_FIELDS = [(0, 1, 0x00), (1, 2, 0x84), (2, 2, 0x84), (3, 4, 0x8C), (4, 4, 0x86)]
+_DEVICE_INFO_FIELDS = [(253, 4, 0x86), (0, 1, 0x02), (2, 2, 0x84), (4, 2, 0x84), (5, 2, 0x84)]
+_RECORD_FIELDS = [(253, 4, 0x86), (0, 4, 0x85), (1, 4, 0x85), (2, 2, 0x84), (3, 1, 0x02),
+                  (4, 1, 0x02), (5, 4, 0x86), (6, 2, 0x84), (7, 2, 0x84)]
+_SESSION_FIELDS = [(253, 4, 0x86), (2, 4, 0x86), (7, 4, 0x86), (9, 4, 0x86), (5, 1, 0x00)]
+_ACTIVITY_FIELDS = [(253, 4, 0x86), (1, 2, 0x84), (2, 1, 0x00)]
+
+_RECORD = struct.Struct("<BIiiHBBIHH")
+
+
+def _definition(local_num: int, global_num: int, fields) -> bytes:
+    body = struct.pack("<BBHB", 0, 0, global_num, len(fields))
+    body += b"".join(struct.pack("<BBB", *field) for field in fields)
+    return bytes([0x40 | local_num]) + body
+
+
+def build_activity(duration: int, seed: int = 0, end_time: Optional[float] = None) -> bytes:
+    """Build a ride of ``duration`` seconds as Zwift would record it.
+
+    Args:
+        duration: Number of seconds, one record message per second
+        seed: Seed for the simulated power/heart rate noise
+        end_time: Unix time at which the ride ended, defaults to an hour ago
+    """
+    rng = random.Random(seed)
+    end_time = time.time() - 3600 if end_time is None else end_time
+    start = int(end_time) - duration - FIT_EPOCH_OFFSET
+    body = bytearray()
+    body += _definition(0, 0, _FILE_ID_FIELDS)
+    body += struct.pack("<BBHHII", 0, 4, ZWIFT_MANUFACTURER, 0, 1000 + seed, start)
+    body += _definition(1, 23, _DEVICE_INFO_FIELDS)
+    body += struct.pack("<BIBHHH", 1, start, 0, ZWIFT_MANUFACTURER, 0, 100)
+    # a power meter and a heart rate strap next to the creator entry
+    body += struct.pack("<BIBHHH", 1, start, 1, 1, 2697, 0xFFFF)
+    body += struct.pack("<BIBHHH", 1, start, 2, 1, 1619, 0xFFFF)
+
+    body += _definition(2, 20, _RECORD_FIELDS)
+    distance = 0.0
+    altitude = 100.0
+    for second in range(duration):
+        power = max(0, int(200 + 40 * math.sin(second / 300) + rng.gauss(0, 15)))
+        speed = 6 + power / 40
+        distance += speed
+        altitude += math.sin(second / 600) * 0.2
+        body += _RECORD.pack(
+            2, start + second,
+            int(-11.64 * 2 ** 31 / 180 + second * 100), int(166.95 * 2 ** 31 / 180 + second * 80),
+            int((altitude + 500) * 5), min(254, int(130 + power / 10)), 85 + rng.randint(-3, 3),
+            int(distance * 100), int(speed * 1000), power)
+
+    body += _definition(3, 18, _SESSION_FIELDS)
+    body += struct.pack("<BIIIIB", 3, start + duration, start, duration * 1000, int(distance * 100), 2)
+    body += _definition(4, 34, _ACTIVITY_FIELDS)
+    body += struct.pack("<BIHB", 4, start + duration, 1, 0)
+
+    header = bytearray(struct.pack("<BBHI4s", 14, PROTOCOL_VERSION, PROFILE_VERSION, len(body), b".FIT"))
+    header += struct.pack("<H", fit_crc(header))
+    data = header + body
+    data += struct.pack("<H", fit_crc(data))
+    return bytes(data)
+
+
+def build_fixtures(seed: int = 0) -> Dict[str, bytes]:
+    """One activity per entry of DURATIONS."""
+    return {name: build_activity(duration, seed) for name, duration in DURATIONS.items()}
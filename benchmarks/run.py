@@ -0,0 +1,126 @@
+"""Benchmark the transfer pipeline against local stand-in servers.
+
+Usage: python benchmarks/run.py [--output results.json] [--scenarios codec,transfer,flow]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+# settings are read when the services are imported; keep the runs away from
+# the real data directory, the converted file cache and the upload pacing
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="zwift_benchmark_"))
+os.environ.setdefault("FIT_CACHE_MAX_SIZE", "0")
+os.environ.setdefault("UPLOAD_INTERVAL", "0")
+os.environ.setdefault("UPLOAD_BACKOFF", "0.05")
+os.environ.setdefault("DOWNLOAD_BACKOFF", "0.05")
+os.environ.setdefault("FIT_VALIDATION", "warn")
+
+from fixtures import DURATIONS, build_fixtures  # noqa: E402
+from scenarios import SCENARIOS, Case, Options  # noqa: E402
+from servers import StandInConfig  # noqa: E402
+from services.metrics import STAGE_DURATION  # noqa: E402
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_case(case: Case, repeat: int) -> dict:
+    """Time ``repeat`` calls of a case and summarize them."""
+    STAGE_DURATION.reset()
+    durations = []
+    try:
+        for _ in range(repeat):
+            argument = case.setup()
+            started = time.perf_counter()
+            case.run(argument)
+            durations.append(time.perf_counter() - started)
+    finally:
+        case.teardown()
+    median = statistics.median(durations)
+    result = {
+        "scenario": case.scenario,
+        "variant": case.variant,
+        "runs": repeat,
+        "bytes": case.bytes,
+        "min": min(durations),
+        "median": median,
+        "mean": statistics.mean(durations),
+        "max": max(durations),
+        "throughput_mb_s": case.bytes / median / 1e6 if median else None,
+        "stages": {labels[0]: {"count": count, "seconds": seconds}
+                   for labels, (count, seconds) in sorted(STAGE_DURATION.totals().items())},
+    }
+    result.update(case.extra())
+    return result
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", default="-", help="JSON file for the results, - for stdout")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--fixtures", default=",".join(DURATIONS),
+                        help=f"comma separated subset of {', '.join(DURATIONS)}")
+    parser.add_argument("--engines", default="native", help="comma separated conversion engines")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    parser.add_argument("--batch-size", type=int, default=8, help="activities in the batch flow")
+    parser.add_argument("--accounts", type=int, default=24, help="accounts syncing at once in the async flow")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="answer every n-th request with 429")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="Retry-After sent with a 429")
+    args = parser.parse_args(argv)
+
+    fixtures = build_fixtures()
+    names = args.fixtures.split(",")
+    unknown = [name for name in names if name not in fixtures]
+    unknown += [name for name in args.scenarios.split(",") if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown fixtures or scenarios: {', '.join(unknown)}")
+    server = StandInConfig(latency=args.latency, rate_limit_every=args.rate_limit_every,
+                           retry_after=args.retry_after)
+    options = Options({name: fixtures[name] for name in names}, args.engines.split(","),
+                      server, args.batch_size, args.accounts)
+
+    results = []
+    for scenario in args.scenarios.split(","):
+        for case in SCENARIOS[scenario](options):
+            result = run_case(case, args.repeat)
+            print(f"{result['scenario']:>24} {result['variant']:>6}  median {result['median'] * 1000:9.2f} ms",
+                  file=sys.stderr)
+            results.append(result)
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": vars(args),
+        "results": results,
+    }
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
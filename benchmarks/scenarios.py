@@ -0,0 +1,258 @@
+"""Benchmark scenarios for the stages and flows of the transfer pipeline."""
+
+import os
+import io
+import asyncio
+import itertools
+import tempfile
+from dataclasses import dataclass, field, replace
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+from services import garmin_service as garmin_module
+from services import zwift_service as zwift_module
+from services.activity_processor import ActivityProcessor
+from services.async_processor import AsyncActivityProcessor
+from services.buffers import buffer_from_bytes
+from services.fit_cache import ConvertedFitCache
+from services.fit_file_service import ENGINE_CSV, ENGINE_JVM, ENGINE_NATIVE, FitFileService, jar_path
+from services.fit_protocol import fit_crc
+from services.fit_records import decode_records, summarize
+from services.garmin_service import GarminService
+from services.sync_state import SyncStateStore
+from services.upload_scheduler import UploadScheduler
+from services.zwift_service import ZwiftService
+
+from fixtures import DURATIONS, build_activity
+from servers import (
+    GarminStandIn,
+    StandInConfig,
+    StandInGarminClient,
+    StandInZwiftClient,
+    ZwiftStandIn,
+)
+
+
+@dataclass
+class Options:
+    """Settings shared by all scenarios."""
+
+    fixtures: Dict[str, bytes]
+    engines: List[str] = field(default_factory=lambda: [ENGINE_NATIVE])
+    server: StandInConfig = field(default_factory=StandInConfig)
+    batch_size: int = 8
+    accounts: int = 24
+
+
+@dataclass
+class Case:
+    """One timed operation: ``setup`` runs untimed before every call of ``run``."""
+
+    scenario: str
+    variant: str
+    run: Callable[[Any], Any]
+    setup: Callable[[], Any] = lambda: None
+    teardown: Callable[[], None] = lambda: None
+    bytes: int = 0
+    extra: Callable[[], Dict[str, Any]] = dict
+
+
+def _zwift(server: ZwiftStandIn) -> ZwiftService:
+    # listing (async) and downloads resolve their location through these module settings
+    zwift_module.FIT_FILE_URL = server.fit_file_url
+    zwift_module.API_URL = server.url
+    service = ZwiftService("benchmark", "benchmark")
+    service.client = StandInZwiftClient(server.url)
+    return service
+
+
+def _garmin(server: GarminStandIn) -> GarminService:
+    garmin_module.UPLOAD_URL = server.url + "{path}"
+    service = GarminService("benchmark", "benchmark")
+    service.client = StandInGarminClient(server.url)
+    return service
+
+
+def _upload(scheduler: UploadScheduler, buffer, number: int):
+    # a fresh file name each time, the stand-in answers 409 for repeated ones
+    return scheduler.upload(number, buffer, f"benchmark_{number}.fit")
+
+
+def _engines(options: Options) -> List[str]:
+    """The requested engines that can run here; the FIT SDK ones need the jar."""
+    available = [ENGINE_NATIVE] + ([ENGINE_JVM, ENGINE_CSV] if os.path.exists(jar_path) else [])
+    return [engine for engine in options.engines if engine in available]
+
+
+def codec_cases(options: Options) -> List[Case]:
+    """CPU bound stages on every fixture: CRC, conversion and record decoding."""
+    cases = []
+    for name, data in options.fixtures.items():
+        cases.append(Case("crc", name, lambda _, data=data: fit_crc(data), bytes=len(data)))
+        cases.append(Case("decode_records", name, lambda _, data=data: summarize(decode_records(data)),
+                          bytes=len(data)))
+        for engine in _engines(options):
+            service = FitFileService(engine)
+            cases.append(Case(
+                f"convert_{engine}", name,
+                lambda buffer, service=service: service.modify_device_info_stream(buffer).close(),
+                setup=lambda data=data: buffer_from_bytes(data), bytes=len(data)))
+    return cases
+
+
+def transfer_cases(options: Options) -> List[Case]:
+    """Download from the S3 stand-in and upload to the Garmin stand-in, per fixture."""
+    cases = []
+    for name, data in options.fixtures.items():
+        zwift_server = ZwiftStandIn([data], options.server).__enter__()
+        zwift = _zwift(zwift_server)
+        activity = zwift_server.activities[0]
+        cases.append(Case(
+            "download", name, lambda _, zwift=zwift, activity=activity: zwift.fetch_activity(activity).close(),
+            setup=lambda server=zwift_server, zwift=zwift: setattr(zwift_module, "FIT_FILE_URL",
+                                                                   server.fit_file_url),
+            teardown=lambda server=zwift_server: server.__exit__(None, None, None),
+            bytes=len(data),
+            extra=lambda server=zwift_server: {"requests": server.requests, "rate_limited": server.rate_limited}))
+
+        garmin_server = GarminStandIn(options.server).__enter__()
+        garmin = _garmin(garmin_server)
+        garmin.authenticate()
+        # through the scheduler, which retries the stand-in's 429s like a sync does
+        scheduler = UploadScheduler(garmin)
+        counter = itertools.count()
+        cases.append(Case(
+            "upload", name,
+            lambda buffer, scheduler=scheduler, counter=counter: _upload(scheduler, buffer, next(counter)),
+            setup=lambda data=data: io.BytesIO(data),
+            teardown=lambda server=garmin_server: server.__exit__(None, None, None),
+            bytes=len(data),
+            extra=lambda server=garmin_server: {"requests": server.requests, "rate_limited": server.rate_limited,
+                                                "conflicts": server.conflicts}))
+    return cases
+
+
+class _Flow:
+    """Fresh stand-ins, sync state and processors for every run of a flow.
+
+    With ``async_io`` every run gets its own connection pool, as a pool is
+    bound to the event loop of the run. ``accounts`` processors share the
+    stand-ins, the pool and the conversion service.
+    """
+
+    def __init__(self, files: List[bytes], options: Options, engine: str,
+                 async_io: bool = False, accounts: int = 1):
+        self.files = files
+        self.options = options
+        self.fit_file_service = FitFileService(engine)
+        self.async_io = async_io
+        self.accounts = accounts
+        self.http: Optional[httpx.AsyncClient] = None
+        self.stats: Dict[str, Any] = {}
+        self._servers = []
+        self._temp_dir: Optional[tempfile.TemporaryDirectory] = None
+
+    def setup(self) -> List[ActivityProcessor]:
+        self.teardown()
+        self._temp_dir = tempfile.TemporaryDirectory()
+        server = self.options.server
+        if self.accounts > 1:
+            # every account uploads the same activity, which is not a duplicate for them
+            server = replace(server, conflict_duplicates=False)
+        zwift_server = ZwiftStandIn(self.files, server).__enter__()
+        garmin_server = GarminStandIn(server).__enter__()
+        self._servers = [zwift_server, garmin_server]
+        self.http = httpx.AsyncClient() if self.async_io else None
+        processors = []
+        for account in range(self.accounts):
+            zwift, garmin = _zwift(zwift_server), _garmin(garmin_server)
+            sync_state = SyncStateStore(os.path.join(self._temp_dir.name, f"sync_state_{account}.db"))
+            cache = ConvertedFitCache(max_size=0)
+            if self.async_io:
+                processors.append(AsyncActivityProcessor(zwift, garmin, self.fit_file_service, self.http,
+                                                         sync_state=sync_state, fit_cache=cache))
+            else:
+                processors.append(ActivityProcessor(zwift, garmin, self.fit_file_service, sync_state,
+                                                    fit_cache=cache))
+        return processors
+
+    def run_async(self, flows) -> Any:
+        async def run():
+            async with self.http:
+                return await asyncio.gather(*flows)
+        return asyncio.run(run())
+
+    def teardown(self) -> None:
+        if self._servers:
+            zwift_server, garmin_server = self._servers
+            self.stats = {"zwift_requests": zwift_server.requests, "garmin_requests": garmin_server.requests,
+                          "rate_limited": zwift_server.rate_limited + garmin_server.rate_limited,
+                          "uploaded": garmin_server.uploads, "conflicts": garmin_server.conflicts}
+            for server in self._servers:
+                server.__exit__(None, None, None)
+            self._servers = []
+        if self._temp_dir is not None:
+            self._temp_dir.cleanup()
+            self._temp_dir = None
+
+
+def flow_cases(options: Options) -> List[Case]:
+    """Full ActivityProcessor flows against the stand-ins, blocking and async."""
+    cases = []
+    sizes = list(options.fixtures.values())
+    latest_name = "1h" if "1h" in options.fixtures else next(iter(options.fixtures))
+    latest_file = options.fixtures[latest_name]
+
+    # distinct activities of mixed length, cycling through the fixtures
+    names = list(options.fixtures)
+    batch = [build_activity(DURATIONS[names[i % len(names)]], seed=i) if names[i % len(names)] in DURATIONS
+             else sizes[i % len(sizes)] for i in range(options.batch_size)]
+
+    for engine in _engines(options):
+        latest = _Flow([latest_file], options, engine)
+        cases.append(Case(
+            f"flow_latest_{engine}", latest_name,
+            lambda processors: processors[0].process_latest_activity(),
+            setup=latest.setup, teardown=latest.teardown, bytes=len(latest_file),
+            extra=lambda flow=latest: flow.stats))
+
+        flow = _Flow(batch, options, engine)
+        cases.append(Case(
+            f"flow_batch_{engine}", f"{options.batch_size}x",
+            lambda processors, size=options.batch_size: processors[0].process_last_x_activities(size),
+            setup=flow.setup, teardown=flow.teardown, bytes=sum(map(len, batch)),
+            extra=lambda flow=flow: flow.stats))
+
+        latest_async = _Flow([latest_file], options, engine, async_io=True)
+        cases.append(Case(
+            f"flow_latest_async_{engine}", latest_name,
+            lambda processors, flow=latest_async: flow.run_async(
+                [processors[0].process_latest_activity_async()]),
+            setup=latest_async.setup, teardown=latest_async.teardown, bytes=len(latest_file),
+            extra=lambda flow=latest_async: flow.stats))
+
+        batch_async = _Flow(batch, options, engine, async_io=True)
+        cases.append(Case(
+            f"flow_batch_async_{engine}", f"{options.batch_size}x",
+            lambda processors, flow=batch_async, size=options.batch_size: flow.run_async(
+                [processors[0].process_last_x_activities_async(size)]),
+            setup=batch_async.setup, teardown=batch_async.teardown, bytes=sum(map(len, batch)),
+            extra=lambda flow=batch_async: flow.stats))
+
+        # many accounts syncing their latest activity at the same time on one event loop
+        accounts = _Flow([latest_file], options, engine, async_io=True, accounts=options.accounts)
+        cases.append(Case(
+            f"flow_accounts_async_{engine}", f"{options.accounts}x{latest_name}",
+            lambda processors, flow=accounts: flow.run_async(
+                [processor.process_latest_activity_async() for processor in processors]),
+            setup=accounts.setup, teardown=accounts.teardown, bytes=len(latest_file) * options.accounts,
+            extra=lambda flow=accounts: flow.stats))
+    return cases
+
+
+SCENARIOS: Dict[str, Callable[[Options], List[Case]]] = {
+    "codec": codec_cases,
+    "transfer": transfer_cases,
+    "flow": flow_cases,
+}
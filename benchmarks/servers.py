@@ -0,0 +1,266 @@
+"""Local stand-ins for the Zwift API, the S3 bucket and Garmin Connect."""
+
+import re
+import json
+import time
+import threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+# the activities endpoints need the numeric player id, which zwift-client resolves through the "me" profile
+PLAYER_ID = 1_234_567
+PROFILE_PATH = "/api/profiles/me"
+ACTIVITIES_PATH = f"/api/profiles/{PLAYER_ID}/activities"
+S3_PATH = "/s3"
+UPLOAD_PATH = "/upload-service/upload"
+
+
+@dataclass
+class StandInConfig:
+    """Behaviour of a stand-in server.
+
+    Attributes:
+        latency: Seconds added to every response
+        rate_limit_every: Answer every n-th request with 429, 0 never does
+        retry_after: Retry-After header sent with a 429
+        conflict_duplicates: Answer 409 when a file name is uploaded a second time
+    """
+
+    latency: float = 0.0
+    rate_limit_every: int = 0
+    retry_after: float = 1.0
+    conflict_duplicates: bool = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately; don't let them wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes = b"", headers: Optional[Dict[str, str]] = None,
+               content_type: str = "application/json") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _throttled(self) -> bool:
+        """Apply latency and rate limiting; returns True if a 429 was sent."""
+        server: StandInServer = self.server.stand_in
+        time.sleep(server.config.latency)
+        if server.count_request():
+            self._reply(429, b'{"error": "rate limited"}', {"Retry-After": f"{server.config.retry_after:g}"})
+            return True
+        return False
+
+    def do_GET(self):
+        if not self._throttled():
+            self.server.stand_in.handle_get(self)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self._throttled():
+            self.server.stand_in.handle_post(self, body)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # many accounts connect at once; the default backlog of 5 would stall them in SYN retries
+    request_queue_size = 128
+
+
+class StandInServer:
+    """Threaded HTTP server on a free localhost port, used as a context manager."""
+
+    def __init__(self, config: Optional[StandInConfig] = None):
+        self.config = config or StandInConfig()
+        self.requests = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        self._server.stand_in = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count_request(self) -> bool:
+        """Count a request; returns True if it has to be rate limited."""
+        with self._lock:
+            self.requests += 1
+            every = self.config.rate_limit_every
+            limited = bool(every) and self.requests % every == 0
+            self.rate_limited += limited
+            return limited
+
+    def __enter__(self) -> "StandInServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle_get(self, handler: _Handler) -> None:
+        handler._reply(404)
+
+    def handle_post(self, handler: _Handler, body: bytes) -> None:
+        handler._reply(404)
+
+
+class ZwiftStandIn(StandInServer):
+    """Serves an activity listing and the matching .fit files with Range support."""
+
+    def __init__(self, files: List[bytes], config: Optional[StandInConfig] = None):
+        """Initialize ZwiftStandIn.
+
+        Args:
+            files: FIT files of the activities, newest first
+            config: Latency and rate limiting
+        """
+        super().__init__(config)
+        self.files = {f"activity-{i}.fit": data for i, data in enumerate(files)}
+        self.activities = [
+            {"id": 10_000 + len(files) - i, "startDate": "2026-01-01T10:00:00.000+0000",
+             "fitFileBucket": "bucket", "fitFileKey": f"activity-{i}.fit"}
+            for i in range(len(files))
+        ]
+
+    def handle_get(self, handler: _Handler) -> None:
+        url = urlparse(handler.path)
+        if url.path == PROFILE_PATH:
+            handler._reply(200, json.dumps({"id": PLAYER_ID}).encode())
+            return
+        if url.path == ACTIVITIES_PATH:
+            query = parse_qs(url.query)
+            start = int(query.get("start", ["0"])[0])
+            limit = int(query.get("limit", ["10"])[0])
+            handler._reply(200, json.dumps(self.activities[start:start + limit]).encode())
+            return
+        data = self.files.get(url.path.rsplit("/", 1)[-1]) if url.path.startswith(S3_PATH) else None
+        if data is None:
+            handler._reply(404)
+            return
+        match = re.match(r"bytes=(\d+)-", handler.headers.get("Range", ""))
+        if match:
+            offset = int(match.group(1))
+            handler._reply(206, data[offset:], {"Content-Range": f"bytes {offset}-{len(data) - 1}/{len(data)}"},
+                           "application/octet-stream")
+        else:
+            handler._reply(200, data, content_type="application/octet-stream")
+
+    @property
+    def fit_file_url(self) -> str:
+        """Template for ZWIFT_FIT_FILE_URL pointing at this server."""
+        return self.url + S3_PATH + "/{bucket}/{key}"
+
+
+class GarminStandIn(StandInServer):
+    """Accepts uploads, answering 409 for file names it has already seen."""
+
+    def __init__(self, config: Optional[StandInConfig] = None):
+        super().__init__(config)
+        self.uploaded: Dict[str, int] = {}
+        # accepted uploads; several accounts may upload the same file name
+        self.uploads = 0
+        self.conflicts = 0
+
+    def handle_post(self, handler: _Handler, body: bytes) -> None:
+        if urlparse(handler.path).path != UPLOAD_PATH:
+            handler._reply(404)
+            return
+        match = re.search(rb'filename="([^"]+)"', body)
+        name = match.group(1).decode() if match else ""
+        with self._lock:
+            duplicate = name in self.uploaded
+            if duplicate and self.config.conflict_duplicates:
+                self.conflicts += 1
+            else:
+                self.uploaded[name] = len(self.uploaded) + 1
+                self.uploads += 1
+            upload_id = self.uploaded[name]
+        if duplicate and self.config.conflict_duplicates:
+            handler._reply(409, b'{"detailedImportResult": {"failures": [{"messages": ["Duplicate Activity."]}]}}')
+            return
+        handler._reply(201, json.dumps({"detailedImportResult": {"uploadId": upload_id}}).encode())
+
+
+class _ZwiftToken:
+    access_token = "benchmark"
+
+    def have_valid_access_token(self) -> bool:
+        return True
+
+
+class StandInZwiftClient:
+    """Takes the place of zwift.Client, listing activities from a ZwiftStandIn."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.session = requests.Session()
+        self.auth_token = _ZwiftToken()
+
+    def get_profile(self, player_id: Any = "me") -> "_StandInProfile":
+        return _StandInProfile(self, player_id)
+
+
+class _StandInProfile:
+    """Takes the place of zwift.profile.Profile, resolving "me" to the player id like it does."""
+
+    def __init__(self, client: StandInZwiftClient, player_id: Any):
+        self.client = client
+        self.player_id = player_id
+
+    def _json(self, path: str, **params) -> Any:
+        response = self.client.session.get(self.client.url + path, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def check_player_id(self) -> None:
+        if self.player_id == "me":
+            self.player_id = self._json(PROFILE_PATH)["id"]
+
+    def get_activities(self, start: int = 0, limit: int = 10) -> List[Dict[str, Any]]:
+        self.check_player_id()
+        return self._json(f"/api/profiles/{self.player_id}/activities", start=start, limit=limit)
+
+
+class _Token:
+    expires_at = float("inf")
+
+    def __str__(self) -> str:
+        return "Bearer benchmark"
+
+
+class StandInGarminClient:
+    """Takes the place of garminconnect.Garmin, uploading to a GarminStandIn."""
+
+    garmin_connect_upload = UPLOAD_PATH
+    domain = "garmin.com"
+
+    def __init__(self, url: str):
+        self.url = url
+        self.session = requests.Session()
+        self.garth = self
+        self.oauth2_token = _Token()
+
+    def login(self, token_file: Optional[str] = None) -> None:
+        pass
+
+    def post(self, subdomain: str, path: str, api: bool = False, **kwargs) -> Any:
+        response = self.session.post(self.url + path, **kwargs)
+        # raises requests.HTTPError, which carries the response like garth's errors do
+        response.raise_for_status()
+        return response.json()